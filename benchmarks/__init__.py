@@ -0,0 +1,7 @@
+"""Benchmarks for the conversion pipeline
+
+Run them from the root of the repository, like this:
+
+    python -m benchmarks.memory
+
+"""
@@ -0,0 +1,169 @@
+"""Generate synthetic WordPress exports of any size
+
+The posts are a mix of the two kinds of markup that WordPress exports:
+
+    - block editor (Gutenberg) posts, in which every block is wrapped in
+      `<!-- wp:... -->` comments
+
+    - classic editor posts, with paragraphs wrapped in spans, images that
+      link to themselves, images that run into the following paragraph, and
+      `[gallery]` shortcodes
+
+Every post has a thumbnail, and every image refers to an attachment in the
+export. The same arguments always generate the same export.
+
+"""
+
+import dataclasses
+import random
+import typing
+
+from tests.context import rss_doc
+
+images_per_post = 4
+
+words = (
+    'the quick brown fox jumps over lazy dog while WordPress exports every '
+    'post as XML and Astro builds static pages from Markdown files'
+).split()
+
+
+@dataclasses.dataclass
+class Spec:
+    posts: int = 1000
+    images_per_post: int = images_per_post
+    gallery_size: int = 6
+    paragraphs: int = 8
+    classic_ratio: float = 0.5
+    seed: int = 0
+
+    @property
+    def attachments_per_post(self) -> int:
+        return self.images_per_post + self.gallery_size
+
+
+def attachment_url(attachment_id: int) -> str:
+    return f'https://example.files.wordpress.com/2023/10/{attachment_id}.jpg'
+
+
+def attachment_item(attachment_id: int) -> str:
+    return f"""
+<item>
+  <title><![CDATA[{attachment_id}]]></title>
+  <wp:post_id>{attachment_id}</wp:post_id>
+  <wp:post_date_gmt>2023-10-24 15:25:20</wp:post_date_gmt>
+  <wp:post_name>{attachment_id}</wp:post_name>
+  <wp:status>inherit</wp:status>
+  <wp:post_type>attachment</wp:post_type>
+  <wp:attachment_url>{attachment_url(attachment_id)}</wp:attachment_url>
+</item>
+"""
+
+
+def image_tag(attachment_id: int) -> str:
+    return (
+        f'<img class="alignnone size-full wp-image-{attachment_id}" '
+        f'src="{attachment_url(attachment_id)}?w=1024" alt="" '
+        'width="4160" height="3120" />'
+    )
+
+
+def sentence(rng: random.Random) -> str:
+    return ' '.join(rng.choices(words, k=rng.randint(8, 20))).capitalize()
+
+
+def paragraph(rng: random.Random) -> str:
+    return '. '.join(sentence(rng) for _ in range(rng.randint(2, 6))) + '.'
+
+
+def block_content(rng: random.Random, spec: Spec, image_ids: list[int]) -> str:
+    heading = f'<h2>{sentence(rng)}</h2>'
+    blocks = [f'<!-- wp:heading -->\n{heading}\n<!-- /wp:heading -->']
+    for i in range(spec.paragraphs):
+        blocks.append(
+            f'<!-- wp:paragraph -->\n<p>{paragraph(rng)}</p>\n'
+            '<!-- /wp:paragraph -->'
+        )
+        if i < len(image_ids):
+            image_id = image_ids[i]
+            blocks.append(
+                f'<!-- wp:image {{"id":{image_id}}} -->\n'
+                f'<figure class="wp-block-image">{image_tag(image_id)}'
+                '</figure>\n<!-- /wp:image -->'
+            )
+    return '\n\n'.join(blocks)
+
+
+def classic_content(
+    rng: random.Random, spec: Spec, image_ids: list[int], gallery: list[int]
+) -> str:
+    blocks = []
+    for i in range(spec.paragraphs):
+        text = f'<span style="font-weight: 400;">{paragraph(rng)}</span>'
+        if i < len(image_ids):
+            image_id = image_ids[i]
+            url = attachment_url(image_id)
+            if i % 2:
+                text = f'<a href="{url}">{image_tag(image_id)}</a>\n\n{text}'
+            else:
+                text = image_tag(image_id) + text
+        blocks.append(text)
+    if gallery:
+        ids = ','.join(str(i) for i in gallery)
+        blocks.append(f'[gallery ids="{ids}" type="rectangular"]')
+    return '\n\n'.join(blocks)
+
+
+def post_item(
+    post_id: int, image_ids: list[int] = [], content: str = ''
+) -> str:
+    if not content:
+        content = '\n\n'.join(image_tag(i) for i in image_ids)
+    thumbnail_id = image_ids[0] if image_ids else ''
+    return f"""
+<item>
+  <title><![CDATA[Post {post_id}]]></title>
+  <wp:post_id>{post_id}</wp:post_id>
+  <wp:post_date_gmt>2023-10-24 15:25:27</wp:post_date_gmt>
+  <wp:post_name>post-{post_id}</wp:post_name>
+  <wp:post_type>post</wp:post_type>
+  <wp:status>publish</wp:status>
+  <category domain="post_tag" nicename="tag-{post_id % 10}"><![CDATA[Tag]]></category>
+  <wp:postmeta>
+    <wp:meta_key>_thumbnail_id</wp:meta_key>
+    <wp:meta_value><![CDATA[{thumbnail_id}]]></wp:meta_value>
+  </wp:postmeta>
+  <content:encoded><![CDATA[{content}]]></content:encoded>
+</item>
+"""
+
+
+def items(spec: Spec) -> typing.Iterator[str]:
+    rng = random.Random(spec.seed)
+    for post_id in range(spec.posts):
+        first = spec.posts + post_id * spec.attachments_per_post
+        attachment_ids = list(range(first, first + spec.attachments_per_post))
+        for attachment_id in attachment_ids:
+            yield attachment_item(attachment_id)
+        image_ids = attachment_ids[: spec.images_per_post]
+        gallery = attachment_ids[spec.images_per_post :]
+        if rng.random() < spec.classic_ratio:
+            content = classic_content(rng, spec, image_ids, gallery)
+        else:
+            content = block_content(rng, spec, image_ids)
+        yield post_item(post_id, image_ids, content)
+
+
+def write_export(
+    file: typing.TextIO, num_posts: int, images: int = images_per_post
+) -> None:
+    spec = Spec(posts=num_posts, images_per_post=images, gallery_size=0)
+    write_spec(file, spec)
+
+
+def write_spec(file: typing.TextIO, spec: Spec) -> None:
+    header, footer = rss_doc('{items}').split('{items}')
+    file.write(header)
+    for item in items(spec):
+        file.write(item)
+    file.write(footer)
@@ -0,0 +1,57 @@
+"""Measure HostedImageFilter on posts containing hundreds of images
+
+For comparison, `regex_per_image()` rewrites the post with a separate
+`re.sub()` call for each image, which is how the filter used to work.
+
+"""
+
+import re
+import timeit
+import typing
+
+from benchmarks import corpus
+from wpsite import astro
+from wpsite.page import AttachmentParser
+
+image_counts = [10, 100, 300, 1000]
+
+
+def regex_per_image(attachments: typing.Mapping[str, str], text: str) -> str:
+    def replace_url(attachment_id: str) -> None:
+        nonlocal text
+        url = attachments[attachment_id]
+        multiprotocol_url = url.replace('https://', 'https?://')
+        text = re.sub(
+            rf'{multiprotocol_url}(\?[^"]+)?', astro.attachment_path(url), text
+        )
+
+    parser = AttachmentParser(replace_url)
+    parser.feed(text)
+    parser.close()
+    return text
+
+
+def post_with_images(count: int) -> tuple[typing.Mapping[str, str], str]:
+    attachments = {str(i): corpus.attachment_url(i) for i in range(count)}
+    paragraph = f'<p>{"Some words in a paragraph. " * 20}</p>\n\n'
+    text = ''.join(paragraph + corpus.image_tag(i) for i in range(count))
+    return attachments, text
+
+
+def best_time(function: typing.Callable[[], object], repeat: int = 3) -> float:
+    return min(timeit.repeat(function, number=1, repeat=repeat))
+
+
+def main() -> None:
+    print(f'{"images":>7} {"per image ms":>13} {"single scan ms":>15}')
+    for count in image_counts:
+        attachments, text = post_with_images(count)
+        image_filter = astro.HostedImageFilter(attachments)
+        assert image_filter(text) == regex_per_image(attachments, text)
+        before = best_time(lambda: regex_per_image(attachments, text))
+        after = best_time(lambda: image_filter(text))
+        print(f'{count:>7} {before * 1000:>13.1f} {after * 1000:>15.1f}')
+
+
+if __name__ == '__main__':
+    main()
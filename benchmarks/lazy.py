@@ -0,0 +1,51 @@
+"""Measure the memory held by parsed posts, with and without their content
+
+Every post in a synthetic export is kept in a list (as a caller building an
+index page might), read by `wp.posts()`, by `wp.posts(lazy=True)` and by
+`wp.post_metadata()`. The memory still allocated once they've all been read
+is reported, along with how quickly they were read.
+
+"""
+
+import io
+import time
+import tracemalloc
+import typing
+
+from benchmarks import corpus
+from wpsite import wp
+
+num_posts = 5000
+
+
+def measure(read: typing.Callable[[io.BytesIO], list]) -> tuple[float, float]:
+    export = io.StringIO()
+    corpus.write_spec(export, corpus.Spec(posts=num_posts))
+    source = io.BytesIO(export.getvalue().encode())
+    del export
+    tracemalloc.start()
+    try:
+        started = time.perf_counter()
+        posts = read(source)
+        elapsed = time.perf_counter() - started
+        held, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert len(posts) == num_posts
+    return num_posts / elapsed, held / 1024 / 1024
+
+
+def main() -> None:
+    readers: dict[str, typing.Callable[[io.BytesIO], list]] = {
+        'posts': lambda source: list(wp.posts(source)),
+        'lazy posts': lambda source: list(wp.posts(source, lazy=True)),
+        'metadata': lambda source: list(wp.post_metadata(source)),
+    }
+    print(f'{"read":<11} {"posts/s":>10} {"held MB":>8}')
+    for name, read in readers.items():
+        speed, held = measure(read)
+        print(f'{name:<11} {speed:>10.1f} {held:>8.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""Measure how quickly posts are converted to Markdown
+
+`page.Markdownify` is compared with calling `markdownify.markdownify()` for
+each post, which is how posts used to be converted. It's run over posts with
+images, galleries and classic editor markup, and over posts that contain
+nothing but headings and paragraphs (which can take the fast path).
+
+"""
+
+import io
+import time
+import typing
+
+import markdownify  # type: ignore
+
+import wpsite
+
+from benchmarks import corpus
+from wpsite import page, wp
+
+num_posts = 500
+
+
+def filtered_html(spec: corpus.Spec) -> list[str]:
+    export = io.StringIO()
+    corpus.write_spec(export, spec)
+    export.seek(0)
+    attachments, spool = wp.split_export(export)
+    with spool:
+        posts = wp.posts(spool, wpsite.filters(attachments))
+        return [post.filtered_html for post in posts]
+
+
+def posts_per_second(
+    convert: typing.Callable[[str], str], posts: list[str]
+) -> float:
+    started = time.perf_counter()
+    for html in posts:
+        convert(html)
+    return len(posts) / (time.perf_counter() - started)
+
+
+def convert_with_markdownify(html: str) -> str:
+    return markdownify.markdownify(html, heading_style=markdownify.ATX)
+
+
+def main() -> None:
+    specs = {
+        'mixed': corpus.Spec(posts=num_posts),
+        'plain': corpus.Spec(
+            posts=num_posts, images_per_post=0, gallery_size=0, classic_ratio=0
+        ),
+    }
+    converter = page.Markdownify()
+    print(f'parser: {converter.parser}')
+    print(f'{"posts":<6} {"markdownify()":>14} {"Markdownify":>12}')
+    for name, spec in specs.items():
+        posts = filtered_html(spec)
+        for html in posts:
+            assert converter(html) == convert_with_markdownify(html)
+        before = posts_per_second(convert_with_markdownify, posts)
+        after = posts_per_second(converter, posts)
+        print(
+            f'{name:<6} {before:>14.1f} {after:>12.1f} ({after / before:.1f}x)'
+        )
+
+
+if __name__ == '__main__':
+    main()
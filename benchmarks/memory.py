@@ -0,0 +1,54 @@
+"""Show that peak memory doesn't grow with the size of the export
+
+Each export is parsed in a fresh process, so that the peak resident set size
+reported by the OS belongs to that export alone.
+
+"""
+
+import resource
+import subprocess
+import sys
+import tempfile
+
+from pathlib import Path
+
+from benchmarks import corpus
+from wpsite import wp
+
+sizes = [1_000, 10_000, 100_000]
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is measured in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def measure(xml_file: Path) -> None:
+    with xml_file.open() as file:
+        for _ in wp.posts(file):
+            pass
+    print(peak_rss_mb())
+
+
+def main() -> None:
+    print(f'{"posts":>8} {"export MB":>10} {"peak RSS MB":>12}')
+    with tempfile.TemporaryDirectory() as tmp:
+        for num_posts in sizes:
+            xml_file = Path(tmp) / f'{num_posts}.xml'
+            with xml_file.open('w') as file:
+                corpus.write_export(file, num_posts)
+            output = subprocess.run(
+                [sys.executable, '-m', 'benchmarks.memory', str(xml_file)],
+                capture_output=True,
+                check=True,
+                text=True,
+            ).stdout
+            size_mb = xml_file.stat().st_size / 1024 / 1024
+            print(f'{num_posts:>8} {size_mb:>10.1f} {float(output):>12.1f}')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        measure(Path(sys.argv[1]))
+    else:
+        main()
@@ -0,0 +1,79 @@
+"""Measure how long it takes to render a post
+
+Each post is rendered the way `wpsite.convert_export()` does it, by writing
+its Markdown and listing its attachments. For comparison, we also render
+copies of each post whose filtered HTML is discarded between steps, which is
+how pages used to be rendered before the results were cached.
+
+"""
+
+import dataclasses
+import io
+import tempfile
+import time
+import typing
+
+from pathlib import Path
+
+import wpsite
+
+from benchmarks import corpus
+from wpsite import astro, page, wp
+
+num_posts = 500
+
+
+def load_posts() -> tuple[list[page.Page], typing.Mapping[str, str]]:
+    source = io.StringIO()
+    corpus.write_export(source, num_posts)
+    source.seek(0)
+    attachments, spool = wp.split_export(source)
+    with spool:
+        posts = wp.posts(
+            spool, wpsite.filters(attachments), wpsite.parsers(attachments)
+        )
+        return list(posts), attachments
+
+
+def render(
+    post_dir: astro.PostDirectory, attachments: typing.Mapping[str, str]
+) -> None:
+    post_dir.create_markdown()
+    post_dir.attachment_urls(attachments)
+
+
+def uncached(post: page.Page) -> page.Page:
+    class UncachedPage(page.Page):
+        def __getattribute__(self, name: str) -> typing.Any:
+            if name in page.Page.rendered:
+                self.__dict__.pop('filtered_html', None)
+            return super().__getattribute__(name)
+
+    fields = {f.name: getattr(post, f.name) for f in dataclasses.fields(post)}
+    return UncachedPage(**fields)
+
+
+def posts_per_second(
+    posts: list[page.Page],
+    attachments: typing.Mapping[str, str],
+    content_dir: Path,
+) -> float:
+    started = time.perf_counter()
+    for post in posts:
+        render(astro.PostDirectory(content_dir, post), attachments)
+    return len(posts) / (time.perf_counter() - started)
+
+
+def main() -> None:
+    posts, attachments = load_posts()
+    with tempfile.TemporaryDirectory() as tmp:
+        before = posts_per_second(
+            [uncached(p) for p in posts], attachments, Path(tmp)
+        )
+        after = posts_per_second(posts, attachments, Path(tmp))
+    print(f'uncached: {before:8.1f} posts/s')
+    print(f'cached:   {after:8.1f} posts/s ({after / before:.1f}x)')
+
+
+if __name__ == '__main__':
+    main()
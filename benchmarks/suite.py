@@ -0,0 +1,185 @@
+"""Measure the throughput and memory use of each stage of a conversion
+
+Each stage is run over every post in a synthetic export (see `corpus`):
+
+    - reading the export with `wp.split_export()`, which collects the
+      attachments and re-serializes the published posts into a spool
+    - parsing the spooled posts (a second time) with `wp.posts()`
+    - each of the filters returned by `wpsite.filters()`, applied in order
+      to the whole of each post, and then all of them at once, in the
+      single pass made by their `FilterEngine`
+    - converting the filtered HTML with `Page.markdown`
+    - writing files with `PostDirectory.create_markdown()`
+
+Each stage is run twice; once to time it, and again with tracemalloc
+running, to find the peak memory allocated during the stage.
+
+Results can be saved as a named baseline, and compared with a baseline that
+was saved earlier (e.g. before making a change):
+
+    python -m benchmarks.suite --save before
+    python -m benchmarks.suite --compare before
+
+Baselines are kept in benchmarks/baselines, which git ignores, as they're
+only meaningful on the machine that measured them.
+
+"""
+
+import argparse
+import dataclasses
+import io
+import json
+import tempfile
+import time
+import tracemalloc
+import typing
+
+from pathlib import Path
+
+import wpsite
+
+from benchmarks import corpus
+from wpsite import astro, page, wp
+
+baselines_dir = Path(__file__).parent / 'baselines'
+
+
+@dataclasses.dataclass
+class Result:
+    posts_per_second: float
+    peak_mb: float
+
+
+def measure(stage: typing.Callable[[], object], num_posts: int) -> Result:
+    started = time.perf_counter()
+    stage()
+    elapsed = time.perf_counter() - started
+    tracemalloc.start()
+    try:
+        stage()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return Result(num_posts / elapsed, peak / 1024 / 1024)
+
+
+def run(spec: corpus.Spec) -> dict[str, Result]:
+    export = io.StringIO()
+    corpus.write_spec(export, spec)
+    attachments, spool = wp.split_export(io.StringIO(export.getvalue()))
+    spool_bytes = spool.read()
+
+    def split() -> None:
+        wp.split_export(io.StringIO(export.getvalue()))[1].close()
+
+    results = {'wp.split_export': measure(split, spec.posts)}
+    [engine] = wpsite.filters(attachments)
+    assert isinstance(engine, page.FilterEngine)
+    posts: list[page.Page] = []
+
+    def parse() -> None:
+        posts[:] = wp.posts(
+            io.BytesIO(spool_bytes), [], wpsite.parsers(attachments)
+        )
+
+    results['wp.posts'] = measure(parse, spec.posts)
+
+    html = [post.content for post in posts]
+    for html_filter in engine.filters:
+        inputs = list(html)
+
+        def apply() -> None:
+            html[:] = [html_filter(text) for text in inputs]
+
+        results[page.filter_name(html_filter)] = measure(apply, spec.posts)
+
+    def fused() -> None:
+        for post in posts:
+            engine(post.content)
+
+    results['FilterEngine'] = measure(fused, spec.posts)
+
+    rendered = [dataclasses.replace(p, content=h) for p, h in zip(posts, html)]
+
+    def markdown() -> None:
+        for post in rendered:
+            post.__dict__.pop('markdown', None)
+            post.markdown
+
+    results['Page.markdown'] = measure(markdown, spec.posts)
+
+    with tempfile.TemporaryDirectory() as tmp:
+
+        def write() -> None:
+            for post in rendered:
+                astro.PostDirectory(Path(tmp), post).create_markdown()
+
+        results['PostDirectory.create_markdown'] = measure(write, spec.posts)
+
+    return results
+
+
+def report(
+    results: dict[str, Result], baseline: dict[str, Result] | None = None
+) -> str:
+    width = max(len(name) for name in results)
+    header = f'{"stage":<{width}} {"posts/s":>10} {"peak MB":>8}'
+    if baseline:
+        header += f' {"vs posts/s":>11} {"vs peak MB":>11}'
+    lines = [header]
+    for name, result in results.items():
+        line = (
+            f'{name:<{width}} {result.posts_per_second:>10.1f} '
+            f'{result.peak_mb:>8.1f}'
+        )
+        if baseline and name in baseline:
+            before = baseline[name]
+            speed = result.posts_per_second / before.posts_per_second - 1
+            memory = (
+                result.peak_mb / before.peak_mb - 1 if before.peak_mb else 0
+            )
+            line += f' {speed:>+11.0%} {memory:>+11.0%}'
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def load_baseline(name: str) -> dict[str, Result]:
+    data = json.loads((baselines_dir / f'{name}.json').read_text())
+    return {stage: Result(**result) for stage, result in data.items()}
+
+
+def save_baseline(name: str, results: dict[str, Result]) -> None:
+    baselines_dir.mkdir(exist_ok=True)
+    data = {stage: dataclasses.asdict(r) for stage, r in results.items()}
+    (baselines_dir / f'{name}.json').write_text(json.dumps(data, indent=2))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--posts', type=int, default=corpus.Spec.posts)
+    parser.add_argument(
+        '--images', type=int, default=corpus.Spec.images_per_post
+    )
+    parser.add_argument(
+        '--gallery-size', type=int, default=corpus.Spec.gallery_size
+    )
+    parser.add_argument('--save', metavar='NAME', help='save as a baseline')
+    parser.add_argument(
+        '--compare', metavar='NAME', help='compare with a saved baseline'
+    )
+    args = parser.parse_args()
+
+    spec = corpus.Spec(
+        posts=args.posts,
+        images_per_post=args.images,
+        gallery_size=args.gallery_size,
+    )
+    results = run(spec)
+    baseline = load_baseline(args.compare) if args.compare else None
+    print(report(results, baseline))
+    if args.save:
+        save_baseline(args.save, results)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,15 @@
-__all__ = ['astro', 'page', 'wp']
+__all__ = [
+    'astro',
+    'attachments',
+    'fetch',
+    'images',
+    'page',
+    'pipeline',
+    'profiling',
+    'wp',
+]
 
+import io
 import os
 import sys
 
@@ -7,7 +17,12 @@ project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 sys.path.insert(0, project_root)
 
 from wpsite import astro  # noqa: E402
+from wpsite import attachments  # noqa: E402
+from wpsite import fetch  # noqa: E402
+from wpsite import images  # noqa: E402
 from wpsite import page  # noqa: E402
+from wpsite import pipeline  # noqa: E402
+from wpsite import profiling  # noqa: E402
 from wpsite import wp  # noqa: E402
 
 
@@ -38,3 +53,16 @@ def rss_doc(xml: str) -> str:
   </channel>
 </rss>
 """
+
+
+class StubResponse(io.BytesIO):
+    """Stands in for http.client.HTTPResponse"""
+
+    status = 200
+
+    def __init__(self, body: bytes, headers: dict[str, str] = {}) -> None:
+        super().__init__(body)
+        self.headers = headers
+
+    def getheader(self, name: str, default: str | None = None) -> str | None:
+        return self.headers.get(name, default)
@@ -1,10 +1,17 @@
+import io
+import re
+import tarfile
+import zipfile
+
 from unittest import mock
 
 from pathlib import Path
 
 import pytest
 
+from .context import StubResponse
 from .context import astro
+from .context import fetch
 from .context import page
 
 
@@ -131,13 +138,13 @@ def test_inline_attachments_fetched(
     post_dir = astro.PostDirectory(content_dir, photo_post)
 
     photo_bytes = b'some pixels'
-    mock_urlopen.return_value.read.return_value = photo_bytes
+    mock_urlopen.return_value = StubResponse(photo_bytes)
     photo_filename = 'image.jpg'
     url = f'https://sitename.files.wordpress.com/{photo_filename}'
 
     post_dir.fetch_attachments({photo_attachment_id: url})
 
-    mock_urlopen.assert_called_with(url)
+    mock_urlopen.assert_called_with(url, timeout=fetch.default_timeout)
     assert (post_dir.path / photo_filename).read_bytes() == photo_bytes
 
 
@@ -149,17 +156,190 @@ def test_thumbnail_attachment_fetched(
     post_dir = astro.PostDirectory(content_dir, post)
 
     photo_bytes = b'some pixels'
-    mock_urlopen.return_value.read.return_value = photo_bytes
+    mock_urlopen.return_value = StubResponse(photo_bytes)
     photo_filename = 'image.jpg'
     url = f'https://sitename.files.wordpress.com/{photo_filename}'
     post.thumbnail = url
 
     post_dir.fetch_attachments({'123': url})
 
-    mock_urlopen.assert_called_with(url)
+    mock_urlopen.assert_called_with(url, timeout=fetch.default_timeout)
     assert (post_dir.path / photo_filename).read_bytes() == photo_bytes
 
 
+class TestSizedAttachments:
+    url = 'https://sitename.files.wordpress.com/image.jpg'
+
+    def urls(self, content: str, thumbnail: str = '') -> list[str]:
+        post = page.Page('Title', 'slug', '2023-10-24', content)
+        post.thumbnail = thumbnail
+        post_dir = astro.PostDirectory(Path('content'), post)
+        return post_dir.attachment_urls({'1': self.url}, sized=True)
+
+    def test_fetches_images_at_the_size_they_are_shown(self) -> None:
+        urls = self.urls('<img class="wp-image-1 size-large">')
+
+        assert urls == [f'{self.url}?w=1024']
+
+    def test_fetches_full_size_images_in_full(self) -> None:
+        urls = self.urls('<img class="wp-image-1 size-full">')
+
+        assert urls == [self.url]
+
+    def test_fetches_cover_images_in_full(self) -> None:
+        urls = self.urls('<img class="wp-image-1 size-large">', self.url)
+
+        assert urls == [self.url]
+
+    def test_only_resizes_images_on_hosts_that_resize(self) -> None:
+        self.url = 'https://example.com/wp-content/uploads/image.jpg'
+
+        urls = self.urls('<img class="wp-image-1 size-large">')
+
+        assert urls == [self.url]
+
+    def test_sized_images_are_saved_under_their_own_name(self) -> None:
+        post_dir = astro.PostDirectory(
+            Path('content'), page.Page('', 's', '', '')
+        )
+
+        assert post_dir.image_file(f'{self.url}?w=1024').name == 'image.jpg'
+
+
+@mock.patch.object(astro.urllib.request, 'urlopen', autospec=True)
+def test_failed_downloads_leave_no_file(
+    mock_urlopen: mock.MagicMock, tmp_path: Path, post: page.Page
+) -> None:
+    post_dir = astro.PostDirectory(tmp_path, post)
+    post_dir.create_post_dir()
+    response = StubResponse(b'some pixels')
+    mock_urlopen.return_value = response
+    url = 'https://sitename.files.wordpress.com/image.jpg'
+
+    with mock.patch.object(response, 'read', side_effect=TimeoutError):
+        with pytest.raises(TimeoutError):
+            post_dir.save_image(url)
+
+    assert list(post_dir.path.iterdir()) == []
+
+
+def test_skipped_downloads_are_not_journalled(
+    tmp_path: Path, post: page.Page
+) -> None:
+    post_dir = astro.PostDirectory(tmp_path, post)
+    post_dir.create_post_dir()
+    url = 'https://site/image.jpg'
+    post_dir.image_file(url).write_bytes(b'image')
+    downloader = mock.Mock(revalidates=False)
+
+    with astro.Journal(tmp_path) as journal:
+        post_dir.download_images([url], downloader, journal)
+
+        assert journal.path.read_text() == ''
+    downloader.download.assert_not_called()
+
+
+class TestWriter:
+    def test_creates_each_directory_once(self, tmp_path: Path) -> None:
+        writer = astro.Writer()
+
+        with mock.patch.object(Path, 'mkdir', autospec=True) as mkdir:
+            mkdir.side_effect = lambda path, **kwargs: None
+            writer.mkdir(tmp_path / 'post')
+            writer.mkdir(tmp_path / 'post')
+
+        mkdir.assert_called_once()
+
+    def test_skips_identical_content(self, tmp_path: Path) -> None:
+        writer = astro.Writer()
+        path = tmp_path / 'post' / 'index.md'
+
+        assert writer.write(path, b'text')
+        assert not writer.write(path, b'text')
+        assert writer.write(path, b'changed')
+        assert path.read_bytes() == b'changed'
+
+    def test_recreates_removed_directories(self, tmp_path: Path) -> None:
+        writer = astro.Writer()
+        writer.mkdir(tmp_path / 'post')
+        (tmp_path / 'post').rmdir()
+
+        writer.write(tmp_path / 'post' / 'index.md', b'text')
+
+        assert (tmp_path / 'post' / 'index.md').read_bytes() == b'text'
+
+
+class TestArchive:
+    @pytest.fixture
+    def content_dir(self, tmp_path: Path, post: page.Page) -> Path:
+        astro.PostDirectory(tmp_path, post).create_markdown()
+        (tmp_path / post.slug / 'image.jpg').write_bytes(b'image')
+        astro.Manifest(tmp_path).save()
+        return tmp_path
+
+    @pytest.mark.parametrize('format', ['tar', 'tar.gz', 'tar.xz'])
+    def test_writes_tar_archives(self, content_dir: Path, format: str) -> None:
+        file = io.BytesIO()
+
+        astro.write_archive(content_dir, file, format)
+
+        file.seek(0)
+        with tarfile.open(fileobj=file) as archive:
+            assert archive.getnames() == ['slug/image.jpg', 'slug/index.md']
+
+    def test_writes_zip_archives(self, content_dir: Path) -> None:
+        file = io.BytesIO()
+
+        astro.write_archive(content_dir, file, 'zip')
+
+        with zipfile.ZipFile(file) as archive:
+            assert archive.namelist() == ['slug/image.jpg', 'slug/index.md']
+            assert archive.read('slug/image.jpg') == b'image'
+
+    def test_format_is_chosen_by_suffix(self) -> None:
+        assert astro.archive_format(Path('site.tgz')) == 'tar.gz'
+        with pytest.raises(ValueError):
+            astro.archive_format(Path('site.rar'))
+
+
+class TestManifest:
+    def test_recognises_unchanged_posts(
+        self, tmp_path: Path, post: page.Page
+    ) -> None:
+        post_dir = astro.PostDirectory(tmp_path, post)
+        post_dir.create_markdown()
+        with astro.Manifest(tmp_path) as manifest:
+            manifest.record(post.slug, 'abc', ['https://site/image.jpg'])
+
+        manifest = astro.Manifest(tmp_path)
+
+        assert manifest.unchanged(post_dir, 'abc') == [
+            'https://site/image.jpg'
+        ]
+        assert manifest.unchanged(post_dir, 'def') is None
+
+    def test_rerenders_missing_markdown(
+        self, tmp_path: Path, post: page.Page
+    ) -> None:
+        post_dir = astro.PostDirectory(tmp_path, post)
+        with astro.Manifest(tmp_path) as manifest:
+            manifest.record(post.slug, 'abc', [])
+
+        manifest = astro.Manifest(tmp_path)
+
+        assert manifest.unchanged(post_dir, 'abc') is None
+
+    def test_can_be_reset(self, tmp_path: Path, post: page.Page) -> None:
+        post_dir = astro.PostDirectory(tmp_path, post)
+        post_dir.create_markdown()
+        with astro.Manifest(tmp_path) as manifest:
+            manifest.record(post.slug, 'abc', [])
+
+        manifest = astro.Manifest(tmp_path, reset=True)
+
+        assert manifest.unchanged(post_dir, 'abc') is None
+
+
 class TestHostedImageFilter:
     def test_replaces_wordpress_url_with_relative_path(self) -> None:
         image_id = '1234'
@@ -193,3 +373,47 @@ class TestHostedImageFilter:
         text = astro.HostedImageFilter(urls)(content)
 
         assert text == f'<img class="wp-image-{image_id}" src="./{basename}">'
+
+    def test_replaces_every_attached_image(self) -> None:
+        urls = {
+            str(i): f'https://sitename.files.wordpress.com/{i}.jpg'
+            for i in range(3)
+        }
+        content = ''.join(
+            f'<img class="wp-image-{i}" src="{url}?w=640">'
+            for i, url in urls.items()
+        )
+
+        text = astro.HostedImageFilter(urls)(content)
+
+        assert 'wordpress.com' not in text
+        assert [f'./{i}.jpg' for i in urls] == re.findall(r'\./\d\.jpg', text)
+
+    def test_matches_urls_literally(self) -> None:
+        image_id = '1234'
+        url = 'https://sitename.files.wordpress.com/image+1.jpg'
+        lookalike = 'https://sitename.files.wordpress.com/image+1Xjpg'
+        content = (
+            f'<img class="wp-image-{image_id}" src="{url}">'
+            f'<img src="{lookalike}">'
+        )
+
+        text = astro.HostedImageFilter({image_id: url})(content)
+
+        assert 'src="./image+1.jpg"' in text
+        assert f'src="{lookalike}"' in text
+
+    def test_prefers_the_longest_matching_url(self) -> None:
+        urls = {
+            '1': 'https://sitename.files.wordpress.com/image.jpg',
+            '2': 'https://sitename.files.wordpress.com/image.jpg.webp',
+        }
+        content = ''.join(
+            f'<img class="wp-image-{i}" src="{url}">'
+            for i, url in urls.items()
+        )
+
+        text = astro.HostedImageFilter(urls)(content)
+
+        assert 'src="./image.jpg"' in text
+        assert 'src="./image.jpg.webp"' in text
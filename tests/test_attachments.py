@@ -0,0 +1,74 @@
+import pickle
+
+from pathlib import Path
+
+import pytest
+
+from .context import attachments
+
+urls = {
+    '12': 'https://sitename.files.wordpress.com/2023/10/first.jpg',
+    '3': 'https://sitename.files.wordpress.com/2023/10/second.jpg',
+    '7': 'http://elsewhere.example/photo.png',
+}
+
+
+class TestAttachmentIndex:
+    def test_maps_ids_to_urls(self) -> None:
+        index = attachments.AttachmentIndex.from_dict(urls)
+
+        assert index == urls
+
+    def test_raises_key_error_for_unknown_ids(self) -> None:
+        index = attachments.AttachmentIndex.from_dict(urls)
+
+        for attachment_id in ['4', '100', 'not-a-number']:
+            with pytest.raises(KeyError):
+                index[attachment_id]
+
+    def test_stores_shared_prefixes_once(self) -> None:
+        index = attachments.AttachmentIndex.from_dict(urls)
+
+        # Sorted by ID, so the URLs on the same host are first and last
+        assert index.prefixes[0] == index.prefixes[2]
+        assert len(index.offsets) - 1 == len(urls) + 2
+
+    def test_keeps_last_url_for_repeated_id(self) -> None:
+        builder = attachments.Builder()
+        builder.add('1', 'https://site/old.jpg')
+        builder.add('1', 'https://site/new.jpg')
+
+        assert builder.build() == {'1': 'https://site/new.jpg'}
+
+    def test_can_be_opened_from_a_file(self, tmp_path: Path) -> None:
+        path = tmp_path / 'attachments'
+        attachments.AttachmentIndex.from_dict(urls).save(path)
+
+        index = attachments.AttachmentIndex.open(path)
+
+        unpickled = pickle.loads(pickle.dumps(index))
+
+        assert index == urls
+        assert unpickled == urls
+        assert unpickled.path == path
+
+    def test_saving_leaves_no_temporary_files(self, tmp_path: Path) -> None:
+        path = tmp_path / 'attachments'
+        for _ in range(2):
+            attachments.AttachmentIndex.from_dict(urls).save(path)
+
+        assert list(tmp_path.iterdir()) == [path]
+
+    def test_records_digest_of_attachments(self) -> None:
+        noted = attachments.Builder()
+        for attachment_id, url in urls.items():
+            noted.note(attachment_id, url)
+        changed = dict(urls, **{'7': 'http://elsewhere.example/other.png'})
+
+        index = attachments.AttachmentIndex.from_dict(urls)
+
+        assert index.digest == noted.build().digest
+        assert (
+            index.digest
+            != attachments.AttachmentIndex.from_dict(changed).digest
+        )
@@ -0,0 +1,459 @@
+import email.utils
+import http.server
+import threading
+import time
+import typing
+
+from pathlib import Path
+
+import pytest
+
+from .context import StubResponse
+from .context import fetch
+from .context import profiling
+
+
+Reply = tuple[int, dict[str, str], bytes]
+
+
+class StandInServer(http.server.ThreadingHTTPServer):
+    """A local HTTP server that plays back canned replies
+
+    Each path has a list of replies. They're sent in order, and the last one
+    is repeated once the others have been used up.
+
+    If `capacity` is set, requests beyond that many at once are throttled
+    (with a 429, asking the client to retry after `retry_after` seconds).
+
+    """
+
+    daemon_threads = True
+
+    def __init__(self) -> None:
+        super().__init__(('127.0.0.1', 0), StandInHandler)
+        self.replies: dict[str, list[Reply]] = {}
+        self.delay = 0.0
+        self.requests: list[tuple[str, tuple[str, int]]] = []
+        self.times: list[float] = []
+        self.capacity: int | None = None
+        self.retry_after = '0'
+        self.active = 0
+        self.throttled = 0
+        self.lock = threading.Lock()
+
+    def url(self, path: str) -> str:
+        host, port = self.server_address[:2]
+        return f'http://{host!s}:{port}{path}'
+
+    def reply(
+        self,
+        path: str,
+        status: int = 200,
+        body: bytes = b'',
+        headers: dict[str, str] = {},
+    ) -> None:
+        self.replies.setdefault(path, []).append((status, headers, body))
+
+    def admit(self) -> bool:
+        with self.lock:
+            if self.capacity is not None and self.active >= self.capacity:
+                self.throttled += 1
+                return False
+            self.active += 1
+            return True
+
+    def leave(self) -> None:
+        with self.lock:
+            self.active -= 1
+
+    def next_reply(self, path: str) -> Reply:
+        replies = self.replies.get(path, [(404, {}, b'')])
+        return replies.pop(0) if len(replies) > 1 else replies[0]
+
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server: StandInServer
+
+    def do_GET(self) -> None:
+        self.server.requests.append((self.path, self.client_address))
+        self.server.times.append(time.monotonic())
+        if not self.server.admit():
+            self.respond(429, {'Retry-After': self.server.retry_after}, b'')
+            return
+        try:
+            time.sleep(self.server.delay)
+            status, headers, body = self.server.next_reply(self.path)
+        finally:
+            self.server.leave()
+        self.respond(status, headers, body)
+
+    def respond(
+        self, status: int, headers: dict[str, str], body: bytes
+    ) -> None:
+        etag = headers.get('ETag')
+        if etag and self.headers.get('If-None-Match') == etag:
+            status, body = 304, b''
+        headers = {'Content-Length': str(len(body)), **headers}
+        if int(headers['Content-Length']) != len(body):
+            self.close_connection = True
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: typing.Any) -> None:
+        pass
+
+
+@pytest.fixture
+def server() -> typing.Generator[StandInServer, None, None]:
+    server = StandInServer()
+    thread = threading.Thread(
+        target=server.serve_forever, args=(0.01,), daemon=True
+    )
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def download(url: str, path: Path, **kwargs: typing.Any) -> fetch.Summary:
+    options = {'backoff': 0, **kwargs}
+    with fetch.Downloader(**options) as downloader:
+        downloader.submit(url, path)
+    return downloader.summary
+
+
+class TestDownloader:
+    def test_saves_file(self, server: StandInServer, tmp_path: Path) -> None:
+        server.reply('/image.jpg', body=b'pixels')
+        path = tmp_path / 'image.jpg'
+
+        summary = download(server.url('/image.jpg'), path)
+
+        assert path.read_bytes() == b'pixels'
+        assert (summary.files, summary.bytes) == (1, len(b'pixels'))
+
+    def test_reuses_connections(
+        self, server: StandInServer, tmp_path: Path
+    ) -> None:
+        server.reply('/image.jpg', body=b'pixels')
+
+        with fetch.Downloader(workers=1) as downloader:
+            for i in range(3):
+                downloader.submit(server.url('/image.jpg'), tmp_path / str(i))
+
+        clients = {client for _, client in server.requests}
+        assert len(server.requests) == 3
+        assert len(clients) == 1
+
+    def test_follows_redirects(
+        self, server: StandInServer, tmp_path: Path
+    ) -> None:
+        server.reply('/old.jpg', 301, headers={'Location': '/new.jpg'})
+        server.reply('/new.jpg', body=b'pixels')
+        path = tmp_path / 'image.jpg'
+
+        download(server.url('/old.jpg'), path)
+
+        assert path.read_bytes() == b'pixels'
+
+    def test_retries_server_errors(
+        self, server: StandInServer, tmp_path: Path
+    ) -> None:
+        server.reply('/image.jpg', 503)
+        server.reply('/image.jpg', body=b'pixels')
+        path = tmp_path / 'image.jpg'
+
+        summary = download(server.url('/image.jpg'), path)
+
+        assert path.read_bytes() == b'pixels'
+        assert summary.failures == 0
+
+    def test_gives_up_on_missing_files(
+        self, server: StandInServer, tmp_path: Path
+    ) -> None:
+        path = tmp_path / 'image.jpg'
+
+        summary = download(server.url('/image.jpg'), path)
+
+        assert len(server.requests) == 1
+        assert summary.failures == 1
+        assert not path.exists()
+
+    def test_times_out_stalled_requests(
+        self, server: StandInServer, tmp_path: Path
+    ) -> None:
+        server.reply('/image.jpg', body=b'pixels')
+        server.delay = 0.5
+
+        summary = download(
+            server.url('/image.jpg'), tmp_path / 'x', timeout=0.1, retries=1
+        )
+
+        assert len(server.requests) == 2
+        assert summary.failures == 1
+
+    def test_discards_interrupted_downloads(
+        self, server: StandInServer, tmp_path: Path
+    ) -> None:
+        headers = {'Content-Length': '1000'}
+        server.reply('/image.jpg', body=b'pixels', headers=headers)
+
+        summary = download(server.url('/image.jpg'), tmp_path / 'image.jpg')
+
+        assert summary.failures == 1
+        assert list(tmp_path.iterdir()) == []
+
+    def test_retries_truncated_downloads(
+        self, server: StandInServer, tmp_path: Path
+    ) -> None:
+        headers = {'Content-Length': '1000'}
+        server.reply('/image.jpg', body=b'pixels', headers=headers)
+        server.reply('/image.jpg', body=b'pixels')
+        path = tmp_path / 'image.jpg'
+
+        summary = download(server.url('/image.jpg'), path)
+
+        assert len(server.requests) == 2
+        assert summary.failures == 0
+        assert path.read_bytes() == b'pixels'
+
+    def test_profiles_failed_downloads(
+        self, server: StandInServer, tmp_path: Path
+    ) -> None:
+        profiler = profiling.Profiler()
+
+        download(server.url('/image.jpg'), tmp_path / 'x', profiler=profiler)
+
+        assert profiler.stages['download (failed)'].calls == 1
+        assert 'download' not in profiler.stages
+
+    def test_times_downloads_from_the_first_one(
+        self, server: StandInServer, tmp_path: Path
+    ) -> None:
+        server.reply('/image.jpg', body=b'pixels')
+
+        with fetch.Downloader() as downloader:
+            time.sleep(0.2)
+            downloader.submit(server.url('/image.jpg'), tmp_path / 'x')
+
+        assert 0 < downloader.summary.seconds < 0.2
+
+
+class TestThrottling:
+    def test_backs_off_when_throttled(
+        self, server: StandInServer, tmp_path: Path
+    ) -> None:
+        server.reply('/image.jpg', body=b'pixels')
+        server.capacity = 2
+        server.delay = 0.01
+
+        with fetch.Downloader(workers=8, backoff=0) as downloader:
+            for i in range(40):
+                downloader.submit(server.url('/image.jpg'), tmp_path / str(i))
+
+        assert downloader.summary.files == 40
+        assert downloader.summary.failures == 0
+        assert server.throttled < 20
+
+    def test_honours_retry_after(
+        self, server: StandInServer, tmp_path: Path
+    ) -> None:
+        server.reply('/image.jpg', 429, headers={'Retry-After': '1'})
+        server.reply('/image.jpg', body=b'pixels')
+        path = tmp_path / 'image.jpg'
+
+        summary = download(server.url('/image.jpg'), path, backoff=10)
+
+        assert path.read_bytes() == b'pixels'
+        assert summary.failures == 0
+        assert 1 <= server.times[1] - server.times[0] < 5
+
+    def test_limits_request_rate(
+        self, server: StandInServer, tmp_path: Path
+    ) -> None:
+        server.reply('/image.jpg', body=b'pixels')
+
+        with fetch.Downloader(workers=4, rate=20) as downloader:
+            for i in range(6):
+                downloader.submit(server.url('/image.jpg'), tmp_path / str(i))
+
+        assert server.times[-1] - server.times[0] >= 0.2
+
+
+class TestHostLimiter:
+    def test_increases_limit_additively(self) -> None:
+        limiter = fetch.HostLimiter(maximum=4)
+
+        for _ in range(4):
+            limiter.succeeded('example.com')
+
+        assert limiter.hosts['example.com'].limit == pytest.approx(3.5, 0.1)
+
+    def test_halves_limit_once_per_round_of_requests(self) -> None:
+        limiter = fetch.HostLimiter(maximum=8, initial=8)
+        sent = time.monotonic()
+
+        limiter.throttled('example.com', sent)
+        limiter.throttled('example.com', sent)
+
+        assert limiter.hosts['example.com'].limit == 4
+
+    def test_limits_each_host_separately(self) -> None:
+        limiter = fetch.HostLimiter(maximum=1)
+        limiter.acquire('example.com')
+
+        started = time.monotonic()
+        limiter.acquire('example.org')
+
+        assert time.monotonic() - started < 0.1
+        assert limiter.hosts['example.com'].active == 1
+
+    def test_pauses_host_until_retry_after(self) -> None:
+        limiter = fetch.HostLimiter(maximum=1)
+
+        limiter.throttled('example.com', time.monotonic(), retry_after=0.2)
+        started = time.monotonic()
+        limiter.acquire('example.com')
+
+        assert time.monotonic() - started >= 0.2
+
+
+class TestRetryAfter:
+    def test_parses_seconds(self) -> None:
+        assert fetch.retry_after('120') == 120
+
+    def test_parses_dates(self) -> None:
+        later = email.utils.formatdate(time.time() + 60, usegmt=True)
+
+        assert fetch.retry_after(later) == pytest.approx(60, abs=2)
+
+    def test_ignores_nonsense(self) -> None:
+        assert fetch.retry_after('soon') is None
+        assert fetch.retry_after(None) is None
+
+
+class TestCache:
+    def download(
+        self, cache_dir: Path, downloads: list[tuple[str, Path]]
+    ) -> fetch.Summary:
+        cache = fetch.Cache(cache_dir)
+        with fetch.Downloader(cache=cache, backoff=0) as downloader:
+            for url, path in downloads:
+                downloader.submit(url, path)
+        return downloader.summary
+
+    def test_downloads_each_url_once(
+        self, server: StandInServer, tmp_path: Path
+    ) -> None:
+        server.reply('/image.jpg', body=b'pixels')
+        url = server.url('/image.jpg')
+        paths = [tmp_path / 'a.jpg', tmp_path / 'b.jpg']
+
+        summary = self.download(tmp_path / 'cache', [(url, p) for p in paths])
+
+        assert len(server.requests) == 1
+        assert [p.read_bytes() for p in paths] == [b'pixels', b'pixels']
+        assert summary.cached == 1
+
+    def test_stores_identical_files_once(
+        self, server: StandInServer, tmp_path: Path
+    ) -> None:
+        server.reply('/a.jpg', body=b'pixels')
+        server.reply('/b.jpg', body=b'pixels')
+        cache_dir = tmp_path / 'cache'
+
+        self.download(
+            cache_dir,
+            [
+                (server.url('/a.jpg'), tmp_path / 'a.jpg'),
+                (server.url('/b.jpg'), tmp_path / 'b.jpg'),
+            ],
+        )
+
+        objects = [
+            p for p in (cache_dir / 'objects').rglob('*') if p.is_file()
+        ]
+        assert len(objects) == 1
+
+    def test_revalidates_with_etag(
+        self, server: StandInServer, tmp_path: Path
+    ) -> None:
+        server.reply('/image.jpg', body=b'pixels', headers={'ETag': '"v1"'})
+        url = server.url('/image.jpg')
+        cache_dir = tmp_path / 'cache'
+        self.download(cache_dir, [(url, tmp_path / 'first.jpg')])
+
+        path = tmp_path / 'second.jpg'
+        summary = self.download(cache_dir, [(url, path)])
+
+        assert len(server.requests) == 2
+        assert (summary.bytes, summary.cached) == (0, 1)
+        assert path.read_bytes() == b'pixels'
+
+    def test_fetches_changed_files(
+        self, server: StandInServer, tmp_path: Path
+    ) -> None:
+        server.reply('/image.jpg', body=b'pixels', headers={'ETag': '"v1"'})
+        server.reply('/image.jpg', body=b'changed', headers={'ETag': '"v2"'})
+        url = server.url('/image.jpg')
+        path = tmp_path / 'image.jpg'
+        cache_dir = tmp_path / 'cache'
+        self.download(cache_dir, [(url, path)])
+
+        self.download(cache_dir, [(url, path)])
+
+        assert path.read_bytes() == b'changed'
+
+    def test_runs_sharing_a_cache_keep_each_others_entries(
+        self, server: StandInServer, tmp_path: Path
+    ) -> None:
+        server.reply('/a.jpg', body=b'a')
+        server.reply('/b.jpg', body=b'b')
+        cache_dir = tmp_path / 'cache'
+        first, second = fetch.Cache(cache_dir), fetch.Cache(cache_dir)
+
+        for cache, name in [(first, 'a.jpg'), (second, 'b.jpg')]:
+            with fetch.Downloader(cache=cache) as downloader:
+                downloader.submit(server.url(f'/{name}'), tmp_path / name)
+
+        index = fetch.Cache(cache_dir).index
+        assert sorted(index) == [server.url('/a.jpg'), server.url('/b.jpg')]
+        assert list(cache_dir.glob('*.part')) == []
+
+
+class TestSaveResponse:
+    def test_streams_body_to_file(self, tmp_path: Path) -> None:
+        path = tmp_path / 'image.jpg'
+        body = b'x' * (fetch.chunk_size * 2 + 1)
+
+        size = fetch.save_response(StubResponse(body), path)
+
+        assert size == len(body)
+        assert path.read_bytes() == body
+
+    def test_verifies_content_length(self, tmp_path: Path) -> None:
+        response = StubResponse(b'pixels', {'Content-Length': '1000'})
+
+        with pytest.raises(fetch.IncompleteDownload):
+            fetch.save_response(response, tmp_path / 'image.jpg')
+
+        assert list(tmp_path.iterdir()) == []
+
+    def test_length_verification_is_optional(self, tmp_path: Path) -> None:
+        response = StubResponse(b'pixels', {'Content-Length': '1000'})
+        path = tmp_path / 'image.jpg'
+
+        fetch.save_response(response, path, verify_length=False)
+
+        assert path.read_bytes() == b'pixels'
+
+
+class TestSummary:
+    def test_reports_throughput(self) -> None:
+        summary = fetch.Summary(files=2, bytes=3 * 1024 * 1024, seconds=2)
+
+        assert '2 files (3.0 MB) in 2.0s (1.50 MB/s)' in str(summary)
@@ -0,0 +1,153 @@
+import io
+import os
+
+from pathlib import Path
+from unittest import mock
+
+import pytest
+
+from .context import images
+
+pytest.importorskip('PIL')
+
+from PIL import Image  # noqa: E402
+
+
+def jpeg(width: int, height: int, orientation: int | None = None) -> bytes:
+    image = Image.new('RGB', (width, height), 'teal')
+    exif = Image.Exif()
+    if orientation is not None:
+        exif[0x0112] = orientation
+    output = io.BytesIO()
+    image.save(output, 'JPEG', exif=exif)
+    return output.getvalue()
+
+
+def opened(path: Path) -> Image.Image:
+    return Image.open(io.BytesIO(path.read_bytes()))
+
+
+class TestOptimize:
+    def test_scales_down_large_images(self, tmp_path: Path) -> None:
+        path = tmp_path / 'photo.jpg'
+        path.write_bytes(jpeg(400, 100))
+
+        images.optimize(path, images.Settings(max_dimension=200))
+
+        assert opened(path).size == (200, 50)
+
+    def test_strips_metadata(self, tmp_path: Path) -> None:
+        path = tmp_path / 'photo.jpg'
+        path.write_bytes(jpeg(40, 20, orientation=1))
+
+        images.optimize(path, images.Settings())
+
+        assert 'exif' not in opened(path).info
+
+    def test_applies_orientation_before_stripping_it(
+        self, tmp_path: Path
+    ) -> None:
+        path = tmp_path / 'photo.jpg'
+        path.write_bytes(jpeg(40, 20, orientation=6))
+
+        images.optimize(path, images.Settings())
+
+        assert opened(path).size == (20, 40)
+
+    def test_leaves_optimal_images_alone(self, tmp_path: Path) -> None:
+        path = tmp_path / 'photo.png'
+        Image.new('RGB', (40, 20)).save(path)
+        original = path.read_bytes()
+
+        saved = images.optimize(path, images.Settings())
+
+        assert saved == 0
+        assert path.read_bytes() == original
+
+    def test_ignores_files_that_arent_images(self, tmp_path: Path) -> None:
+        path = tmp_path / 'drawing.svg'
+        path.write_bytes(b'<svg/>')
+
+        images.optimize(path, images.Settings(formats=('webp',)))
+
+        assert path.read_bytes() == b'<svg/>'
+        assert list(tmp_path.iterdir()) == [path]
+
+    def test_saves_other_formats_next_to_the_original(
+        self, tmp_path: Path
+    ) -> None:
+        path = tmp_path / 'photo.png'
+        Image.new('P', (40, 20)).save(path)
+
+        images.optimize(path, images.Settings(formats=('webp',)))
+
+        assert opened(tmp_path / 'photo.png.webp').format == 'WEBP'
+        assert opened(path).format == 'PNG'
+
+    def test_keeps_variants_of_images_with_the_same_stem(
+        self, tmp_path: Path
+    ) -> None:
+        settings = images.Settings(formats=('webp',))
+        jpg, png = tmp_path / 'photo.jpg', tmp_path / 'photo.png'
+        jpg.write_bytes(jpeg(40, 20))
+        Image.new('P', (20, 40)).save(png)
+
+        images.optimize(jpg, settings)
+        images.optimize(png, settings)
+
+        assert opened(tmp_path / 'photo.jpg.webp').size == (40, 20)
+        assert opened(tmp_path / 'photo.png.webp').size == (20, 40)
+
+    def test_reuses_cached_results(self, tmp_path: Path) -> None:
+        settings = images.Settings(max_dimension=200, formats=('webp',))
+        first, second = tmp_path / 'first.jpg', tmp_path / 'second.jpg'
+        first.write_bytes(jpeg(400, 100))
+        second.write_bytes(jpeg(400, 100))
+        cache_dir = tmp_path / 'cache'
+
+        images.optimize(first, settings, cache_dir)
+        with mock.patch.object(images, 'process') as process:
+            images.optimize(second, settings, cache_dir)
+
+        process.assert_not_called()
+        assert second.read_bytes() == first.read_bytes()
+        assert opened(tmp_path / 'second.jpg.webp').format == 'WEBP'
+
+    def test_doesnt_modify_linked_downloads(self, tmp_path: Path) -> None:
+        cached = tmp_path / 'cached'
+        cached.write_bytes(jpeg(400, 100))
+        original = cached.read_bytes()
+        path = tmp_path / 'photo.jpg'
+        os.link(cached, path)
+
+        images.optimize(path, images.Settings(max_dimension=200))
+
+        assert cached.read_bytes() == original
+        assert opened(path).size == (200, 50)
+
+
+class TestOptimizer:
+    def test_optimizes_images_in_other_processes(self, tmp_path: Path) -> None:
+        paths = [tmp_path / f'{i}.jpg' for i in range(3)]
+        for path in paths:
+            path.write_bytes(jpeg(400, 100))
+
+        settings = images.Settings(max_dimension=200)
+        with images.Optimizer(settings, processes=2) as optimizer:
+            optimizer.optimize(paths)
+
+        assert [opened(path).size for path in paths] == [(200, 50)] * 3
+        assert optimizer.images == 3
+        assert optimizer.saved > 0
+
+    def test_logs_failures(
+        self, tmp_path: Path, caplog: pytest.LogCaptureFixture
+    ) -> None:
+        path = tmp_path / 'photo.jpg'
+        path.write_bytes(jpeg(400, 100)[:200])
+
+        with images.Optimizer(images.Settings()) as optimizer:
+            optimizer.optimize([path])
+
+        assert "Couldn't optimize" in caplog.text
+        assert optimizer.images == 0
@@ -1,5 +1,12 @@
+import dataclasses
+import pickle
+import re
 import unittest.mock
 
+import bs4  # type: ignore
+import markdownify  # type: ignore
+import pytest
+
 from .context import page
 
 
@@ -18,6 +25,41 @@ class TestAttachmentParser:
 
         callback.assert_called_with(image_id)
 
+    def widths(self, content: str) -> dict[str, int | None]:
+        parser = page.AttachmentParser(lambda attachment_id: None)
+        parser.feed(content)
+        parser.close()
+        return parser.widths
+
+    def test_records_widths_of_images(self) -> None:
+        content = '<img class="wp-image-1 size-large" width="640">'
+
+        assert self.widths(content) == {'1': 640}
+
+    def test_records_widths_of_standard_sizes(self) -> None:
+        content = """
+<figure class="wp-block-image size-large"><img class="wp-image-1"></figure>
+<img class="wp-image-2 size-medium">
+"""
+
+        assert self.widths(content) == {'1': 1024, '2': 300}
+
+    def test_full_size_images_have_no_width(self) -> None:
+        content = """
+<img class="wp-image-1 size-full" width="4160">
+<img class="wp-image-2">
+"""
+
+        assert self.widths(content) == {'1': None, '2': None}
+
+    def test_records_largest_width_of_each_image(self) -> None:
+        content = """
+<img class="wp-image-1 size-medium"><img class="wp-image-1 size-large">
+<img class="wp-image-2 size-medium"><img class="wp-image-2 size-full">
+"""
+
+        assert self.widths(content) == {'1': 1024, '2': None}
+
 
 class TestPage:
     def test_converts_html_content_to_markdown(self) -> None:
@@ -52,3 +94,172 @@ class TestPage:
         post = page.Page('Title', 'slug', '2023-10-30', content)
 
         assert post.attachment_ids == set([image_id])
+
+    def test_filters_are_only_applied_once(self) -> None:
+        image = '<img class="wp-image-1234" src="image.jpg">'
+        html_filter = unittest.mock.Mock(return_value=image)
+
+        post = page.Page(
+            'Title', 'slug', '2023-10-30', '', filters=[html_filter]
+        )
+        post.markdown
+        post.attachment_ids
+
+        html_filter.assert_called_once()
+
+    def test_converts_with_its_converter(self) -> None:
+        post = page.Page('Title', 'slug', '2023-10-30', '<p>Text</p>')
+        post.markdown
+
+        post.converter = str.upper
+
+        assert post.markdown == '<P>TEXT</P>'
+
+    def test_loads_deferred_content_when_rendered(self) -> None:
+        load = unittest.mock.Mock(return_value='<p>Text</p>')
+
+        post = page.DeferredPage(load, title='Title', slug='slug', pubDate='')
+        post.slug
+        load.assert_not_called()
+        post.markdown
+        post.content
+
+        load.assert_called_once()
+        assert post.markdown == 'Text'
+
+    def test_deferred_pages_can_be_copied(self) -> None:
+        load = unittest.mock.Mock(return_value='<p>Text</p>')
+        post = page.DeferredPage(load, title='Title', slug='slug', pubDate='')
+
+        copy = dataclasses.replace(post, filters=[])
+
+        load.assert_called_once()
+        assert copy.content == '<p>Text</p>'
+        assert pickle.loads(pickle.dumps(copy)).content == '<p>Text</p>'
+
+    def test_rerenders_when_content_changes(self) -> None:
+        post = page.Page('Title', 'slug', '2023-10-30', '<p>Before</p>')
+        post.markdown
+
+        post.content = '<p>After</p>'
+
+        assert 'After' in post.markdown
+
+
+markdownify_examples = [
+    '<p>A paragraph</p>',
+    '<!-- wp:paragraph -->\n<p>Some  text\n split </p>\n<!-- /wp:paragraph -->',
+    '<p>a</p>\n<!-- /wp:paragraph -->\n\n<!-- wp:paragraph -->\n<p>b</p>',
+    '<h2 class="wp-block-heading"> A  heading\n</h2><p>Text</p>',
+    '<p></p><h3></h3><p>\xa0Non-breaking\xa0</p>',
+    ' <!-- a --> <!-- b -->\xa0<p>\r\nText\r\n</p> ',
+    '<p>Emphasis with *asterisks* and _underscores_</p>',
+    '<p>Fish &amp; chips</p>',
+    '<p />Not a paragraph</p>',
+    '<!-- not closed --!> <p>Text</p> <!-- closed -->',
+    '<p>An <em>inline</em> tag</p>',
+    '<img src="image.jpg" alt="Alt text">Text after an image',
+]
+
+
+class TestMarkdownify:
+    @pytest.mark.parametrize('html', markdownify_examples)
+    def test_matches_markdownify(self, html: str) -> None:
+        expected = markdownify.markdownify(html, heading_style=markdownify.ATX)
+
+        assert page.Markdownify('html.parser')(html) == expected
+
+    @pytest.mark.parametrize(
+        'parser, html, expected',
+        [
+            ('html.parser', 'a<br>b<br/>c', 'a  \nb  '),
+            ('lxml', 'a<br>b<br/>c', 'a  \nb  \nc'),
+            ('html.parser', '<!-- x --!> <p>Text</p>', '<!-- x --!>\n\nText'),
+            ('lxml', '<!-- x --!> <p>Text</p>', 'Text'),
+        ],
+    )
+    def test_output_depends_on_parser(
+        self, parser: str, html: str, expected: str
+    ) -> None:
+        if parser == 'lxml':
+            pytest.importorskip('lxml.etree')
+
+        assert page.Markdownify(parser)(html) == expected
+
+    def test_converts_plain_posts_without_parsing_html(self) -> None:
+        converter = page.Markdownify()
+        html = '<h2>Heading</h2>\n\n<p>Paragraph</p>'
+
+        with unittest.mock.patch.object(converter, 'converter') as parser:
+            markdown = converter(html)
+
+        parser.convert_soup.assert_not_called()
+        assert markdown == '## Heading\n\nParagraph'
+
+    def test_parses_html_with_configured_parser(self) -> None:
+        converter = page.Markdownify('configured')
+        html = '<p><b>Bold</b></p>'
+        soup_class = bs4.BeautifulSoup
+
+        def parse(markup: str, features: str) -> bs4.BeautifulSoup:
+            return soup_class(markup, 'html.parser')
+
+        with unittest.mock.patch.object(
+            page.bs4, 'BeautifulSoup', side_effect=parse
+        ) as soup:
+            markdown = converter(html)
+
+        soup.assert_called_once_with(html, 'configured')
+        assert markdown == '**Bold**'
+
+    def test_can_be_pickled(self) -> None:
+        converter = pickle.loads(pickle.dumps(page.Markdownify('html.parser')))
+
+        assert converter('<p><b>Bold</b></p>') == '**Bold**'
+
+
+class Shout(page.ChunkFilter):
+    triggers = re.compile(r'!')
+
+    def __call__(self, text: str) -> str:
+        return text.replace('!', '!!')
+
+
+class Whisper(page.ChunkFilter):
+    triggers = re.compile(r'!!')
+
+    def __call__(self, text: str) -> str:
+        return text.replace('!!', '.')
+
+
+class TestFilterEngine:
+    def test_only_filters_chunks_that_trigger_a_filter(self) -> None:
+        shout = Shout()
+        text = 'Calm.\n\nLoud!\n\nCalm again.'
+
+        with unittest.mock.patch.object(shout, 'apply') as apply:
+            apply.side_effect = lambda chunk: chunk.upper()
+            output = page.FilterEngine([shout])(text)
+
+        apply.assert_called_once_with('Loud!')
+        assert output == 'Calm.\n\nLOUD!\n\nCalm again.'
+
+    def test_later_filters_see_output_of_earlier_ones(self) -> None:
+        engine = page.FilterEngine([Shout(), Whisper()])
+
+        assert engine('One!\n\nTwo') == 'One.\n\nTwo'
+
+    def test_applies_other_filters_to_whole_text(self) -> None:
+        engine = page.FilterEngine([Shout(), str.title, Whisper()])
+
+        assert engine('one!\n\ntwo') == 'One.\n\nTwo'
+
+    def test_matches_filters_applied_in_turn(self) -> None:
+        html_filters = [Shout(), Whisper(), Shout()]
+        text = '\n\nA!\n\n\nB\n\n\n\nC!!\nD!\n'
+
+        expected = text
+        for html_filter in html_filters:
+            expected = html_filter(expected)
+
+        assert page.FilterEngine(html_filters)(text) == expected
@@ -0,0 +1,67 @@
+import threading
+import time
+import typing
+
+import pytest
+
+from .context import pipeline
+from .context import profiling
+
+
+class TestPipeline:
+    def test_passes_items_through_each_stage(self) -> None:
+        results: list[int] = []
+
+        stages = pipeline.Pipeline(range(10))
+        stages.add('double', lambda n: n * 2, workers=3)
+        stages.add('odd', lambda n: n + 1 if n % 4 else None)
+        stages.add('collect', results.append, workers=2)
+        stages.run()
+
+        assert sorted(results) == [3, 7, 11, 15, 19]
+
+    def test_bounds_the_items_waiting_for_slow_stages(self) -> None:
+        read = 0
+        in_flight: list[int] = []
+
+        def source() -> typing.Iterator[int]:
+            nonlocal read
+            for n in range(50):
+                read += 1
+                yield n
+
+        def slow(n: int) -> None:
+            in_flight.append(read - n)
+            time.sleep(0.001)
+
+        stages = pipeline.Pipeline(source())
+        stages.add('slow', slow, queue_size=2)
+        stages.run()
+
+        # One item being processed, two queued and one waiting to be queued
+        assert max(in_flight) <= 4
+
+    def test_raises_errors_from_any_stage(self) -> None:
+        def fail(n: int) -> int:
+            if n == 5:
+                raise ValueError(n)
+            return n
+
+        stages = pipeline.Pipeline(range(1000))
+        stages.add('fail', fail, workers=2)
+        stages.add('sink', lambda n: None)
+
+        with pytest.raises(ValueError):
+            stages.run()
+        names = [thread.name for thread in threading.enumerate()]
+        assert not [name for name in names if name.startswith('fail-')]
+
+    def test_records_queue_depths(self) -> None:
+        profiler = profiling.Profiler()
+
+        stages = pipeline.Pipeline(range(10), profiler)
+        stages.add('sink', lambda n: None)
+        stages.run()
+
+        assert profiler.gauges['sink queue'].samples == 10
+        assert 1 <= profiler.gauges['sink queue'].peak <= 4
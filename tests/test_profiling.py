@@ -0,0 +1,55 @@
+import json
+
+from pathlib import Path
+
+from .context import profiling
+
+
+class TestProfiler:
+    def test_accumulates_stages(self) -> None:
+        profiler = profiling.Profiler()
+
+        profiler.record('stage', 1.0, 10)
+        profiler.record('stage', 0.5, 5)
+
+        assert profiler.stages['stage'] == profiling.Stage(2, 1.5, 15)
+
+    def test_merges_stages_from_other_processes(self) -> None:
+        profiler = profiling.Profiler()
+        profiler.record('stage', 1.0)
+        worker = profiling.Profiler()
+        worker.record('stage', 2.0)
+
+        profiler.merge(worker.take())
+
+        assert profiler.stages['stage'].calls == 2
+        assert worker.stages == {}
+
+    def test_times_iteration(self) -> None:
+        profiler = profiling.Profiler()
+
+        items = list(profiler.iterate('items', range(3)))
+
+        assert items == [0, 1, 2]
+        assert profiler.stages['items'].calls == 3
+
+    def test_reports_stages(self, tmp_path: Path) -> None:
+        profiler = profiling.Profiler()
+        with profiler.timing('stage', bytes=1024 * 1024):
+            pass
+
+        profiler.dump(tmp_path / 'profile.json')
+
+        assert 'stage ' in profiler.report()
+        data = json.loads((tmp_path / 'profile.json').read_text())
+        assert data['stages']['stage']['bytes'] == 1024 * 1024
+
+    def test_samples_gauges(self) -> None:
+        profiler = profiling.Profiler()
+
+        for depth in [1, 4, 1]:
+            profiler.gauge('queue', depth)
+
+        assert profiler.gauges['queue'].peak == 4
+        assert profiler.gauges['queue'].mean == 2
+        assert 'queue ' in profiler.report()
@@ -1,7 +1,13 @@
+import bz2
+import dataclasses
+import gzip
 import io
+import lzma
+import typing
 
 import pytest
 
+from .context import page
 from .context import rss_doc
 from .context import wp
 
@@ -78,6 +84,110 @@ class TestAttachments:
         assert attachments[attachment_id] == attachment_url
 
 
+class Unseekable(io.BufferedReader):
+    def seekable(self) -> bool:
+        return False
+
+
+class TestCompressedExports:
+    @pytest.mark.parametrize(
+        'compress', [gzip.compress, bz2.compress, lzma.compress]
+    )
+    def test_decompresses_as_it_parses(
+        self, post_data: str, compress: typing.Callable[[bytes], bytes]
+    ) -> None:
+        data = compress(rss_doc(post_data).encode())
+        source = Unseekable(io.BytesIO(data))  # type: ignore[arg-type]
+
+        [post] = wp.posts(source)
+
+        assert post.slug == 'post-name'
+
+    def test_reads_uncompressed_text(self, post_data: str) -> None:
+        source = io.StringIO(rss_doc(post_data))
+
+        assert wp.decompressed(source) is source
+        assert source.tell() == 0
+
+
+class TestItemsOfType:
+    def test_releases_items_once_consumed(self, post_data: str) -> None:
+        source = io.StringIO(rss_doc(post_data + post_data))
+        items = wp.items_of_type(source, 'post')
+
+        first = next(items)
+        assert len(first) > 0
+
+        next(items)
+        assert len(first) == 0
+
+    def test_ignores_items_of_other_types(
+        self, attachment_data: str, post_data: str
+    ) -> None:
+        source = io.StringIO(rss_doc(attachment_data + post_data))
+
+        items = list(wp.items_of_type(source, 'attachment'))
+
+        assert len(items) == 1
+
+
+class TestDecodeItem:
+    def decode(self, post_data: str) -> wp.Item:
+        source = io.StringIO(rss_doc(post_data))
+        return wp.decode_item(next(wp.items(source)))
+
+    def test_stores_text_of_each_field(self, post_data: str) -> None:
+        item = self.decode(post_data)
+
+        assert item.text('title') == 'Post title'
+        assert item.text('wp:post_name') == 'post-name'
+
+    def test_collects_post_tags(self, post_data: str) -> None:
+        item = self.decode(post_data)
+
+        assert item.tags == ['tag-1', 'tag-2']
+
+    def test_collects_metadata(self, post_data: str) -> None:
+        item = self.decode(post_data)
+
+        assert item.meta == {
+            '_thumbnail_id': thumbnail_id,
+            '_irrelevant_key': 'irrelevant value',
+        }
+
+    def test_complains_about_missing_fields(self, post_data: str) -> None:
+        item = self.decode(post_data)
+
+        with pytest.raises(ValueError):
+            item.text('wp:attachment_url')
+        with pytest.raises(RuntimeError):
+            item.metadata('_missing_key')
+
+
+class TestSplitExport:
+    def test_collects_attachments_that_follow_posts(
+        self, attachment_data: str, post_data: str
+    ) -> None:
+        source = io.StringIO(rss_doc(post_data + attachment_data))
+
+        attachments, spool = wp.split_export(source)
+
+        assert attachments == {attachment_id: attachment_url}
+
+    def test_spools_published_posts(
+        self, attachment_data: str, post_data: str
+    ) -> None:
+        source = io.StringIO(rss_doc(post_data + attachment_data))
+        attachments = {thumbnail_id: attachment_url}
+        parser = wp.thumbnail_parser(attachments)
+
+        _, spool = wp.split_export(source)
+        posts = list(wp.posts(spool, [], [parser]))
+
+        assert [post.slug for post in posts] == ['post-name']
+        assert posts[0].thumbnail == attachment_url
+
+
 class TestPosts:
     def test_iterates_over_published_posts(self, post_data: str) -> None:
         source = io.StringIO(rss_doc(post_data))
@@ -132,6 +242,37 @@ class TestPosts:
             [inline_image_id] + gallery_image_ids
         )
 
+    def test_lazy_posts_load_the_same_content(self, post_data: str) -> None:
+        eager = next(wp.posts(io.StringIO(rss_doc(post_data))))
+
+        lazy = next(wp.posts(io.StringIO(rss_doc(post_data)), lazy=True))
+
+        assert isinstance(lazy, page.DeferredPage)
+        assert lazy.load_content is not None
+        for field in dataclasses.fields(eager):
+            assert getattr(lazy, field.name) == getattr(eager, field.name)
+
+
+class TestPostMetadata:
+    def test_parses_everything_but_content(self, post_data: str) -> None:
+        source = io.StringIO(rss_doc(post_data))
+
+        [metadata] = wp.post_metadata(source, [wp.tag_parser])
+
+        assert metadata == {
+            'title': 'Post title',
+            'slug': 'post-name',
+            'pubDate': '2023-10-24 15:25:27',
+            'tags': ['tag-1', 'tag-2'],
+        }
+
+
+class TestReferencedAttachmentIds:
+    def test_finds_images_and_galleries(self, post_data: str) -> None:
+        ids = wp.referenced_attachment_ids(post_data)
+
+        assert ids == set([inline_image_id] + gallery_image_ids)
+
 
 class TestDeSpanFilter:
     def test_removes_span_tags_around_paragraph(self) -> None:
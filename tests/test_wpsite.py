@@ -1,3 +1,7 @@
+import asyncio
+import gzip
+import io
+import json
 import typing
 
 from pathlib import Path
@@ -7,20 +11,22 @@ import pytest
 
 import wpsite
 
+from .context import StubResponse
+
 
 @pytest.fixture(autouse=True)
-def stub_urlopen() -> typing.Generator[None, None, None]:
-    # We're stubbing out calls to urllib.request.urlopen(), which is used to
-    # download files that are attached to pages/posts.
+def stub_requests() -> typing.Generator[None, None, None]:
+    # We're stubbing out wpsite.fetch.ConnectionPool.request(), which is used
+    # to download files that are attached to pages/posts.
     #
-    # urlopen() really returns an instance of http.client.HTTPResponse,
+    # request() really returns an instance of http.client.HTTPResponse,
     # which inherits the interface that we want to use from io.BytesIO.
     #
-    # So we can stub out read() from the BytesIO interface instead of getting
+    # So we can stub out the response with a BytesIO instead of getting
     # involved with sockets/socket-like objects.
     #
-    with mock.patch.object(wpsite.astro.urllib.request, 'urlopen') as stub:
-        stub.return_value.read.return_value = b'response data'
+    with mock.patch.object(wpsite.fetch.ConnectionPool, 'request') as stub:
+        stub.side_effect = lambda url, headers: StubResponse(b'response data')
         yield
 
 
@@ -29,6 +35,11 @@ def content_dir(tmp_path: Path) -> Path:
     return tmp_path / 'src' / 'content' / 'blog'
 
 
+def tree(dir: Path, pattern: str = '*') -> dict[Path, bytes]:
+    files = (f for f in dir.rglob(pattern) if f.is_file())
+    return {f.relative_to(dir): f.read_bytes() for f in files}
+
+
 def test_creates_content_dir(xml_file: Path, content_dir: Path) -> None:
     wpsite.convert_to_markdown(xml_file, content_dir)
 
@@ -53,3 +64,333 @@ def test_fetches_attachments(xml_file: Path, content_dir: Path) -> None:
     wpsite.convert_to_markdown(xml_file, content_dir)
 
     assert attachment_path.exists(), f'{attachment_path} should exist'
+    assert attachment_path.read_bytes() == b'response data'
+
+
+def test_fetches_images_at_the_size_they_are_shown(
+    xml_file: Path, content_dir: Path
+) -> None:
+    with mock.patch.object(wpsite.fetch.ConnectionPool, 'request') as stub:
+        stub.side_effect = lambda url, headers: StubResponse(b'pixels')
+        wpsite.convert_to_markdown(xml_file, content_dir, sized_images=True)
+
+    url = 'https://grahamashtondev.files.wordpress.com/2023/10/image.jpg'
+    urls = [call.args[0] for call in stub.call_args_list]
+    assert f'{url}?w=1024' in urls
+    assert (content_dir / 'the-art-of-connection' / 'image.jpg').exists()
+
+
+def test_sized_images_apply_to_converted_posts(
+    xml_file: Path, tmp_path: Path, content_dir: Path
+) -> None:
+    cache_dir = tmp_path / 'cache'
+    wpsite.convert_to_markdown(xml_file, content_dir, cache_dir=cache_dir)
+    with mock.patch.object(wpsite.fetch.ConnectionPool, 'request') as stub:
+        stub.side_effect = lambda url, headers: StubResponse(b'pixels')
+        wpsite.convert_to_markdown(
+            xml_file, content_dir, cache_dir=cache_dir, sized_images=True
+        )
+
+    url = 'https://grahamashtondev.files.wordpress.com/2023/10/image.jpg'
+    urls = [call.args[0] for call in stub.call_args_list]
+    assert f'{url}?w=1024' in urls
+
+
+def test_optimizes_downloaded_images(
+    xml_file: Path, content_dir: Path
+) -> None:
+    Image = pytest.importorskip('PIL.Image')
+    photo = io.BytesIO()
+    Image.new('RGB', (400, 100)).save(photo, 'JPEG')
+    attachment_path = content_dir / 'the-art-of-connection' / 'image.jpg'
+    settings = wpsite.images.Settings(max_dimension=200, formats=('webp',))
+
+    with mock.patch.object(wpsite.fetch.ConnectionPool, 'request') as stub:
+        stub.side_effect = lambda url, headers: StubResponse(photo.getvalue())
+        wpsite.convert_to_markdown(
+            xml_file, content_dir, optimize_images=settings
+        )
+
+    assert Image.open(attachment_path).size == (200, 50)
+    assert attachment_path.with_name('image.jpg.webp').exists()
+
+
+class UnseekableStream(io.BytesIO):
+    def seekable(self) -> bool:
+        return False
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        raise io.UnsupportedOperation('seek')
+
+
+def test_reads_unseekable_streams(xml_file: Path, content_dir: Path) -> None:
+    post_slug = 'the-art-of-connection'
+    post_filename = (content_dir / post_slug / 'index').with_suffix('.md')
+
+    wpsite.convert_export(UnseekableStream(xml_file.read_bytes()), content_dir)
+
+    assert post_filename.is_file()
+
+
+def test_reads_compressed_exports(
+    xml_file: Path, tmp_path: Path, content_dir: Path
+) -> None:
+    compressed_file = tmp_path / 'wordpress.xml.gz'
+    compressed_file.write_bytes(gzip.compress(xml_file.read_bytes()))
+    post_filename = content_dir / 'the-art-of-connection' / 'index.md'
+
+    wpsite.convert_to_markdown(compressed_file, content_dir)
+
+    assert post_filename.is_file()
+
+
+def test_parallel_output_matches_serial(
+    xml_file: Path, tmp_path: Path
+) -> None:
+    wpsite.convert_to_markdown(xml_file, tmp_path / 'serial')
+    wpsite.convert_to_markdown(xml_file, tmp_path / 'parallel', jobs=2)
+
+    serial = tree(tmp_path / 'serial', '*.md')
+    assert serial
+    assert tree(tmp_path / 'parallel', '*.md') == serial
+
+
+def test_unchanged_posts_are_not_rewritten(
+    xml_file: Path, content_dir: Path
+) -> None:
+    wpsite.convert_to_markdown(xml_file, content_dir)
+
+    with mock.patch.object(wpsite.astro.PostDirectory, 'create_markdown') as m:
+        wpsite.convert_to_markdown(xml_file, content_dir)
+
+    m.assert_not_called()
+
+
+def test_changed_posts_are_rewritten(
+    xml_file: Path, tmp_path: Path, content_dir: Path
+) -> None:
+    wpsite.convert_to_markdown(xml_file, content_dir)
+    changed_file = tmp_path / 'changed.xml'
+    changed_file.write_text(
+        xml_file.read_text().replace('Beyond the Obstacle', 'New title')
+    )
+
+    wpsite.convert_to_markdown(changed_file, content_dir)
+
+    markdown = content_dir / 'beyond-the-obstacle' / 'index.md'
+    assert 'title: "New title"' in markdown.read_text()
+
+
+def test_forcing_rewrites_every_post(
+    xml_file: Path, content_dir: Path
+) -> None:
+    wpsite.convert_to_markdown(xml_file, content_dir)
+
+    with mock.patch.object(wpsite.astro.PostDirectory, 'create_markdown') as m:
+        wpsite.convert_to_markdown(xml_file, content_dir, force=True)
+
+    assert m.call_count == 2
+
+
+def test_each_conversion_has_a_writer_of_its_own(
+    xml_file: Path, content_dir: Path
+) -> None:
+    Writer = wpsite.astro.Writer
+    with mock.patch.object(wpsite.astro, 'Writer', wraps=Writer) as writer:
+        wpsite.convert_to_markdown(xml_file, content_dir)
+        wpsite.convert_to_markdown(xml_file, content_dir, force=True)
+
+    assert writer.call_count == 2
+
+
+def test_profiles_each_stage(xml_file: Path, content_dir: Path) -> None:
+    profiler = wpsite.profiling.Profiler()
+
+    wpsite.convert_to_markdown(xml_file, content_dir, profiler=profiler)
+
+    for stage in ['parse export', 'HostedImageFilter', 'markdownify']:
+        assert stage in profiler.stages
+    assert profiler.stages['download'].bytes == len(b'response data')
+
+
+hosted_url = 'https://sitename.files.wordpress.com/2023/10/image.jpg'
+hosted_image = (
+    f'<img class="size-full wp-image-1" src="{hosted_url}?w=1024" />'
+)
+
+filter_engine_examples = [
+    '\n\n'.join(
+        [
+            f'<span style="font-weight: 400;">{hosted_image}Some text</span>',
+            f'<a href="{hosted_url}?w=1024">{hosted_image}</a>More text',
+            f'<p>A <a href="{hosted_url}">link</a></p>',
+            '[gallery ids="1,2,3" type="rectangular"]',
+            '<p>Nothing to see here</p>',
+        ]
+    ),
+    # Tags that span a blank line
+    '<span\n\nstyle="font-weight: 400;">Some text</span>',
+    f'<a href="{hosted_url}"><img\n\nsrc="{hosted_url}"></a>',
+    # IDs that aren't on an <img>, so there are no images to point at
+    f'<figure class="wp-image-1">\n\n<a href="{hosted_url}">link</a>',
+    f'<p>wp-image-1</p>\n\n<p><a href="{hosted_url}">link</a></p>',
+]
+
+
+@pytest.mark.parametrize('content', filter_engine_examples)
+def test_filter_engine_matches_filters_applied_in_turn(content: str) -> None:
+    attachments = {'1': hosted_url, '2': hosted_url.replace('image', 'other')}
+    [engine] = wpsite.filters(attachments)
+    assert isinstance(engine, wpsite.page.FilterEngine)
+
+    expected = content
+    for html_filter in engine.filters:
+        expected = html_filter(expected)
+
+    assert engine(content) == expected
+
+
+def test_shards_partition_posts_by_slug() -> None:
+    shards = [wpsite.Shard.parse(f'{i}/3') for i in range(1, 4)]
+    slugs = [f'post-{i}' for i in range(100)]
+
+    owners = [[s for s in shards if slug in s] for slug in slugs]
+
+    assert all(len(owner) == 1 for owner in owners)
+    assert {owner[0] for owner in owners} == set(shards)
+
+
+@pytest.mark.parametrize('text', ['0/2', '3/2', '1', 'a/b'])
+def test_rejects_invalid_shards(text: str) -> None:
+    with pytest.raises(ValueError):
+        wpsite.Shard.parse(text)
+
+
+def test_merged_shards_match_single_run(
+    xml_file: Path, tmp_path: Path, content_dir: Path
+) -> None:
+    index = tmp_path / 'attachments'
+    for number in [1, 2]:
+        wpsite.convert_to_markdown(
+            xml_file,
+            content_dir,
+            shard=wpsite.Shard(number, 2),
+            attachment_index=index,
+        )
+    with xml_file.open('rb') as file:
+        problems = wpsite.merge_shards(file, content_dir, 2)
+    wpsite.convert_to_markdown(xml_file, tmp_path / 'single')
+
+    assert problems == []
+    assert index.exists()
+    single = tree(tmp_path / 'single')
+    sharded = tree(content_dir)
+    for shard in ['1-of-2', '2-of-2']:
+        del sharded[Path(f'.wpsite-manifest-{shard}.json')]
+    assert sharded == single
+
+
+def test_rejects_attachment_index_from_another_export(
+    xml_file: Path, tmp_path: Path, content_dir: Path
+) -> None:
+    index = tmp_path / 'attachments'
+    wpsite.convert_to_markdown(xml_file, content_dir, attachment_index=index)
+    changed_file = tmp_path / 'changed.xml'
+    changed_file.write_text(
+        xml_file.read_text().replace('2023/10/image.jpg', '2023/11/image.jpg')
+    )
+
+    with pytest.raises(ValueError, match='different export'):
+        wpsite.convert_to_markdown(
+            changed_file, content_dir, attachment_index=index
+        )
+
+
+def test_merging_reports_missing_shards(
+    xml_file: Path, content_dir: Path
+) -> None:
+    wpsite.convert_to_markdown(xml_file, content_dir, shard=wpsite.Shard(1, 2))
+
+    with xml_file.open('rb') as file:
+        problems = wpsite.merge_shards(file, content_dir, 2)
+
+    assert 'Shard 2/2 has no manifest' in problems
+    assert not (content_dir / '.wpsite-manifest.json').exists()
+
+
+def test_async_conversion_reports_each_post(
+    xml_file: Path, tmp_path: Path, content_dir: Path
+) -> None:
+    async def convert() -> list[wpsite.Converted]:
+        events = wpsite.convert_to_markdown_async(xml_file, content_dir)
+        return [event async for event in events]
+
+    events = asyncio.run(convert())
+    wpsite.convert_to_markdown(xml_file, tmp_path / 'sync')
+
+    assert sorted(event.slug for event in events) == [
+        'beyond-the-obstacle',
+        'the-art-of-connection',
+    ]
+    assert [event.posts for event in events] == [1, 2]
+    assert tree(content_dir) == tree(tmp_path / 'sync')
+
+
+def test_journal_is_removed_after_a_complete_run(
+    xml_file: Path, content_dir: Path
+) -> None:
+    wpsite.convert_to_markdown(xml_file, content_dir)
+
+    assert not (content_dir / '.wpsite-journal.jsonl').exists()
+
+
+def test_resuming_retries_only_failed_downloads(
+    xml_file: Path, content_dir: Path
+) -> None:
+    not_found = StubResponse(b'')
+    not_found.status = 404
+    with mock.patch.object(wpsite.fetch.ConnectionPool, 'request') as stub:
+        stub.return_value = not_found
+        wpsite.convert_to_markdown(xml_file, content_dir)
+    image = content_dir / 'the-art-of-connection' / 'image.jpg'
+    assert not image.exists()
+    assert (content_dir / '.wpsite-journal.jsonl').exists()
+
+    with mock.patch.object(wpsite.astro.PostDirectory, 'create_markdown') as m:
+        wpsite.convert_to_markdown(xml_file, content_dir, resume=True)
+
+    m.assert_not_called()
+    assert image.read_bytes() == b'response data'
+    assert not (content_dir / '.wpsite-journal.jsonl').exists()
+    manifest = wpsite.astro.Manifest(content_dir)
+    assert sorted(manifest.previous) == [
+        'beyond-the-obstacle',
+        'the-art-of-connection',
+    ]
+
+
+def test_resuming_an_interrupted_run(
+    xml_file: Path, tmp_path: Path, content_dir: Path
+) -> None:
+    wpsite.convert_to_markdown(xml_file, tmp_path / 'complete')
+    # A run that was killed after rendering one post, before it downloaded
+    # the post's image, and in the middle of writing the next line.
+    markdown = Path('the-art-of-connection') / 'index.md'
+    (content_dir / markdown.parent).mkdir(parents=True)
+    (content_dir / markdown).write_bytes(
+        (tmp_path / 'complete' / markdown).read_bytes()
+    )
+    entry = wpsite.astro.Manifest(tmp_path / 'complete').previous[
+        'the-art-of-connection'
+    ]
+    (content_dir / '.wpsite-journal.jsonl').write_text(
+        json.dumps({'post': 'the-art-of-connection', **entry})
+        + '\n{"post": "beyond-the'
+    )
+
+    with mock.patch.object(wpsite.astro.PostDirectory, 'create_markdown') as m:
+        wpsite.convert_to_markdown(xml_file, content_dir, resume=True)
+
+    assert m.call_count == 1
+    image = content_dir / 'the-art-of-connection' / 'image.jpg'
+    assert image.read_bytes() == b'response data'
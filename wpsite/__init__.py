@@ -24,6 +24,19 @@ responsibility. This is the thinking behind what each module is for:
     - `astro` knows how to convert the things in the `page` module into files
       that can be read by Astro
 
+    - `fetch` downloads the files that are attached to the pages
+
+    - `attachments` stores the URLs of a site's attachments compactly
+
+    - `files` writes files so that readers never see them half-written
+
+    - `images` optimizes downloaded images for the web
+
+    - `pipeline` runs the stages of a conversion at the same time, and
+      starts the pools of processes that some stages run on
+
+    - `profiling` records how long each stage of a conversion takes
+
 Think of `page` as a bridge between `wp` and `astro`. The code in `wp` takes
 the XML and converts it into objects in `page`. Then the `astro` code can then
 use things that live in `page` to build an Astro-ready representation of the
@@ -39,34 +52,741 @@ top-level of the `wpsite` package. That's really the entry point.
 """
 
 
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
+import asyncio
+import collections
+import contextlib
+import dataclasses
+import hashlib
+import json
+import logging
+import tempfile
 import typing
 
 from . import astro
+from . import fetch
+from . import images
+from . import page
 from . import wp
+from .attachments import AttachmentIndex
+from .pipeline import Pipeline, spawn_pool
+from .profiling import Profiler, Stage
 
 
-def filters(attachments: dict[str, str]) -> list[typing.Callable]:
-    return [
+def filters(
+    attachments: typing.Mapping[str, str], profiler: Profiler | None = None
+) -> list[typing.Callable]:
+    html_filters: list[typing.Callable[[str], str]] = [
         wp.DeSpanFilter(),
         wp.RemoveImageLinksFilter(),
         wp.IllustratedParagraphFilter(),
         wp.GalleryFilter(attachments),
         astro.HostedImageFilter(attachments),
     ]
+    return [page.FilterEngine(html_filters, profiler)]
 
 
-def parsers(attachments: dict[str, str]) -> list[typing.Callable]:
+def parsers(attachments: typing.Mapping[str, str]) -> list[typing.Callable]:
     return [
         wp.tag_parser,
         wp.thumbnail_parser(attachments),
     ]
 
 
-def convert_to_markdown(xml_file: Path, content_dir: Path) -> None:
-    with xml_file.open() as file:
-        attachments = wp.attachments_by_id(file)
-        for post in wp.posts(file, filters(attachments), parsers(attachments)):
+def fingerprint(
+    post: page.Page,
+    attachments: typing.Mapping[str, str],
+    sized_images: bool = False,
+) -> str:
+    """Summarise everything that affects how a post is rendered"""
+    attachment_ids = sorted(wp.referenced_attachment_ids(post.content))
+    post_filters = [page.filter_name(f) for f in post.filters]
+    converter = getattr(
+        post.converter, 'name', page.filter_name(post.converter)
+    )
+    data = [
+        post.title,
+        post.slug,
+        post.pubDate,
+        post.content,
+        post.tags,
+        post.thumbnail,
+        post_filters,
+        converter,
+        [attachments.get(i) for i in attachment_ids],
+    ]
+    # Only added when it's set, so that turning the option on doesn't
+    # change the fingerprints of posts that are converted without it.
+    if sized_images:
+        data.append('sized images')
+    return hashlib.sha256(json.dumps(data).encode()).hexdigest()
+
+
+def timing(
+    profiler: Profiler | None, name: str, bytes: int = 0
+) -> typing.ContextManager[None]:
+    if profiler is None:
+        return contextlib.nullcontext()
+    return profiler.timing(name, bytes)
+
+
+def prepare(
+    post_dir: astro.PostDirectory,
+    attachments: typing.Mapping[str, str],
+    profiler: Profiler | None = None,
+    sized_images: bool = False,
+) -> tuple[str, list[str]]:
+    """Render a post's Markdown file (without writing it), and find its URLs"""
+    # The filters time themselves, and each step's output is cached by the
+    # Page, so we can time each step separately.
+    post = post_dir.post
+    with timing(profiler, 'markdownify', len(post.filtered_html)):
+        text = post_dir.markdown_text()
+    with timing(profiler, 'find attachments'):
+        return text, post_dir.attachment_urls(attachments, sized_images)
+
+
+# Each worker process in a rendering pool receives the attachment URLs once,
+# when it starts, rather than with every post.
+worker_attachments: typing.Mapping[str, str] = {}
+worker_filters: list[typing.Callable] = []
+worker_profiler: Profiler | None = None
+
+
+def init_worker(attachments: typing.Mapping[str, str], profile: bool) -> None:
+    global worker_attachments, worker_filters, worker_profiler
+    worker_attachments = attachments
+    worker_profiler = Profiler() if profile else None
+    worker_filters = filters(attachments, worker_profiler)
+
+
+Prepared = tuple[str, list[str], dict[str, Stage]]
+
+
+def prepare_in_worker(
+    content_dir: Path, post: page.Page, sized_images: bool = False
+) -> Prepared:
+    post.filters = worker_filters
+    post_dir = astro.PostDirectory(content_dir, post)
+    text, urls = prepare(
+        post_dir, worker_attachments, worker_profiler, sized_images
+    )
+    return text, urls, worker_profiler.take() if worker_profiler else {}
+
+
+@contextlib.contextmanager
+def rendering_pool(
+    jobs: int, attachments: typing.Mapping[str, str], profiler: Profiler | None
+) -> typing.Iterator[ProcessPoolExecutor | None]:
+    if jobs == 1:
+        yield None
+        return
+    with tempfile.TemporaryDirectory() as tmp:
+        # The workers map the attachment index's file into memory, rather than
+        # each being sent a copy of it.
+        if isinstance(attachments, AttachmentIndex):
+            attachments.save(Path(tmp) / 'attachments')
+            attachments = AttachmentIndex.open(Path(tmp) / 'attachments')
+        with spawn_pool(
+            jobs,
+            initializer=init_worker,
+            initargs=(attachments, profiler is not None),
+        ) as executor:
+            yield executor
+
+
+@contextlib.contextmanager
+def image_pool(
+    settings: images.Settings | None, processes: int, cache_dir: Path | None
+) -> typing.Iterator[images.Optimizer | None]:
+    if settings is None:
+        yield None
+        return
+    image_cache = cache_dir / 'images' if cache_dir else None
+    with images.Optimizer(settings, processes, image_cache) as optimizer:
+        yield optimizer
+
+
+@dataclasses.dataclass
+class RenderedPost:
+    """A post on its way through the stages of a conversion
+
+    If the post hasn't changed since it was last written, it's not rendered
+    again, and `text` is None.
+
+    """
+
+    post_dir: astro.PostDirectory
+    fingerprint: str
+    urls: list[str]
+    text: str | None = None
+
+
+def render_post(
+    post: page.Page,
+    content_dir: Path,
+    attachments: typing.Mapping[str, str],
+    manifest: astro.Manifest,
+    executor: ProcessPoolExecutor | None = None,
+    profiler: Profiler | None = None,
+    sized_images: bool = False,
+    writer: astro.Writer | None = None,
+) -> RenderedPost:
+    """Render a post's Markdown (without writing it), unless it's unchanged
+
+    Posts that haven't changed since the manifest was written aren't
+    rendered again; the URLs of their attachments come from the manifest.
+    Posts are rendered on the executor (a rendering pool) if there is one,
+    and on the calling thread if not. The post is later written with
+    `writer`.
+
+    """
+    post_dir = astro.PostDirectory(content_dir, post, writer)
+    with timing(profiler, 'check manifest'):
+        digest = fingerprint(post, attachments, sized_images)
+        urls = manifest.unchanged(post_dir, digest)
+    if urls is not None:
+        return RenderedPost(post_dir, digest, urls)
+    if executor is None:
+        text, urls = prepare(post_dir, attachments, profiler, sized_images)
+    else:
+        unfiltered = dataclasses.replace(post, filters=[])
+        text, urls, stages = executor.submit(
+            prepare_in_worker, content_dir, unfiltered, sized_images
+        ).result()
+        if profiler:
+            profiler.merge(stages)
+    return RenderedPost(post_dir, digest, urls, text)
+
+
+def write_post(
+    rendered: RenderedPost,
+    manifest: astro.Manifest,
+    profiler: Profiler | None = None,
+) -> None:
+    """Write a rendered post's Markdown (if it changed), and record it"""
+    post_dir = rendered.post_dir
+    if rendered.text is not None:
+        with timing(profiler, 'write markdown', len(rendered.text)):
+            post_dir.create_markdown(rendered.text)
+    manifest.record(post_dir.post.slug, rendered.fingerprint, rendered.urls)
+
+
+RenderedPosts = typing.Generator[tuple[page.Page, list[str]], None, None]
+
+
+def render_posts(
+    posts: typing.Iterable[page.Page],
+    content_dir: Path,
+    attachments: typing.Mapping[str, str],
+    manifest: astro.Manifest,
+    jobs: int = 1,
+    profiler: Profiler | None = None,
+    writer: astro.Writer | None = None,
+) -> RenderedPosts:
+    """Write each post's Markdown, yielding the URLs of its attachments
+
+    Each post is rendered by `render_post()`, on one of `jobs` threads (and
+    in a pool of processes when there's more than one job). They're yielded
+    in their original order, and only a few posts per job are rendered at a
+    time.
+
+    """
+    pending: collections.deque[Future] = collections.deque()
+
+    def finish(future: Future) -> RenderedPosts:
+        rendered = future.result()
+        write_post(rendered, manifest, profiler)
+        yield rendered.post_dir.post, rendered.urls
+
+    with (
+        rendering_pool(jobs, attachments, profiler) as executor,
+        ThreadPoolExecutor(jobs) as threads,
+    ):
+        for post in posts:
+            pending.append(
+                threads.submit(
+                    render_post,
+                    post,
+                    content_dir,
+                    attachments,
+                    manifest,
+                    executor,
+                    profiler,
+                    writer=writer,
+                )
+            )
+            if len(pending) >= jobs * 4:
+                yield from finish(pending.popleft())
+        while pending:
+            yield from finish(pending.popleft())
+
+
+@dataclasses.dataclass(frozen=True)
+class Shard:
+    """One of several parts of an export, to be converted separately
+
+    Posts are assigned to shards by a hash of their slug, so that the machines
+    converting each shard agree on which posts belong to which shard without
+    having to talk to each other. Shards are numbered from 1, and each one
+    keeps its own manifest in the (shared) content directory.
+
+    """
+
+    number: int
+    count: int
+
+    @classmethod
+    def parse(cls, text: str) -> 'Shard':
+        """Read a shard written as e.g. `2/8`"""
+        number, _, count = text.partition('/')
+        shard = cls(int(number), int(count))
+        if not 1 <= shard.number <= shard.count:
+            raise ValueError(f'{text} is not a shard (e.g. 1/{shard.count})')
+        return shard
+
+    def __str__(self) -> str:
+        return f'{self.number}/{self.count}'
+
+    def __contains__(self, slug: str) -> bool:
+        digest = hashlib.sha256(slug.encode()).digest()
+        return (
+            int.from_bytes(digest[:8], 'big') % self.count == self.number - 1
+        )
+
+    def filename(self, filename: str) -> str:
+        """Name a shard's copy of a file (e.g. its manifest)"""
+        path = Path(filename)
+        return f'{path.stem}-{self.number}-of-{self.count}{path.suffix}'
+
+
+def read_export(
+    source: typing.IO,
+    shard: Shard | None = None,
+    attachment_index: Path | None = None,
+    skip: typing.Container[str] = (),
+) -> tuple[typing.Mapping[str, str], typing.IO[bytes]]:
+    """Split the export, reusing a precomputed attachment index if there is one
+
+    If `attachment_index` doesn't exist yet, the index that's built from the
+    export is saved there, so that other shards can map it into memory rather
+    than collecting the attachments themselves. An existing index must have
+    been built from an export with the same attachments, or ValueError is
+    raised.
+
+    Posts that aren't in the shard, or whose slugs are in `skip`, are left
+    out of the spool.
+
+    """
+
+    def wanted(slug: str) -> bool:
+        return (shard is None or slug in shard) and slug not in skip
+
+    if attachment_index is not None and attachment_index.exists():
+        seen, spool = wp.split_export(
+            source, wanted, collect_attachments=False
+        )
+        attachments = AttachmentIndex.open(attachment_index)
+        if attachments.digest != seen.digest:
+            spool.close()
+            raise ValueError(
+                f'{attachment_index} was built from a different export; '
+                'delete it to rebuild it'
+            )
+        return attachments, spool
+    attachments, spool = wp.split_export(source, wanted)
+    if attachment_index is not None:
+        attachments.save(attachment_index)
+    return attachments, spool
+
+
+def shard_filename(filename: str, shard: Shard | None) -> str:
+    return shard.filename(filename) if shard else filename
+
+
+def convert_export(
+    source: typing.IO,
+    content_dir: Path,
+    jobs: int = 1,
+    downloads: int = 4,
+    force: bool = False,
+    cache_dir: Path | None = None,
+    profiler: Profiler | None = None,
+    shard: Shard | None = None,
+    attachment_index: Path | None = None,
+    resume: bool = False,
+    writers: int = 1,
+    rate_limit: float | None = None,
+    optimize_images: images.Settings | None = None,
+    sized_images: bool = False,
+) -> None:
+    """Convert an export, writing the posts into the content directory
+
+    The posts are parsed, rendered (on `jobs` processes), written (on
+    `writers` threads) and their attachments downloaded (on `downloads`
+    threads) in a Pipeline, so that each stage can get on with its work while
+    the others are waiting, e.g. for the network.
+
+    Progress is recorded in a journal as the run goes along. If `resume` is
+    set, the posts that an earlier (interrupted) run rendered are skipped,
+    and only the downloads that it didn't finish are retried.
+
+    `rate_limit` caps the number of requests per second made to each host
+    that attachments are downloaded from.
+
+    If `optimize_images` is given, the images that are downloaded are then
+    optimized (on `jobs` processes) in a final stage of the pipeline. The
+    originals are replaced, keeping their names, so links to them (e.g. the
+    `coverImage` in the front matter) still work.
+
+    If `sized_images` is set, images that posts only show at a smaller size
+    are downloaded at that size, where the host can resize them.
+
+    """
+    journal = astro.Journal(
+        content_dir,
+        resume,
+        filename=shard_filename(astro.Journal.filename, shard),
+    )
+    resumed = dict(journal.posts)
+    with timing(profiler, 'parse export'):
+        attachments, spool = read_export(
+            source, shard, attachment_index, skip=resumed
+        )
+    writer = astro.Writer()
+    manifest = astro.Manifest(
+        content_dir,
+        reset=force,
+        filename=shard_filename(astro.Manifest.filename, shard),
+        writer=writer,
+    )
+    cache = fetch.Cache(cache_dir) if cache_dir else None
+    downloader = fetch.Downloader(
+        downloads, cache=cache, profiler=profiler, rate=rate_limit
+    )
+    pool = rendering_pool(jobs, attachments, profiler)
+    optimizing = image_pool(optimize_images, jobs, cache_dir)
+    # The optimizer is shut down after the downloader, as downloads that
+    # finish while it's shutting down are passed on to the optimizer
+    with (
+        journal,
+        spool,
+        manifest,
+        optimizing as optimizer,
+        downloader,
+        pool as executor,
+    ):
+        for slug, entry in resumed.items():
+            manifest.record(slug, entry['fingerprint'], entry['urls'])
+            for url in journal.unfinished(slug):
+                path = content_dir / slug / astro.attachment_basename(url)
+                if path.exists() and not downloader.revalidates:
+                    continue
+                download = downloader.submit(url, path)
+                journal.track(slug, url, download)
+                if optimizer:
+                    optimizer.after(download, path)
+
+        def render(post: page.Page) -> RenderedPost:
+            return render_post(
+                post,
+                content_dir,
+                attachments,
+                manifest,
+                executor,
+                profiler,
+                sized_images,
+                writer,
+            )
+
+        def write(rendered: RenderedPost) -> RenderedPost | None:
+            write_post(rendered, manifest, profiler)
+            journal.rendered(
+                rendered.post_dir.post.slug,
+                rendered.fingerprint,
+                rendered.urls,
+            )
+            return rendered if rendered.urls else None
+
+        def download_attachments(rendered: RenderedPost) -> list[Path] | None:
+            downloaded = rendered.post_dir.download_images(
+                rendered.urls, downloader, journal
+            )
+            return downloaded or None
+
+        posts: typing.Iterable[page.Page] = wp.posts(
+            spool, filters(attachments, profiler), parsers(attachments)
+        )
+        if profiler:
+            posts = profiler.iterate('parse posts', posts)
+        pipeline = Pipeline(posts, profiler)
+        pipeline.add('render', render, workers=jobs)
+        pipeline.add('write', write, workers=writers)
+        pipeline.add('download', download_attachments, workers=downloads)
+        if optimizer:
+            pipeline.add('optimize', optimizer.optimize, workers=jobs)
+        pipeline.run()
+    logging.info(downloader.summary)
+    if failures := journal.failure_report():
+        logging.warning(
+            f"{len(failures)} attachments couldn't be downloaded "
+            '(resume the run to try them again):'
+        )
+        for failure in failures:
+            logging.warning(f'  {failure}')
+
+
+def convert_to_markdown(
+    xml_file: Path,
+    content_dir: Path,
+    jobs: int = 1,
+    downloads: int = 4,
+    force: bool = False,
+    cache_dir: Path | None = None,
+    profiler: Profiler | None = None,
+    shard: Shard | None = None,
+    attachment_index: Path | None = None,
+    resume: bool = False,
+    writers: int = 1,
+    rate_limit: float | None = None,
+    optimize_images: images.Settings | None = None,
+    sized_images: bool = False,
+) -> None:
+    with xml_file.open('rb') as file:
+        convert_export(
+            file,
+            content_dir,
+            jobs=jobs,
+            downloads=downloads,
+            force=force,
+            cache_dir=cache_dir,
+            profiler=profiler,
+            shard=shard,
+            attachment_index=attachment_index,
+            resume=resume,
+            writers=writers,
+            rate_limit=rate_limit,
+            optimize_images=optimize_images,
+            sized_images=sized_images,
+        )
+
+
+@dataclasses.dataclass(frozen=True)
+class Converted:
+    """Progress of an asynchronous conversion; a post is finished
+
+    Its Markdown has been written, and its attachments downloaded (or they
+    failed to download; failures are logged by the Downloader, as usual).
+
+    """
+
+    slug: str
+    posts: int
+    attachments: int
+
+
+async def convert_export_async(
+    source: typing.IO,
+    content_dir: Path,
+    jobs: int = 1,
+    downloads: int = 4,
+    force: bool = False,
+    cache_dir: Path | None = None,
+    profiler: Profiler | None = None,
+    shard: Shard | None = None,
+    attachment_index: Path | None = None,
+    pending_posts: int = 16,
+    rate_limit: float | None = None,
+) -> typing.AsyncIterator[Converted]:
+    """Convert an export without blocking the event loop
+
+    This does the same job as `convert_export()`, yielding an event as each
+    post is finished. The export is parsed and the posts are rendered on a
+    thread of their own (and rendered in a pool of processes when there's
+    more than one job), a post at a time, so that the loop is free to get on
+    with other work in between. Attachments are downloaded by a Downloader,
+    whose threads limit how many are fetched at once, and are awaited rather
+    than waited for.
+
+    No more than `pending_posts` posts are waiting for their attachments at
+    once; parsing pauses until some of their downloads finish.
+
+    """
+    loop = asyncio.get_running_loop()
+    with ThreadPoolExecutor(1) as thread:
+
+        def run(f: typing.Callable, *args: typing.Any) -> asyncio.Future:
+            return loop.run_in_executor(thread, f, *args)
+
+        with timing(profiler, 'parse export'):
+            attachments, spool = await run(
+                read_export, source, shard, attachment_index
+            )
+        writer = astro.Writer()
+        manifest = astro.Manifest(
+            content_dir,
+            reset=force,
+            filename=shard_filename(astro.Manifest.filename, shard),
+            writer=writer,
+        )
+        cache = fetch.Cache(cache_dir) if cache_dir else None
+        downloader = fetch.Downloader(
+            downloads, cache=cache, profiler=profiler, rate=rate_limit
+        )
+        converted = 0
+
+        async def fetch_attachments(
+            post: page.Page, urls: list[str]
+        ) -> Converted:
+            post_dir = astro.PostDirectory(content_dir, post, writer)
+            futures = post_dir.save_images(urls, downloader)
+            await asyncio.gather(*map(asyncio.wrap_future, futures))
+            return Converted(post.slug, 0, len(urls))
+
+        def finished() -> list[Converted]:
+            # Posts are counted as they're reported, so that the count in
+            # each event is one more than in the one before.
+            nonlocal converted
+            events = []
+            for task in [task for task in pending if task.done()]:
+                pending.remove(task)
+                converted += 1
+                events.append(
+                    dataclasses.replace(task.result(), posts=converted)
+                )
+            return events
+
+        with spool, manifest:
+            posts: typing.Iterable[page.Page] = wp.posts(
+                spool, filters(attachments, profiler), parsers(attachments)
+            )
+            if profiler:
+                posts = profiler.iterate('parse posts', posts)
+            rendered = render_posts(
+                posts,
+                content_dir,
+                attachments,
+                manifest,
+                jobs,
+                profiler,
+                writer,
+            )
+            pending: set[asyncio.Task] = set()
+            try:
+                while next_post := await run(next, rendered, None):
+                    pending.add(
+                        asyncio.create_task(fetch_attachments(*next_post))
+                    )
+                    if len(pending) >= pending_posts:
+                        await asyncio.wait(
+                            pending, return_when=asyncio.FIRST_COMPLETED
+                        )
+                    for event in finished():
+                        yield event
+                while pending:
+                    await asyncio.wait(
+                        pending, return_when=asyncio.FIRST_COMPLETED
+                    )
+                    for event in finished():
+                        yield event
+            finally:
+                for task in pending:
+                    task.cancel()
+                await run(rendered.close)
+                await run(downloader.wait)
+    logging.info(downloader.summary)
+
+
+async def convert_to_markdown_async(
+    xml_file: Path,
+    content_dir: Path,
+    jobs: int = 1,
+    downloads: int = 4,
+    force: bool = False,
+    cache_dir: Path | None = None,
+    profiler: Profiler | None = None,
+    shard: Shard | None = None,
+    attachment_index: Path | None = None,
+    rate_limit: float | None = None,
+) -> typing.AsyncIterator[Converted]:
+    with xml_file.open('rb') as file:
+        events = convert_export_async(
+            file,
+            content_dir,
+            jobs=jobs,
+            downloads=downloads,
+            force=force,
+            cache_dir=cache_dir,
+            profiler=profiler,
+            shard=shard,
+            attachment_index=attachment_index,
+            rate_limit=rate_limit,
+        )
+        async for event in events:
+            yield event
+
+
+def merge_shards(
+    source: typing.IO,
+    content_dir: Path,
+    count: int,
+    sized_images: bool = False,
+) -> list[str]:
+    """Check that a sharded conversion matches a single run, and merge it
+
+    Every published post in the export should have been converted by exactly
+    one shard (the one that its slug belongs to), with the same fingerprint
+    that a single run would have given it, and its Markdown and attachments
+    should be in the content directory. If so, the shards' manifests are merged
+    into the one that a single run would have written, so later runs can carry
+    on incrementally without sharding.
+
+    The shards must have been converted with the same `sized_images`
+    setting, which is passed in so that the fingerprints can be checked.
+
+    Returns a description of each problem that's found.
+
+    """
+    problems = []
+    recorded: dict[str, dict[str, typing.Any]] = {}
+    for shard in (Shard(number, count) for number in range(1, count + 1)):
+        shard_manifest = astro.Manifest(
+            content_dir, filename=shard.filename(astro.Manifest.filename)
+        )
+        if not shard_manifest.path.exists():
+            problems.append(f'Shard {shard} has no manifest')
+        for slug, entry in shard_manifest.previous.items():
+            if slug not in shard:
+                problems.append(f'{slug} was converted by shard {shard}')
+            elif slug in recorded:
+                problems.append(f'{slug} was converted more than once')
+            recorded[slug] = entry
+
+    attachments, spool = wp.split_export(source)
+    merged = astro.Manifest(content_dir, reset=True)
+    with spool:
+        for post in wp.posts(
+            spool, filters(attachments), parsers(attachments)
+        ):
             post_dir = astro.PostDirectory(content_dir, post)
-            post_dir.create_markdown()
-            post_dir.fetch_attachments(attachments)
+            digest = fingerprint(post, attachments, sized_images)
+            if post.slug not in recorded:
+                problems.append(f'{post.slug} was not converted')
+                continue
+            entry = recorded.pop(post.slug)
+            if entry['fingerprint'] != digest:
+                problems.append(f'{post.slug} is out of date')
+            elif not post_dir.markdown_filename.exists():
+                problems.append(f'{post.slug} has no Markdown file')
+            else:
+                for url in entry['urls']:
+                    basename = post_dir.attachment_basename(url)
+                    if not (post_dir.path / basename).exists():
+                        problems.append(f'{post.slug} is missing {basename}')
+                merged.record(post.slug, digest, entry['urls'])
+    for slug in recorded:
+        problems.append(f'{slug} is not a published post in the export')
+    if not problems:
+        merged.save()
+    return problems
@@ -1,22 +1,106 @@
+import json
 import logging
+import os
 import re
+import tarfile
+import threading
 import urllib.parse
 import urllib.request
+import zipfile
 
+from concurrent.futures import Future
 from pathlib import Path, PurePath
+from typing import IO, Any, Mapping
 
-from .page import AttachmentParser, Page
+from .fetch import Downloader, default_timeout, save_response
+from .files import atomic_write
+from .page import AttachmentParser, ChunkFilter, Page
+from .wp import gallery_attachment_ids, image_attachment_ids
+
+
+def attachment_basename(url: str) -> str:
+    return PurePath(urllib.parse.urlparse(url).path).name
 
 
 def attachment_path(url: str) -> str:
-    return f'./{PurePath(urllib.parse.urlparse(url).path).name}'
+    return f'./{attachment_basename(url)}'
+
+
+# Hosts that resize images on request (e.g. `?w=1024`), as WordPress.com
+# and Jetpack's image CDN do
+resizing_hosts = ('.files.wordpress.com', '.wp.com')
+
+
+def sized_url(url: str, width: int | None) -> str:
+    """The URL of a copy of an image that's no wider than it needs to be"""
+    parts = urllib.parse.urlsplit(url)
+    if width is None or not parts.netloc.endswith(resizing_hosts):
+        return url
+    return parts._replace(query=f'w={width}').geturl()
+
+
+class Writer:
+    """Write files into the content directory with as few syscalls as we can
+
+    Directories are remembered once they've been created, so they're only
+    created once per run. A file whose content hasn't changed is left alone
+    (which also leaves its modification time alone, so tools that watch the
+    content directory don't rebuild it). Other files are written to a
+    temporary file and renamed into place, so a file is never left half
+    written.
+
+    Each conversion has a Writer of its own, as what it remembers about the
+    content directory only holds for the length of a run.
+
+    """
+
+    def __init__(self) -> None:
+        self.directories: set[Path] = set()
+        self.lock = threading.Lock()
+
+    def mkdir(self, path: Path) -> None:
+        if path in self.directories:
+            return
+        path.mkdir(exist_ok=True, parents=True)
+        with self.lock:
+            self.directories.add(path)
+
+    def unchanged(self, path: Path, data: bytes) -> bool:
+        try:
+            if path.stat().st_size != len(data):
+                return False
+            return path.read_bytes() == data
+        except FileNotFoundError:
+            return False
+
+    def write(self, path: Path, data: bytes) -> bool:
+        """Write a file, returning False if it already had that content"""
+        if self.unchanged(path, data):
+            return False
+        self.mkdir(path.parent)
+        try:
+            self.replace(path, data)
+        except FileNotFoundError:
+            # The directory has been removed since we created it
+            with self.lock:
+                self.directories.discard(path.parent)
+            self.mkdir(path.parent)
+            self.replace(path, data)
+        return True
+
+    def replace(self, path: Path, data: bytes) -> None:
+        with atomic_write(path) as file:
+            file.write(data)
 
 
 class PostDirectory:
-    def __init__(self, content_dir: Path, post: Page) -> None:
+    def __init__(
+        self, content_dir: Path, post: Page, writer: Writer | None = None
+    ) -> None:
         self.content_dir = content_dir
         self.post = post
         self.path = self.content_dir / post.slug
+        self.writer = writer or Writer()
 
     def escape_quotes(self, text: str) -> str:
         return '"' + text.replace('"', '\\"') + '"'
@@ -26,75 +110,483 @@ class PostDirectory:
         return (self.path / 'index').with_suffix('.md')
 
     def create_post_dir(self) -> None:
-        self.markdown_filename.parent.mkdir(exist_ok=True, parents=True)
-
-    def create_markdown(self) -> None:
-        self.create_post_dir()
+        self.writer.mkdir(self.path)
 
-        text = f"""---
-title: {self.escape_quotes(self.post.title)}
-pubDate: {self.post.pubDate}
-"""
+    def front_matter(self) -> list[str]:
+        lines = [
+            '---',
+            f'title: {self.escape_quotes(self.post.title)}',
+            f'pubDate: {self.post.pubDate}',
+        ]
         if self.post.tags:
-            text += '\n'.join(['tags:'] + [f'  - {t}' for t in self.post.tags])
-            text += '\n'
+            lines.append('tags:')
+            lines.extend(f'  - {tag}' for tag in self.post.tags)
         if self.post.thumbnail:
-            text += f'coverImage: {attachment_path(self.post.thumbnail)}\n'
+            lines.append(f'coverImage: {attachment_path(self.post.thumbnail)}')
+        lines.append('---')
+        return lines
 
-        text += f"""---
-{self.post.markdown}
-"""
-        with self.markdown_filename.open('w') as file:
-            file.write(text)
+    def markdown_text(self) -> str:
+        return '\n'.join([*self.front_matter(), self.post.markdown, ''])
+
+    def create_markdown(self, text: str | None = None) -> bool:
+        """Write the post's Markdown, unless the file is already up to date
+
+        The text of the file can be passed in, if it's already been rendered
+        (see `markdown_text()`).
+
+        """
+        if text is None:
+            text = self.markdown_text()
+        return self.writer.write(self.markdown_filename, text.encode('utf-8'))
 
     def attachment_basename(self, url: str) -> str:
-        return PurePath(urllib.parse.urlparse(url).path).name
+        return attachment_basename(url)
 
-    def save_image(self, url: str) -> None:
-        image_file = self.path / self.attachment_basename(url)
-        if image_file.exists():
+    def image_file(self, url: str) -> Path:
+        return self.path / self.attachment_basename(url)
+
+    def needs_fetching(
+        self, url: str, downloader: Downloader | None = None
+    ) -> bool:
+        if downloader and downloader.revalidates:
+            return True
+        if self.image_file(url).exists():
             logging.debug(f'Skipping {url} (file exists)')
-        else:
-            logging.info(f'Downloading {url}')
-            with open(image_file, 'wb') as f:
-                f.write(urllib.request.urlopen(url).read())
+            return False
+        return True
 
-    def fetch_attachments(self, attachment_urls: dict[str, str]) -> None:
-        self.create_post_dir()
-        logging.info(f'Fetching attachments for {self.post.slug}')
+    def save_image(
+        self, url: str, downloader: Downloader | None = None
+    ) -> Future | None:
+        """Fetch an attachment, returning the download if it's in progress"""
+        if not self.needs_fetching(url, downloader):
+            return None
+        if downloader:
+            return downloader.submit(url, self.image_file(url))
+        logging.info(f'Downloading {url}')
+        with urllib.request.urlopen(url, timeout=default_timeout) as response:
+            save_response(response, self.image_file(url))
+        return None
+
+    def attachment_urls(
+        self, attachment_urls: Mapping[str, str], sized: bool = False
+    ) -> list[str]:
+        """The URLs of the post's attachments
+
+        If `sized` is set, images that are only shown at a smaller size are
+        fetched at that size (where the host can resize them), rather than
+        at full size. They're saved under the same name either way.
+
+        """
+        urls = []
         if self.post.thumbnail:
-            self.save_image(self.post.thumbnail)
-        for attachment_id in self.post.attachment_ids:
+            urls.append(self.post.thumbnail)
+        for attachment_id, width in self.post.attachment_widths.items():
             try:
                 url = attachment_urls[attachment_id]
             except KeyError:
                 logging.warning(
                     f'Attachment missing from export: {attachment_id}'
                 )
-            else:
-                self.save_image(url)
+                continue
+            if url == self.post.thumbnail:
+                # The cover image is already listed, at full size
+                continue
+            if sized:
+                url = sized_url(url, width)
+            urls.append(url)
+        return urls
+
+    def save_images(
+        self,
+        urls: list[str],
+        downloader: Downloader | None = None,
+        journal: 'Journal | None' = None,
+    ) -> list[Future]:
+        self.create_post_dir()
+        logging.info(f'Fetching attachments for {self.post.slug}')
+        downloads = [self.save_image(url, downloader) for url in urls]
+        if journal is not None:
+            for url, download in zip(urls, downloads):
+                journal.track(self.post.slug, url, download)
+        return [future for future in downloads if future is not None]
+
+    def download_images(
+        self,
+        urls: list[str],
+        downloader: Downloader,
+        journal: 'Journal | None' = None,
+    ) -> list[Path]:
+        """Fetch attachments on this thread, rather than the downloader's
+
+        Returns the paths of the files that were downloaded.
+
+        """
+        self.create_post_dir()
+        logging.info(f'Fetching attachments for {self.post.slug}')
+        downloaded = []
+        for url in urls:
+            if not self.needs_fetching(url, downloader):
+                continue
+            error = downloader.download(url, self.image_file(url))
+            if error is None:
+                downloaded.append(self.image_file(url))
+            if journal is not None:
+                journal.fetched(self.post.slug, url, error)
+        return downloaded
+
+    def fetch_attachments(
+        self,
+        attachment_urls: Mapping[str, str],
+        downloader: Downloader | None = None,
+    ) -> None:
+        urls = self.attachment_urls(attachment_urls)
+        self.save_images(urls, downloader)
+
+
+class Manifest:
+    """Remember which posts have been written to the content directory
+
+    For each post we store a fingerprint of everything that went into
+    rendering it, along with the URLs of its attachments. If a post's
+    fingerprint hasn't changed since the last run (and its Markdown file is
+    still there) it doesn't need rendering again.
+
+    Only the posts recorded during this run are saved, so posts that are no
+    longer in the export drop out of the manifest.
+
+    A run that only converts some of the posts (see `wpsite.Shard`) keeps its
+    own manifest, under a different filename.
+
+    The manifest is saved through a Writer, like the rest of the content
+    directory.
+
+    """
+
+    filename = '.wpsite-manifest.json'
+    version = 1
+
+    def __init__(
+        self,
+        content_dir: Path,
+        reset: bool = False,
+        filename: str | None = None,
+        writer: Writer | None = None,
+    ) -> None:
+        self.path = content_dir / (filename or self.filename)
+        self.writer = writer or Writer()
+        self.previous = {} if reset else self.load()
+        self.posts: dict[str, dict[str, Any]] = {}
+
+    def __enter__(self) -> 'Manifest':
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.save()
+
+    def load(self) -> dict[str, dict[str, Any]]:
+        try:
+            data = json.loads(self.path.read_text())
+        except (OSError, ValueError):
+            return {}
+        if data.get('version') != self.version:
+            return {}
+        return data['posts']
+
+    def save(self) -> None:
+        data = {'version': self.version, 'posts': self.posts}
+        text = json.dumps(data, indent=1, sort_keys=True)
+        self.writer.write(self.path, text.encode('utf-8'))
+
+    def unchanged(
+        self, post_dir: PostDirectory, fingerprint: str
+    ) -> list[str] | None:
+        entry = self.previous.get(post_dir.post.slug)
+        if entry is None or entry['fingerprint'] != fingerprint:
+            return None
+        if not post_dir.markdown_filename.exists():
+            return None
+        return entry['urls']
+
+    def record(self, slug: str, fingerprint: str, urls: list[str]) -> None:
+        self.posts[slug] = {'fingerprint': fingerprint, 'urls': urls}
+
+
+class Journal:
+    """Record a run's progress as it happens, so that it can be resumed
+
+    The manifest is only saved at the end of a run, so if a run is killed we
+    can't tell which posts it finished. The journal is a file of JSON lines
+    that are written (and flushed) as each post is rendered, and as each of
+    its attachments is downloaded or fails to download. Attachments that are
+    skipped because they've already been downloaded aren't recorded, as
+    that would mean writing a line per attachment on every run.
+
+    A resumed run replays the journal. Posts that were rendered needn't be
+    parsed or rendered again, and only those of their attachments that
+    failed, or that were still being fetched (and haven't since appeared on
+    disk), are downloaded. The journal is
+    deleted at the end of a run, unless some downloads failed (in which case
+    resuming again will retry them).
+
+    """
+
+    filename = '.wpsite-journal.jsonl'
+
+    def __init__(
+        self,
+        content_dir: Path,
+        resume: bool = False,
+        filename: str | None = None,
+    ) -> None:
+        self.content_dir = content_dir
+        self.path = content_dir / (filename or self.filename)
+        self.resume = resume
+        self.posts: dict[str, dict[str, Any]] = {}
+        self.downloaded: set[str] = set()
+        self.failures: dict[str, dict[str, str]] = {}
+        self.lock = threading.Lock()
+        self.file: IO[str] | None = None
+        if resume:
+            self.replay()
+
+    def __enter__(self) -> 'Journal':
+        self.path.parent.mkdir(exist_ok=True, parents=True)
+        self.file = self.path.open('a' if self.resume else 'w')
+        return self
+
+    def __exit__(self, exc_type: type | None, *exc_info: Any) -> None:
+        if self.file is not None:
+            self.file.close()
+        if exc_type is None and not self.failures:
+            self.path.unlink(missing_ok=True)
+
+    def replay(self) -> None:
+        try:
+            lines = self.path.read_text().splitlines()
+        except FileNotFoundError:
+            return
+        for line in lines:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # The last line is cut short if the run was killed mid-write
+                continue
+            self.apply(entry)
+
+    def apply(self, entry: dict[str, Any]) -> None:
+        if 'post' in entry:
+            slug = entry['post']
+            self.posts[slug] = {
+                'fingerprint': entry['fingerprint'],
+                'urls': entry['urls'],
+            }
+        elif 'downloaded' in entry:
+            self.downloaded.add(entry['downloaded'])
+            self.failures.pop(entry['downloaded'], None)
+        elif 'failed' in entry:
+            self.downloaded.discard(entry['failed'])
+            self.failures[entry['failed']] = {
+                'url': entry['url'],
+                'error': entry['error'],
+            }
+
+    def append(self, entry: dict[str, Any]) -> None:
+        with self.lock:
+            self.apply(entry)
+            if self.file is not None:
+                self.file.write(json.dumps(entry) + '\n')
+                self.file.flush()
+
+    def attachment(self, slug: str, url: str) -> str:
+        return f'{slug}/{attachment_basename(url)}'
+
+    def rendered(self, slug: str, fingerprint: str, urls: list[str]) -> None:
+        self.append({'post': slug, 'fingerprint': fingerprint, 'urls': urls})
+
+    def fetched(self, slug: str, url: str, error: Exception | None) -> None:
+        attachment = self.attachment(slug, url)
+        if error is None:
+            self.append({'downloaded': attachment})
+        else:
+            self.append(
+                {'failed': attachment, 'url': url, 'error': str(error)}
+            )
+
+    def track(self, slug: str, url: str, download: Future | None) -> None:
+        """Record the outcome of a download, if it wasn't skipped"""
+        if download is not None:
+            download.add_done_callback(
+                lambda future: self.fetched(slug, url, future.result())
+            )
 
+    def unfinished(self, slug: str) -> list[str]:
+        """The URLs of a rendered post's attachments that might need fetching
 
-class HostedImageFilter:
-    def __init__(self, attachments: dict[str, str]) -> None:
+        Attachments that were skipped aren't in the journal, so the caller
+        should check whether the files are already there.
+
+        """
+        urls = self.posts[slug]['urls']
+        done = self.downloaded
+        return [url for url in urls if self.attachment(slug, url) not in done]
+
+    def failure_report(self) -> list[str]:
+        return [
+            f'{failure["url"]} ({attachment}): {failure["error"]}'
+            for attachment, failure in sorted(self.failures.items())
+        ]
+
+
+archive_suffixes = {
+    '.tar': 'tar',
+    '.tar.gz': 'tar.gz',
+    '.tgz': 'tar.gz',
+    '.tar.bz2': 'tar.bz2',
+    '.tar.xz': 'tar.xz',
+    '.zip': 'zip',
+}
+
+tar_modes: dict[str, str] = {
+    'tar': 'w|',
+    'tar.gz': 'w|gz',
+    'tar.bz2': 'w|bz2',
+    'tar.xz': 'w|xz',
+}
+
+
+def archive_format(path: Path) -> str:
+    for suffix, format in archive_suffixes.items():
+        if path.name.endswith(suffix):
+            return format
+    raise ValueError(f"Don't know how to archive to {path.name}")
+
+
+def archived_files(content_dir: Path) -> list[Path]:
+    # The manifests and journals only make sense alongside the content
+    # directory that they describe, so they're left out.
+    prefixes = tuple(
+        Path(filename).stem
+        for filename in [Manifest.filename, Journal.filename]
+    )
+    return sorted(
+        path
+        for path in content_dir.rglob('*')
+        if path.is_file()
+        and not path.name.startswith(prefixes)
+        and not path.name.endswith('.part')
+    )
+
+
+def write_archive(
+    content_dir: Path, file: IO[bytes], format: str = 'tar'
+) -> int:
+    """Copy the content directory into a tar or zip archive
+
+    The archive is streamed, so `file` can be a pipe or a socket (e.g. to
+    ship the site to a build server). Images are already compressed, so
+    only the Markdown is compressed in a zip archive. Returns the number of
+    files that were archived.
+
+    """
+    paths = archived_files(content_dir)
+    if format == 'zip':
+        with zipfile.ZipFile(file, 'w') as zip_archive:
+            for path in paths:
+                zip_archive.write(
+                    path,
+                    path.relative_to(content_dir).as_posix(),
+                    zipfile.ZIP_DEFLATED
+                    if path.suffix == '.md'
+                    else zipfile.ZIP_STORED,
+                )
+    else:
+        with tarfile.open(fileobj=file, mode=tar_modes[format]) as archive:
+            for path in paths:
+                archive.add(path, path.relative_to(content_dir).as_posix())
+    return len(paths)
+
+
+class HostedImageFilter(ChunkFilter):
+    """Point hosted images at the copies we download
+
+    The post's attachment URLs are all replaced in a single scan through the
+    text. Attachments tend to share a host and a path prefix, so we search for the
+    longest prefix that they all have in common, and then look up the text
+    that follows each occurrence of it, trying the longest URLs first. That's
+    much cheaper than compiling a pattern that contains every URL. URLs are
+    matched literally, whether they're served over HTTP or HTTPS, and any
+    query string (e.g. image size parameters) is removed.
+
+    When it's run by a FilterEngine the images are found with a quick search
+    for the IDs in <img> classes (and in galleries that haven't been expanded
+    yet) rather than by parsing the HTML, and the filter is triggered by the
+    common prefix.
+
+    """
+
+    query_string = re.compile(r'\?[^"]+')
+
+    def __init__(self, attachments: Mapping[str, str]) -> None:
         self.attachments = attachments
+        self.paths: dict[str, str] = {}
+        self.prefix = ''
+        self.lengths: list[int] = []
 
     def __call__(self, text: str) -> str:
-        self.text = text
-        parser = AttachmentParser(self.replace_url)
+        self.paths = {}
+        parser = AttachmentParser(self.record_url)
         parser.feed(text)
         parser.close()
-        return self.text
+        return self.apply(text) if self.index() else text
+
+    def trigger(self, text: str) -> re.Pattern | None:
+        self.paths = {}
+        # GalleryFilter quietly leaves out images that aren't in the export
+        ids = set(image_attachment_ids(text))
+        ids.update(
+            attachment_id
+            for attachment_id in gallery_attachment_ids(text)
+            if attachment_id in self.attachments
+        )
+        for attachment_id in sorted(ids):
+            self.record_url(attachment_id)
+        return re.compile(re.escape(self.prefix)) if self.index() else None
+
+    def index(self) -> bool:
+        self.prefix = os.path.commonprefix(list(self.paths))
+        self.lengths = sorted({len(url) for url in self.paths}, reverse=True)
+        return bool(self.paths)
 
-    def replace_url(self, attachment_id: str) -> None:
+    def apply(self, chunk: str) -> str:
+        output = []
+        copied = 0
+        start = chunk.find(self.prefix)
+        while start != -1:
+            for length in self.lengths:
+                url = chunk[start : start + length]
+                if url in self.paths:
+                    end = start + length
+                    if query := self.query_string.match(chunk, end):
+                        end = query.end()
+                    output.append(chunk[copied:start])
+                    output.append(self.paths[url])
+                    copied = end
+                    break
+            else:
+                end = start + 1
+            start = chunk.find(self.prefix, end)
+        output.append(chunk[copied:])
+        return ''.join(output)
+
+    def record_url(self, attachment_id: str) -> None:
         try:
             url = self.attachments[attachment_id]
         except KeyError:
             logging.warning(f'Attachment missing from export: {attachment_id}')
         else:
-            multiprotocol_url = url.replace('https://', 'https?://')
-            self.text = re.sub(
-                rf'{multiprotocol_url}(\?[^"]+)?',
-                attachment_path(url),
-                self.text,
-            )
+            path = attachment_path(url)
+            self.paths[url] = path
+            if url.startswith('https://'):
+                self.paths[url.replace('https://', 'http://', 1)] = path
@@ -0,0 +1,206 @@
+import array
+import bisect
+import hashlib
+import io
+import mmap
+import struct
+import typing
+
+from collections.abc import Iterator, Mapping
+from pathlib import Path
+
+from .files import atomic_write
+
+
+class AttachmentIndex(Mapping[str, str]):
+    """Map attachment IDs to their URLs, without a string object per URL
+
+    A site can have hundreds of thousands of attachments, and a dict of their
+    URLs takes hundreds of megabytes, all of which would be pickled into each
+    worker process. Instead, the IDs are stored as a sorted array of integers,
+    and each URL is split into a prefix (everything up to the last `/`) and a
+    basename. Prefixes are shared by many URLs, so each one is only stored
+    once, in the same table of UTF-8 strings as the basenames.
+
+    The whole index lives in a single buffer, which can be saved to disk and
+    then memory-mapped (see `open()`), so that several processes can share
+    one copy of it. An index that's been opened from a file is pickled as its
+    path.
+
+    A saved index is only valid for the export it was built from, so the
+    header records a digest of the export's attachments (see `Builder`),
+    which can be compared with the digest of the export being converted.
+
+    Layout of the buffer (native byte order):
+
+        header      magic, version, entry count, string count, digest
+        ids         int64 per entry, in ascending order
+        offsets     uint64 per string, plus one for the end of the table
+        prefixes    uint32 per entry; the index of its prefix string
+        basenames   uint32 per entry; the index of its basename string
+        strings     the UTF-8 encoded strings, one after the other
+
+    """
+
+    magic = b'WPAI'
+    version = 2
+    header = struct.Struct('=4sIQQ16s')
+
+    def __init__(self, buffer: bytes | mmap.mmap, path: Path | None = None):
+        self.buffer = buffer
+        self.path = path
+        try:
+            (
+                magic,
+                version,
+                count,
+                num_strings,
+                self.digest,
+            ) = self.header.unpack_from(buffer)
+        except struct.error:
+            raise ValueError('Not an attachment index') from None
+        if magic != self.magic or version != self.version:
+            raise ValueError('Not an attachment index')
+        view = memoryview(buffer)
+        position = self.header.size
+
+        def take(
+            format: typing.Literal['q', 'Q', 'I'], length: int
+        ) -> memoryview:
+            nonlocal position
+            size = struct.calcsize(format) * length
+            section = view[position : position + size].cast(format)
+            position += size
+            return section
+
+        self.ids = take('q', count)
+        self.offsets = take('Q', num_strings + 1)
+        self.prefixes = take('I', count)
+        self.basenames = take('I', count)
+        self.strings = view[position:]
+
+    @classmethod
+    def open(cls, path: Path) -> 'AttachmentIndex':
+        with path.open('rb') as file:
+            buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(buffer, path)
+
+    @classmethod
+    def from_dict(cls, urls: Mapping[str, str]) -> 'AttachmentIndex':
+        builder = Builder()
+        for attachment_id, url in urls.items():
+            builder.add(attachment_id, url)
+        return builder.build()
+
+    def __reduce__(self) -> tuple[typing.Any, ...]:
+        if self.path is not None:
+            return (type(self).open, (self.path,))
+        return (type(self), (bytes(self.buffer),))
+
+    def position(self, attachment_id: str) -> int:
+        try:
+            number = int(attachment_id)
+        except ValueError:
+            raise KeyError(attachment_id) from None
+        i = bisect.bisect_left(self.ids, number)
+        if i == len(self.ids) or self.ids[i] != number:
+            raise KeyError(attachment_id)
+        return i
+
+    def string(self, i: int) -> str:
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return str(self.strings[start:end], 'utf-8')
+
+    def __getitem__(self, attachment_id: str) -> str:
+        i = self.position(attachment_id)
+        return self.string(self.prefixes[i]) + self.string(self.basenames[i])
+
+    def __iter__(self) -> Iterator[str]:
+        return (str(attachment_id) for attachment_id in self.ids)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def save(self, path: Path) -> None:
+        # Other processes might be reading an index saved at the same path
+        # (e.g. one shared by several shards), and several shards might save
+        # it at once, so each one writes its own temporary file and replaces
+        # the index atomically.
+        with atomic_write(path) as file:
+            file.write(self.buffer)
+
+
+class Builder:
+    """Collect attachment URLs, and write them out as an AttachmentIndex
+
+    If an ID is added more than once, the last URL wins (as it would in a
+    dict). IDs that aren't integers are ignored, as WordPress doesn't use
+    them.
+
+    Every attachment that's added (or just noted, with `note()`) is fed into
+    a digest, in the order they're seen, so that an index can be matched to
+    the export it was built from.
+
+    """
+
+    def __init__(self) -> None:
+        self.ids = array.array('q')
+        self.prefixes = array.array('I')
+        self.basenames = array.array('I')
+        self.offsets = array.array('Q', [0])
+        self.strings = bytearray()
+        self.interned: dict[str, int] = {}
+        self.hash = hashlib.blake2b(digest_size=16)
+
+    def note(self, attachment_id: str, url: str) -> None:
+        self.hash.update(f'{attachment_id}\0{url}\0'.encode('utf-8'))
+
+    def add(self, attachment_id: str, url: str) -> None:
+        self.note(attachment_id, url)
+        try:
+            number = int(attachment_id)
+        except ValueError:
+            return
+        split = url.rfind('/') + 1
+        self.ids.append(number)
+        self.prefixes.append(self.intern(url[:split]))
+        self.basenames.append(self.store(url[split:]))
+
+    def intern(self, prefix: str) -> int:
+        try:
+            return self.interned[prefix]
+        except KeyError:
+            i = self.interned[prefix] = self.store(prefix)
+            return i
+
+    def store(self, text: str) -> int:
+        self.strings += text.encode('utf-8')
+        self.offsets.append(len(self.strings))
+        return len(self.offsets) - 2
+
+    def sorted_entries(self) -> list[int]:
+        # Positions of the entries in order of ID, keeping only the last
+        # entry for each ID.
+        latest = {number: i for i, number in enumerate(self.ids)}
+        return [latest[number] for number in sorted(latest)]
+
+    def write(self, file: typing.BinaryIO) -> None:
+        entries = self.sorted_entries()
+        header = AttachmentIndex.header.pack(
+            AttachmentIndex.magic,
+            AttachmentIndex.version,
+            len(entries),
+            len(self.offsets) - 1,
+            self.hash.digest(),
+        )
+        file.write(header)
+        array.array('q', [self.ids[i] for i in entries]).tofile(file)
+        self.offsets.tofile(file)
+        array.array('I', [self.prefixes[i] for i in entries]).tofile(file)
+        array.array('I', [self.basenames[i] for i in entries]).tofile(file)
+        file.write(self.strings)
+
+    def build(self) -> AttachmentIndex:
+        file = io.BytesIO()
+        self.write(file)
+        return AttachmentIndex(file.getvalue())
@@ -0,0 +1,601 @@
+import contextlib
+import dataclasses
+import email.utils
+import hashlib
+import http.client
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+import urllib.parse
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import IO, Any, Iterator, Protocol
+
+from .files import atomic_write
+from .profiling import Profiler
+
+
+class DownloadError(Exception):
+    pass
+
+
+class IncompleteDownload(DownloadError):
+    pass
+
+
+class HTTPStatusError(DownloadError):
+    def __init__(
+        self, url: str, status: int, retry_after: float | None = None
+    ) -> None:
+        super().__init__(f'HTTP {status} fetching {url}')
+        self.status = status
+        self.retry_after = retry_after
+
+    @property
+    def throttled(self) -> bool:
+        return self.status in (429, 503)
+
+
+def retry_after(value: str | None) -> float | None:
+    """Parse a Retry-After header (seconds, or an HTTP date)"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, when.timestamp() - time.time())
+
+
+class Response(Protocol):
+    def read(self, amt: int) -> bytes:
+        ...
+
+    def getheader(self, name: str) -> str | None:
+        ...
+
+
+class Hash(Protocol):
+    def update(self, data: bytes, /) -> None:
+        ...
+
+
+chunk_size = 64 * 1024
+
+# Seconds to wait for a server to connect or send more of a response
+default_timeout = 30
+
+
+def save_response(
+    response: Response,
+    path: Path,
+    verify_length: bool = True,
+    hash: Hash | None = None,
+) -> int:
+    """Stream the body of a response into a file
+
+    The body is written, a chunk at a time, to a temporary file alongside
+    `path`, which is renamed once the download is complete. So only one chunk
+    of the file is held in memory, and the file only appears at `path` if
+    it's been downloaded in full.
+
+    If a hash object is passed, it's updated with each chunk as it's written.
+
+    """
+    expected = response.getheader('Content-Length')
+    with atomic_write(path) as partial:
+        size = copy_body(response, partial, hash)
+        if verify_length and expected is not None and int(expected) != size:
+            raise IncompleteDownload(
+                f'Received {size} of {expected} bytes for {path.name}'
+            )
+    return size
+
+
+def copy_body(
+    response: Response, file: IO[bytes], hash: Hash | None = None
+) -> int:
+    size = 0
+    with file:
+        while chunk := response.read(chunk_size):
+            file.write(chunk)
+            if hash is not None:
+                hash.update(chunk)
+            size += len(chunk)
+    return size
+
+
+def link_or_copy(source: Path, path: Path) -> None:
+    partial = path.with_name(f'.{path.name}.{threading.get_ident()}.link')
+    try:
+        os.link(source, partial)
+    except OSError:
+        shutil.copyfile(source, partial)
+    os.replace(partial, path)
+
+
+class Cache:
+    """Keep a copy of every file we download, to share between runs
+
+    Files are stored by the SHA-256 of their content, so a file that's
+    attached to several posts (or under several URLs) is only stored once.
+    The cached files are hard linked into the post directories (or copied,
+    if the file system doesn't support hard links).
+
+    The index maps each URL to the digest of its content, along with the
+    ETag and Last-Modified headers the server sent with it. We use them to
+    ask the server whether the file has changed, so that files are only
+    downloaded again if they need to be. Each URL is checked once per run.
+
+    Several runs can share a cache (e.g. shards converted on the same host).
+    When the index is saved, the entries this run stored are merged into the
+    index on disk, rather than replacing the entries that other runs saved
+    in the meantime.
+
+    """
+
+    index_filename = 'index.json'
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.index_file = path / self.index_filename
+        self.objects = path / 'objects'
+        self.index = self.load()
+        self.stored: dict[str, dict[str, str]] = {}
+        self.checked: set[str] = set()
+        self.lock = threading.Lock()
+        self.url_locks: dict[str, threading.Lock] = {}
+
+    def load(self) -> dict[str, dict[str, str]]:
+        try:
+            return json.loads(self.index_file.read_text())
+        except (OSError, ValueError):
+            return {}
+
+    def save(self) -> None:
+        self.path.mkdir(exist_ok=True, parents=True)
+        with self.lock:
+            self.index = self.load()
+            self.index.update(self.stored)
+            text = json.dumps(self.index, indent=1)
+        with atomic_write(self.index_file) as file:
+            file.write(text.encode())
+
+    def url_lock(self, url: str) -> threading.Lock:
+        with self.lock:
+            return self.url_locks.setdefault(url, threading.Lock())
+
+    def object_path(self, digest: str) -> Path:
+        return self.objects / digest[:2] / digest
+
+    def lookup(self, url: str) -> Path | None:
+        entry = self.index.get(url)
+        if entry is None:
+            return None
+        path = self.object_path(entry['digest'])
+        return path if path.exists() else None
+
+    def is_checked(self, url: str) -> bool:
+        return url in self.checked and self.lookup(url) is not None
+
+    def validators(self, url: str) -> dict[str, str]:
+        entry = self.index.get(url)
+        if entry is None or self.lookup(url) is None:
+            return {}
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def revalidated(self, url: str) -> None:
+        self.checked.add(url)
+
+    def store(
+        self, url: str, response: Response, verify_length: bool = True
+    ) -> int:
+        self.objects.mkdir(exist_ok=True, parents=True)
+        partial = self.objects / f'.{os.getpid()}.{threading.get_ident()}.part'
+        hash = hashlib.sha256()
+        size = save_response(response, partial, verify_length, hash)
+        digest = hash.hexdigest()
+        path = self.object_path(digest)
+        path.parent.mkdir(exist_ok=True)
+        os.replace(partial, path)
+        entry = {'digest': digest}
+        for key, header in [
+            ('etag', 'ETag'),
+            ('last_modified', 'Last-Modified'),
+        ]:
+            value = response.getheader(header)
+            if value:
+                entry[key] = value
+        with self.lock:
+            self.index[url] = self.stored[url] = entry
+            self.checked.add(url)
+        return size
+
+    def link(self, url: str, path: Path) -> None:
+        source = self.lookup(url)
+        if source is None:
+            raise DownloadError(f'{url} is missing from the cache')
+        link_or_copy(source, path)
+
+
+Connection = http.client.HTTPConnection
+
+
+class ConnectionPool:
+    """Keep a connection to each host open, for each thread
+
+    http.client connections aren't thread safe, so every thread gets its own
+    set of connections. A connection is reused for as long as the server is
+    happy to keep it alive.
+
+    """
+
+    def __init__(self, timeout: float) -> None:
+        self.timeout = timeout
+        self.local = threading.local()
+
+    @property
+    def connections(self) -> dict[tuple[str, str], Connection]:
+        if not hasattr(self.local, 'connections'):
+            self.local.connections = {}
+        return self.local.connections
+
+    def connect(self, scheme: str, netloc: str) -> Connection:
+        if scheme == 'https':
+            return http.client.HTTPSConnection(netloc, timeout=self.timeout)
+        return http.client.HTTPConnection(netloc, timeout=self.timeout)
+
+    def request(
+        self, url: str, headers: dict[str, str] = {}
+    ) -> http.client.HTTPResponse:
+        parts = urllib.parse.urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += f'?{parts.query}'
+        key = (parts.scheme, parts.netloc)
+        reused = key in self.connections
+        if not reused:
+            self.connections[key] = self.connect(*key)
+        try:
+            return self.send(self.connections[key], path, headers)
+        except (http.client.HTTPException, OSError):
+            self.close(key)
+            if not reused:
+                raise
+        # The server may have closed an idle connection; try a fresh one
+        self.connections[key] = self.connect(*key)
+        try:
+            return self.send(self.connections[key], path, headers)
+        except (http.client.HTTPException, OSError):
+            self.close(key)
+            raise
+
+    def send(
+        self, conn: Connection, path: str, headers: dict[str, str]
+    ) -> http.client.HTTPResponse:
+        conn.request('GET', path, headers=headers)
+        return conn.getresponse()
+
+    def close(self, key: tuple[str, str]) -> None:
+        self.connections.pop(key).close()
+
+
+@dataclasses.dataclass
+class Host:
+    limit: float
+    tokens: float
+    active: int = 0
+    refilled: float = 0.0
+    paused_until: float = 0.0
+    decreased: float = 0.0
+
+
+class HostLimiter:
+    """Share requests out between hosts, without overloading any of them
+
+    Each host has a limit on the number of requests we make to it at once,
+    which adapts to what the host will tolerate (AIMD, as used by TCP). Each
+    successful request raises the limit a little (by 1/limit, so it rises by
+    about one each time the limit's worth of requests succeed), up to
+    `maximum`. When a host throttles us (with a 429 or 503) the limit is
+    halved, unless the throttled request was sent before the limit was last
+    lowered (it was sent too soon, so it tells us nothing new). If the host
+    says when to try again (with Retry-After), no requests are made to it
+    until then.
+
+    If a rate is given, each host also has a token bucket, which allows
+    `rate` requests per second, in bursts of up to `burst` requests.
+
+    """
+
+    def __init__(
+        self,
+        maximum: int,
+        initial: int = 2,
+        rate: float | None = None,
+        burst: int = 1,
+    ) -> None:
+        self.maximum = maximum
+        self.initial = min(initial, maximum)
+        self.rate = rate
+        self.burst = burst
+        self.hosts: dict[str, Host] = {}
+        self.condition = threading.Condition()
+
+    def host(self, name: str) -> Host:
+        if name not in self.hosts:
+            self.hosts[name] = Host(
+                self.initial, self.burst, refilled=time.monotonic()
+            )
+        return self.hosts[name]
+
+    def wait_time(self, host: Host, now: float) -> float | None:
+        """How long until a request can be made (None if we need a slot)"""
+        if host.paused_until > now:
+            return host.paused_until - now
+        if host.active >= int(host.limit):
+            return None
+        if self.rate is not None:
+            elapsed = now - host.refilled
+            host.tokens = min(self.burst, host.tokens + elapsed * self.rate)
+            host.refilled = now
+            if host.tokens < 1:
+                return (1 - host.tokens) / self.rate
+        return 0.0
+
+    def acquire(self, name: str) -> None:
+        with self.condition:
+            host = self.host(name)
+            while (wait := self.wait_time(host, time.monotonic())) != 0:
+                self.condition.wait(wait)
+            host.active += 1
+            if self.rate is not None:
+                host.tokens -= 1
+
+    def release(self, name: str) -> None:
+        with self.condition:
+            self.hosts[name].active -= 1
+            self.condition.notify_all()
+
+    def succeeded(self, name: str) -> None:
+        with self.condition:
+            host = self.host(name)
+            host.limit = min(self.maximum, host.limit + 1 / host.limit)
+            self.condition.notify_all()
+
+    def throttled(
+        self, name: str, sent: float, retry_after: float | None = None
+    ) -> None:
+        with self.condition:
+            host = self.host(name)
+            now = time.monotonic()
+            if sent >= host.decreased:
+                host.limit = max(1.0, host.limit / 2)
+                host.decreased = now
+            if retry_after is not None:
+                host.paused_until = max(host.paused_until, now + retry_after)
+        logging.debug(
+            f'{name} is throttling requests (limit {host.limit:.1f})'
+        )
+
+    @contextlib.contextmanager
+    def request(self, url: str) -> Iterator[str]:
+        """Wait until a request can be made to a URL's host"""
+        name = urllib.parse.urlsplit(url).netloc
+        self.acquire(name)
+        try:
+            yield name
+        finally:
+            self.release(name)
+
+
+@dataclasses.dataclass
+class Summary:
+    files: int = 0
+    bytes: int = 0
+    cached: int = 0
+    failures: int = 0
+    seconds: float = 0.0
+
+    @property
+    def throughput(self) -> float:
+        return self.bytes / self.seconds if self.seconds else 0.0
+
+    def __str__(self) -> str:
+        megabytes = self.bytes / 1024 / 1024
+        rate = self.throughput / 1024 / 1024
+        return (
+            f'Downloaded {self.files} files ({megabytes:.1f} MB) '
+            f'in {self.seconds:.1f}s ({rate:.2f} MB/s), '
+            f'{self.cached} from cache, {self.failures} failed'
+        )
+
+
+class Downloader:
+    """Download files on a pool of threads
+
+    Files are fetched over persistent connections (one per host, in each
+    thread). Connection errors, timeouts and server errors are retried,
+    waiting a little longer before each new attempt.
+
+    Failed downloads are logged, and don't interrupt other downloads. The
+    future returned by `submit()` holds the error, if the download failed.
+
+    Requests to each host are paced by a HostLimiter, which backs off when
+    the host throttles us (honouring Retry-After), and lets more requests
+    through at once while it doesn't. `rate` limits the number of requests
+    per second made to each host.
+
+    If a cache is given, files are served from it when the server confirms
+    they haven't changed.
+
+    """
+
+    redirects = {301, 302, 303, 307, 308}
+    max_redirects = 5
+
+    def __init__(
+        self,
+        workers: int = 4,
+        timeout: float = default_timeout,
+        retries: int = 3,
+        backoff: float = 1,
+        verify_length: bool = True,
+        cache: Cache | None = None,
+        profiler: Profiler | None = None,
+        rate: float | None = None,
+    ) -> None:
+        self.cache = cache
+        self.profiler = profiler
+        self.retries = retries
+        self.verify_length = verify_length
+        self.backoff = backoff
+        self.pool = ConnectionPool(timeout)
+        self.limiter = HostLimiter(workers, rate=rate)
+        self.executor = ThreadPoolExecutor(workers)
+        self.summary = Summary()
+        self.lock = threading.Lock()
+        # The clock starts with the first download, so that the throughput
+        # doesn't count the time spent parsing and rendering before it.
+        self.started: float | None = None
+
+    def __enter__(self) -> 'Downloader':
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.wait()
+
+    def submit(self, url: str, path: Path) -> Future:
+        return self.executor.submit(self.download, url, path)
+
+    def wait(self) -> Summary:
+        self.executor.shutdown()
+        if self.started is not None:
+            self.summary.seconds = time.monotonic() - self.started
+        if self.cache:
+            self.cache.save()
+        return self.summary
+
+    @property
+    def revalidates(self) -> bool:
+        return self.cache is not None
+
+    def download(self, url: str, path: Path) -> Exception | None:
+        """Download a file, returning the error if it couldn't be fetched"""
+        started = time.perf_counter()
+        with self.lock:
+            if self.started is None:
+                self.started = time.monotonic()
+        for attempt in range(self.retries + 1):
+            try:
+                size = self.fetch(url, path)
+            except HTTPStatusError as e:
+                if e.status < 500 and e.status != 429:
+                    return self.failed(url, e, started)
+                error: Exception = e
+            except (
+                IncompleteDownload,
+                http.client.HTTPException,
+                OSError,
+            ) as e:
+                # A connection that drops partway through the body is
+                # usually worth another go
+                error = e
+            except DownloadError as e:
+                return self.failed(url, e, started)
+            else:
+                with self.lock:
+                    self.summary.files += 1
+                    self.summary.bytes += size
+                if self.profiler:
+                    elapsed = time.perf_counter() - started
+                    self.profiler.record('download', elapsed, size)
+                return None
+            if attempt < self.retries:
+                logging.debug(f'Retrying {url} ({error})')
+                # The limiter holds back requests to a host that's told us
+                # when to come back, so there's no need to wait here too
+                if not isinstance(error, HTTPStatusError) or (
+                    error.retry_after is None
+                ):
+                    time.sleep(self.backoff * 2**attempt)
+        return self.failed(url, error, started)
+
+    def failed(self, url: str, error: Exception, started: float) -> Exception:
+        logging.warning(f"Couldn't download {url}: {error}")
+        with self.lock:
+            self.summary.failures += 1
+        # Failures can take a while (timeouts, retries and backing off), so
+        # they're profiled too, but separately from successful downloads
+        if self.profiler:
+            elapsed = time.perf_counter() - started
+            self.profiler.record('download (failed)', elapsed)
+        return error
+
+    def fetch(self, url: str, path: Path) -> int:
+        if self.cache is None:
+            return self.get(url, path)
+        with self.cache.url_lock(url):
+            if not self.cache.is_checked(url):
+                return self.get(url, path)
+        logging.debug(f'Copying {url} from cache')
+        self.cache.link(url, path)
+        self.count_cached()
+        return 0
+
+    def count_cached(self) -> None:
+        with self.lock:
+            self.summary.cached += 1
+
+    def get(self, original_url: str, path: Path) -> int:
+        cache = self.cache
+        headers = cache.validators(original_url) if cache else {}
+        url = original_url
+        logging.info(f'Downloading {url}')
+        for _ in range(self.max_redirects + 1):
+            with self.limiter.request(url) as host:
+                sent = time.monotonic()
+                response = self.pool.request(url, headers)
+                if response.status == 200 and cache:
+                    size = cache.store(
+                        original_url, response, self.verify_length
+                    )
+                    cache.link(original_url, path)
+                    self.limiter.succeeded(host)
+                    return size
+                if response.status == 200:
+                    size = save_response(response, path, self.verify_length)
+                    self.limiter.succeeded(host)
+                    return size
+                response.read()
+            if response.status == 304 and cache:
+                cache.revalidated(original_url)
+                cache.link(original_url, path)
+                self.limiter.succeeded(host)
+                self.count_cached()
+                return 0
+            if response.status not in self.redirects:
+                error = HTTPStatusError(
+                    url,
+                    response.status,
+                    retry_after(response.getheader('Retry-After')),
+                )
+                if error.throttled:
+                    self.limiter.throttled(host, sent, error.retry_after)
+                raise error
+            location = response.getheader('Location', '')
+            url = urllib.parse.urljoin(url, location)
+        raise DownloadError(f'Too many redirects fetching {url}')
@@ -0,0 +1,28 @@
+import contextlib
+import os
+import tempfile
+
+from pathlib import Path
+from typing import IO, Iterator
+
+
+@contextlib.contextmanager
+def atomic_write(path: Path) -> Iterator[IO[bytes]]:
+    """Write a file under a temporary name, then rename it into place
+
+    The temporary file is created alongside `path` with a name of its own, so
+    several threads (or processes) can write the same file at once, and
+    readers only ever see a complete file. If the block raises, the
+    temporary file is removed and `path` is left as it was.
+
+    """
+    partial = tempfile.NamedTemporaryFile(
+        dir=path.parent, prefix=f'.{path.name}.', suffix='.part', delete=False
+    )
+    try:
+        with partial:
+            yield partial
+        os.replace(partial.name, path)
+    except BaseException:
+        os.unlink(partial.name)
+        raise
@@ -0,0 +1,234 @@
+import dataclasses
+import hashlib
+import io
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+from concurrent.futures import Future, wait
+from pathlib import Path
+from typing import Any
+
+from .fetch import link_or_copy
+from .files import atomic_write
+from .pipeline import spawn_pool
+
+try:
+    from PIL import ExifTags, Image, ImageOps, features
+except ImportError:  # Pillow is optional; it's only needed to optimize images
+    Image = None  # type: ignore[assignment]
+
+# Image metadata that's of no use on a web page (colour profiles are kept)
+metadata_keys = ('exif', 'xmp', 'XML:com.adobe.xmp', 'photoshop', 'comment')
+
+
+@dataclasses.dataclass(frozen=True)
+class Settings:
+    """How to optimize images
+
+    Images that are wider or taller than `max_dimension` are scaled down to
+    fit, and their metadata is stripped. A copy of each image is also saved
+    in each of `formats` (e.g. 'webp' or 'avif'), next to the original.
+
+    """
+
+    max_dimension: int = 2048
+    formats: tuple[str, ...] = ()
+    quality: int = 80
+
+    def check(self) -> None:
+        if Image is None:
+            raise ValueError('Optimizing images requires Pillow')
+        for format in self.formats:
+            if not features.check(format):
+                raise ValueError(f"Pillow can't save {format.upper()} files")
+
+
+def variant_path(path: Path, format: str) -> Path:
+    # The format is appended (e.g. photo.jpg.webp), as replacing the suffix
+    # would give photo.jpg and photo.png in the same post the same variant.
+    return path.with_name(f'{path.name}.{format}')
+
+
+def encode(image: 'Image.Image', format: str, **options: Any) -> bytes:
+    output = io.BytesIO()
+    image.save(output, format, **options)
+    return output.getvalue()
+
+
+def web_colours(image: 'Image.Image') -> 'Image.Image':
+    if image.mode in ('RGB', 'RGBA'):
+        return image
+    transparent = image.mode in ('LA', 'PA') or 'transparency' in image.info
+    return image.convert('RGBA' if transparent else 'RGB')
+
+
+def process(data: bytes, settings: Settings) -> dict[str, bytes]:
+    """Optimize an image, returning the files to save, keyed by format
+
+    The optimized original is keyed by 'original', and is left out if it
+    wouldn't be any different. Images that Pillow can't read (such as SVGs)
+    and animations are left alone.
+
+    """
+    try:
+        image = Image.open(io.BytesIO(data))
+    except Image.UnidentifiedImageError:
+        return {}
+    with image:
+        if getattr(image, 'n_frames', 1) > 1:
+            return {}
+        format = image.format or ''
+        original_size = image.size
+        options = {'icc_profile': image.info.get('icc_profile')}
+        # The orientation is lost with the rest of the metadata, so we apply
+        # it to the pixels
+        orientation = image.getexif().get(ExifTags.Base.Orientation, 1)
+        optimized = ImageOps.exif_transpose(image) or image
+        size = settings.max_dimension
+        if max(optimized.size) > size:
+            optimized.thumbnail((size, size), Image.Resampling.LANCZOS)
+        redrawn = orientation != 1 or optimized.size != original_size
+        files = {}
+        if redrawn or any(key in image.info for key in metadata_keys):
+            if format == 'JPEG' and not redrawn:
+                # Re-use the original's quantization tables, so that the
+                # pixels aren't degraded by encoding them again
+                files['original'] = encode(
+                    image, format, quality='keep', **options
+                )
+            elif format == 'JPEG':
+                files['original'] = encode(
+                    optimized, format, quality=settings.quality, **options
+                )
+            else:
+                files['original'] = encode(optimized, format, **options)
+        for variant in settings.formats:
+            if variant.upper() != format:
+                files[variant] = encode(
+                    web_colours(optimized),
+                    variant.upper(),
+                    quality=settings.quality,
+                    **options,
+                )
+        return files
+
+
+def cache_key(data: bytes, settings: Settings) -> str:
+    digest = hashlib.sha256(data)
+    digest.update(repr(settings).encode())
+    return digest.hexdigest()
+
+
+def optimize(
+    path: Path, settings: Settings, cache_dir: Path | None = None
+) -> int:
+    """Optimize a downloaded image in place, returning the bytes saved
+
+    The files made from an image are cached (if there's a cache directory)
+    by a hash of its contents and the settings, so an image is only processed
+    once, however many times it's downloaded.
+
+    Files are replaced rather than rewritten, as a download can be a hard
+    link to a file in the Downloader's cache, which mustn't change.
+
+    """
+    data = path.read_bytes()
+    if cache_dir is None:
+        files = process(data, settings)
+        for name, contents in files.items():
+            target = path if name == 'original' else variant_path(path, name)
+            with atomic_write(target) as file:
+                file.write(contents)
+        return len(data) - len(files.get('original', data))
+    key = cache_key(data, settings)
+    entry = cache_dir / key[:2] / key
+    if not entry.exists():
+        store(entry, process(data, settings))
+    saved = 0
+    for source in entry.iterdir():
+        if source.name == 'original':
+            saved = len(data) - source.stat().st_size
+            link_or_copy(source, path)
+        else:
+            link_or_copy(source, variant_path(path, source.name))
+    return saved
+
+
+def store(entry: Path, files: dict[str, bytes]) -> None:
+    # Other processes might be storing the same image, so each one fills a
+    # directory of its own and moves it into place.
+    entry.parent.mkdir(parents=True, exist_ok=True)
+    partial = Path(
+        tempfile.mkdtemp(dir=entry.parent, prefix=f'.{entry.name}.')
+    )
+    for name, contents in files.items():
+        (partial / name).write_bytes(contents)
+    try:
+        os.rename(partial, entry)
+    except OSError:
+        shutil.rmtree(partial)  # another process got there first
+
+
+class Optimizer:
+    """Optimize downloaded images on a pool of processes
+
+    Failures are logged, and leave the downloaded image as it was.
+
+    """
+
+    def __init__(
+        self,
+        settings: Settings,
+        processes: int = 1,
+        cache_dir: Path | None = None,
+    ) -> None:
+        settings.check()
+        self.settings = settings
+        self.cache_dir = cache_dir
+        self.executor = spawn_pool(processes)
+        self.images = 0
+        self.saved = 0
+        self.lock = threading.Lock()
+
+    def __enter__(self) -> 'Optimizer':
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.executor.shutdown()
+        megabytes = self.saved / 1024 / 1024
+        logging.info(
+            f'Optimized {self.images} images (saving {megabytes:.1f} MB)'
+        )
+
+    def submit(self, path: Path) -> Future:
+        future = self.executor.submit(
+            optimize, path, self.settings, self.cache_dir
+        )
+        future.add_done_callback(lambda future: self.finished(path, future))
+        return future
+
+    def finished(self, path: Path, future: Future) -> None:
+        try:
+            saved = future.result()
+        except Exception as e:
+            logging.warning(f"Couldn't optimize {path}: {e}")
+            return
+        with self.lock:
+            self.images += 1
+            self.saved += saved
+
+    def optimize(self, paths: list[Path]) -> None:
+        """Optimize images, waiting until they're done"""
+        wait([self.submit(path) for path in paths])
+
+    def after(self, download: Future, path: Path) -> None:
+        """Optimize an image once it's been downloaded (if it downloads)"""
+
+        def downloaded(download: Future) -> None:
+            if download.result() is None:
+                self.submit(path)
+
+        download.add_done_callback(downloaded)
@@ -1,31 +1,325 @@
+import abc
+import contextlib
 import dataclasses
 import html.parser
+import re
 import typing
 
-from functools import reduce
+from functools import cached_property, reduce
 
+import bs4  # type: ignore
 import markdownify  # type: ignore
 
+from .profiling import Profiler
+
+# lxml can be importable without BeautifulSoup being able to use it (e.g.
+# if it was built for another Python), so we ask BeautifulSoup.
+html_parser = 'lxml' if bs4.builder_registry.lookup('lxml') else 'html.parser'
+
+
+# The widths of the image sizes that WordPress creates by default
+image_size_widths = {
+    'thumbnail': 150,
+    'medium': 300,
+    'medium_large': 768,
+    'large': 1024,
+}
+
+
+def size_class(classes: str | None) -> str | None:
+    for html_class in (classes or '').split():
+        if html_class.startswith('size-'):
+            return html_class.removeprefix('size-')
+    return None
+
 
 class AttachmentParser(html.parser.HTMLParser):
+    """Find the IDs of the images in some HTML, and how wide they're shown
+
+    An image's width is taken from its `width` attribute, or failing that
+    from the `size-*` class that WordPress puts on the image (or on the
+    figure around it). `widths` maps each image's ID to the largest width
+    it's shown at, or to None if it's shown at full size (or we can't tell).
+
+    """
+
     def __init__(self, callback: typing.Callable) -> None:
         super().__init__()
         self.callback = callback
+        self.widths: dict[str, int | None] = {}
+        self.figure_size: str | None = None
 
-    def _record_attachment_id(self, classes: str) -> None:
+    def _record_attachment_id(self, classes: str) -> list[str]:
+        ids = []
         for html_class in classes.split():
             if html_class.startswith('wp-image-'):
-                self.callback(html_class.rsplit('-', 1)[-1])
+                ids.append(html_class.rsplit('-', 1)[-1])
+                self.callback(ids[-1])
+        return ids
+
+    def _record_width(self, attachment_id: str, width: int | None) -> None:
+        if attachment_id in self.widths:
+            shown = self.widths[attachment_id]
+            width = (
+                None if shown is None or width is None else max(shown, width)
+            )
+        self.widths[attachment_id] = width
+
+    def display_width(self, attrs: dict[str, str | None]) -> int | None:
+        size = size_class(attrs.get('class')) or self.figure_size
+        if size == 'full':
+            return None
+        width = attrs.get('width') or ''
+        if width.isdigit():
+            return int(width)
+        return image_size_widths.get(size or '')
 
     def handle_starttag(
         self, tag: str, attrs: list[tuple[str, str | None]]
     ) -> None:
+        if tag == 'figure':
+            self.figure_size = size_class(dict(attrs).get('class'))
         if tag == 'img':
             for attr, value in attrs:
                 if attr == 'class' and value is not None:
-                    self._record_attachment_id(value)
+                    width = self.display_width(dict(attrs))
+                    for attachment_id in self._record_attachment_id(value):
+                        self._record_width(attachment_id, width)
         return super().handle_starttag(tag, attrs)
 
+    def handle_endtag(self, tag: str) -> None:
+        if tag == 'figure':
+            self.figure_size = None
+        return super().handle_endtag(tag)
+
+
+class ChunkFilter(abc.ABC):
+    """A filter that can join a FilterEngine's single pass over the HTML
+
+    Subclasses set `triggers` to a pattern that matches somewhere in every
+    chunk of text that the filter could change. Patterns are compiled with
+    `re.MULTILINE`, so `^` and `$` match at the start and end of lines.
+
+    The engine splits the HTML into chunks at blank lines, so a filter can only
+    join the pass if none of its matches span a blank line.
+
+    Filters that need to see the whole text before they can decide which
+    chunks to change (see `HostedImageFilter`) can override `trigger()`.
+
+    """
+
+    triggers: re.Pattern
+
+    @abc.abstractmethod
+    def __call__(self, text: str) -> str:
+        ...
+
+    def trigger(self, text: str) -> re.Pattern | None:
+        return self.triggers
+
+    def apply(self, chunk: str) -> str:
+        return self(chunk)
+
+
+def filter_name(html_filter: typing.Callable) -> str:
+    if isinstance(html_filter, FilterEngine):
+        names = ', '.join(filter_name(f) for f in html_filter.filters)
+        return f'FilterEngine({names})'
+    return getattr(html_filter, '__qualname__', type(html_filter).__qualname__)
+
+
+class FilterEngine:
+    """Apply a chain of filters in a single pass over the HTML
+
+    Applying each filter to the whole post in turn means walking very long
+    posts (and allocating a new copy of them) once per filter. Instead, the
+    triggers of all the ChunkFilters are combined into one pattern, and the
+    post is scanned once for chunks (blocks of text between blank lines that
+    aren't inside a tag) that any filter might change. Chunks that no filter is interested in are copied
+    to the output untouched. Each interesting chunk is passed through the
+    filters in order, skipping those whose trigger doesn't match what the
+    previous filters left behind.
+
+    The output is the same as applying the filters to the whole text one after
+    the other, provided that each filter's matches (and the text its trigger
+    depends on) stay within a chunk. Filters that aren't ChunkFilters are
+    still applied to the whole text, in their place in the chain.
+
+    """
+
+    def __init__(
+        self,
+        filters: typing.Sequence[typing.Callable[[str], str]],
+        profiler: Profiler | None = None,
+    ) -> None:
+        self.filters = list(filters)
+        self.profiler = profiler
+        self.stages: list[list[typing.Callable[[str], str]]] = []
+        for f in filters:
+            if (
+                self.stages
+                and self.fusable(f)
+                and self.fusable(self.stages[-1][0])
+            ):
+                self.stages[-1].append(f)
+            else:
+                self.stages.append([f])
+
+    @staticmethod
+    def fusable(html_filter: typing.Callable[[str], str]) -> bool:
+        return isinstance(html_filter, ChunkFilter)
+
+    def __call__(self, text: str) -> str:
+        for stage in self.stages:
+            if self.fusable(stage[0]):
+                chunk_filters = typing.cast(list[ChunkFilter], stage)
+                text = self.apply_in_one_pass(chunk_filters, text)
+            else:
+                with self.timing(stage[0], len(text)):
+                    text = stage[0](text)
+        return text
+
+    def timing(
+        self, html_filter: typing.Callable[[str], str], bytes: int
+    ) -> typing.ContextManager[None]:
+        if self.profiler is None:
+            return contextlib.nullcontext()
+        return self.profiler.timing(filter_name(html_filter), bytes)
+
+    @staticmethod
+    def inside_tag(text: str, position: int) -> bool:
+        return text.rfind('<', 0, position) > text.rfind('>', 0, position)
+
+    def chunk_start(self, text: str, position: int, match_start: int) -> int:
+        start = text.rfind('\n\n', position, match_start)
+        while start != -1 and self.inside_tag(text, start):
+            start = text.rfind('\n\n', position, start)
+        return position if start == -1 else start + 2
+
+    def chunk_end(self, text: str, match_end: int) -> int:
+        end = text.find('\n\n', match_end)
+        while end != -1 and self.inside_tag(text, end):
+            end = text.find('\n\n', end + 2)
+        return len(text) if end == -1 else end
+
+    def apply_in_one_pass(self, filters: list[ChunkFilter], text: str) -> str:
+        triggered = []
+        for f in filters:
+            with self.timing(f, len(text)):
+                pattern = f.trigger(text)
+            if pattern is not None:
+                triggered.append((f, pattern))
+        if not triggered:
+            return text
+        alternatives = '|'.join(f'(?:{p.pattern})' for _, p in triggered)
+        interesting = re.compile(alternatives, flags=re.MULTILINE)
+
+        output = []
+        position = 0
+        while match := interesting.search(text, position):
+            start = self.chunk_start(text, position, match.start())
+            end = self.chunk_end(text, match.end())
+            chunk = text[start:end]
+            for f, pattern in triggered:
+                if pattern.search(chunk):
+                    with self.timing(f, len(chunk)):
+                        chunk = f.apply(chunk)
+            output.append(text[position:start])
+            output.append(chunk)
+            position = end
+        output.append(text[position:])
+        return ''.join(output)
+
+
+class Markdownify:
+    """Convert HTML to Markdown with markdownify
+
+    `markdownify.markdownify()` builds a new converter (and its options) for
+    every call, so we build one up front and reuse it. It also always parses
+    the HTML with Python's own parser, so we parse it ourselves, with lxml if
+    it's installed, as it's much faster. The parsers don't agree on all HTML
+    (e.g. malformed comments), so the Markdown can depend on which one is
+    used, and the parser is part of the converter's name.
+
+    Parsing the HTML is still the slowest part of converting a post, so posts
+    that consist of nothing but plain paragraphs, headings and comments (i.e.
+    with no other tags, entities or characters that would need escaping) are
+    converted without it, producing the same output that markdownify would.
+
+    """
+
+    plain_post = re.compile(
+        r'(?:\s|<!--(?:[^-]|-(?!-))*-->'
+        r'|<(p|h[1-6])(?:\s[^<>/]*)?>[^<&*_\\]*</\1>)*'
+    )
+    plain_token = re.compile(
+        r'(\s+)|<!--(?:[^-]|-(?!-))*-->'
+        r'|<(p|h([1-6]))(?:\s[^<>/]*)?>([^<]*)</\2>'
+    )
+    newline_whitespace = re.compile(r'[\t \r\n]*[\r\n][\t \r\n]*')
+    whitespace = re.compile(r'[\t ]+')
+    all_whitespace = re.compile(r'[\t \r\n]+')
+    newlines = re.compile(r'^(\n*)((?:.*[^\n])?)(\n*)$', flags=re.DOTALL)
+
+    def __init__(self, parser: str = html_parser) -> None:
+        self.parser = parser
+        self.name = f'markdownify ({parser})'
+        self.converter = markdownify.MarkdownConverter(
+            heading_style=markdownify.ATX
+        )
+
+    def __reduce__(self) -> tuple[type, tuple[str]]:
+        # The converter caches functions that can't be pickled
+        return (type(self), (self.parser,))
+
+    def __call__(self, html: str) -> str:
+        if self.plain_post.fullmatch(html):
+            return self.convert_plain_post(html)
+        soup = bs4.BeautifulSoup(html, self.parser)
+        return self.converter.convert_soup(soup)
+
+    def convert_plain_post(self, html: str) -> str:
+        # This follows what markdownify does with the same elements, which
+        # is to ignore comments, and whitespace next to paragraphs and
+        # headings. Whitespace between comments is kept though.
+        tokens = list(self.plain_token.finditer(html))
+        strings = []
+        for i, token in enumerate(tokens):
+            if token.group(1):
+                neighbours = tokens[max(i - 1, 0) : i + 2]
+                if not any(t.group(2) for t in neighbours):
+                    strings.append(self.normalise(token.group(1)))
+            elif token.group(2) == 'p':
+                text = self.normalise(token.group(4))
+                text = text.lstrip(' \t\r\n').rstrip()
+                if text:
+                    strings.append(f'\n\n{text}\n\n')
+            elif token.group(2):
+                text = self.normalise(token.group(4)).strip()
+                text = self.all_whitespace.sub(' ', text)
+                strings.append(f'\n\n{"#" * int(token.group(3))} {text}\n\n')
+        return self.join(strings).strip('\n')
+
+    def normalise(self, text: str) -> str:
+        text = self.newline_whitespace.sub('\n', text)
+        return self.whitespace.sub(' ', text)
+
+    def join(self, strings: list[str]) -> str:
+        # Runs of newlines between strings are collapsed to at most two
+        joined = ['']
+        for string in strings:
+            match = self.newlines.match(string)
+            assert match is not None
+            leading, content, trailing = match.groups()
+            if joined[-1] and leading:
+                previous = joined.pop()
+                leading = '\n' * min(2, max(len(previous), len(leading)))
+            joined.extend([leading, content, trailing])
+        return ''.join(joined)
+
+
+default_converter = Markdownify()
+
 
 @dataclasses.dataclass
 class Page:
@@ -38,21 +332,69 @@ class Page:
     filters: list[typing.Callable[[str], str]] = dataclasses.field(
         default_factory=list
     )
+    converter: typing.Callable[[str], str] = default_converter
 
-    @property
+    # Rendering a page is expensive, so each of these is only computed once.
+    # They're discarded if the content, filters or converter are replaced.
+    rendered = ('filtered_html', 'markdown', 'attachment_widths')
+
+    def __setattr__(self, name: str, value: typing.Any) -> None:
+        if name in ('content', 'filters', 'converter'):
+            for attr in self.rendered:
+                self.__dict__.pop(attr, None)
+        super().__setattr__(name, value)
+
+    @cached_property
     def filtered_html(self) -> str:
         return reduce(lambda html, f: f(html), self.filters, self.content)
 
-    @property
+    @cached_property
     def markdown(self) -> str:
-        return markdownify.markdownify(
-            self.filtered_html, heading_style=markdownify.ATX
-        )
+        return self.converter(self.filtered_html)
 
-    @property
-    def attachment_ids(self) -> set[str]:
-        ids = set()
-        parser = AttachmentParser(lambda attachment_id: ids.add(attachment_id))
+    @cached_property
+    def attachment_widths(self) -> dict[str, int | None]:
+        """How wide the page's images are shown (see AttachmentParser)"""
+        parser = AttachmentParser(lambda attachment_id: None)
         parser.feed(self.filtered_html)
         parser.close()
-        return ids
+        return parser.widths
+
+    @property
+    def attachment_ids(self) -> set[str]:
+        return set(self.attachment_widths)
+
+
+class DeferredPage(Page):
+    """A page whose content is only loaded when it's first used
+
+    Callers that only need a page's metadata (e.g. its slug or tags)
+    needn't keep every page's content in memory. Once it's been loaded (or
+    replaced), the content is kept like any other page's.
+
+    """
+
+    load_content: typing.Callable[[], str] | None
+
+    def __init__(
+        self,
+        load_content: typing.Callable[[], str] | None = None,
+        content: str = '',
+        **fields: typing.Any,
+    ) -> None:
+        # The content is passed in (rather than loaded) when the page is
+        # copied, e.g. by `dataclasses.replace()`.
+        super().__init__(content=content, **fields)
+        if load_content is not None:
+            self.load_content = load_content
+
+    @property
+    def content(self) -> str:
+        if self.load_content is not None:
+            self.content = self.load_content()
+        return self._content
+
+    @content.setter
+    def content(self, text: str) -> None:
+        self._content = text
+        self.load_content = None
@@ -0,0 +1,186 @@
+import logging
+import multiprocessing
+import queue
+import threading
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Iterable
+
+from .profiling import Profiler
+
+# Tells a worker that there are no more items for its stage
+finished = object()
+
+
+class Stage:
+    def __init__(
+        self,
+        name: str,
+        function: Callable[[Any], Any],
+        workers: int,
+        queue_size: int,
+    ) -> None:
+        self.name = name
+        self.function = function
+        self.workers = workers
+        self.queue: queue.Queue = queue.Queue(queue_size)
+        self.running = workers
+
+
+class Pipeline:
+    """Pass items through a series of stages that run at the same time
+
+    Each stage has its own threads (its workers), which take items from a
+    bounded queue and put whatever the stage's function returns on the next
+    stage's queue (results of None are dropped). The items come from an
+    iterable, which is read on a thread of its own.
+
+    When a queue is full, the stage that feeds it waits. So however slow a
+    stage is, no more than a queue's worth of items can pile up in front of
+    it, and memory use stays bounded.
+
+    The depth of each queue is sampled whenever an item is taken from it,
+    and recorded by the profiler (if there is one). `depths()` returns the
+    current depths, which are also logged (at debug level) while the
+    pipeline runs.
+
+    If any stage raises an exception, the other stages stop, and `run()`
+    raises it.
+
+    """
+
+    poll_interval = 0.1
+    log_interval = 5.0
+
+    def __init__(
+        self, source: Iterable[Any], profiler: Profiler | None = None
+    ) -> None:
+        self.source = source
+        self.profiler = profiler
+        self.stages: list[Stage] = []
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.error: BaseException | None = None
+
+    def add(
+        self,
+        name: str,
+        function: Callable[[Any], Any],
+        workers: int = 1,
+        queue_size: int | None = None,
+    ) -> 'Pipeline':
+        queue_size = queue_size or 4 * workers
+        self.stages.append(Stage(name, function, workers, queue_size))
+        return self
+
+    def depths(self) -> dict[str, int]:
+        return {stage.name: stage.queue.qsize() for stage in self.stages}
+
+    def run(self) -> None:
+        threads = [threading.Thread(target=self.feed, name='source')]
+        for index, stage in enumerate(self.stages):
+            threads.extend(
+                threading.Thread(
+                    target=self.work, args=(index,), name=f'{stage.name}-{n}'
+                )
+                for n in range(stage.workers)
+            )
+        for thread in threads:
+            thread.start()
+        try:
+            self.wait(threads)
+        except BaseException as e:
+            # e.g. KeyboardInterrupt; the workers finish what they're doing
+            self.fail(e)
+            for thread in threads:
+                thread.join()
+            raise
+        if self.error is not None:
+            raise self.error
+
+    def wait(self, threads: list[threading.Thread]) -> None:
+        logged = time.monotonic()
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(self.poll_interval)
+                if time.monotonic() - logged >= self.log_interval:
+                    logging.debug(f'Queue depths: {self.depths()}')
+                    logged = time.monotonic()
+
+    def put(self, index: int, item: Any) -> bool:
+        """Wait for room in a stage's queue, unless the pipeline's stopping"""
+        while not self.stopping.is_set():
+            try:
+                self.stages[index].queue.put(item, timeout=self.poll_interval)
+            except queue.Full:
+                continue
+            return True
+        return False
+
+    def get(self, stage: Stage) -> Any:
+        while not self.stopping.is_set():
+            try:
+                item = stage.queue.get(timeout=self.poll_interval)
+            except queue.Empty:
+                continue
+            if self.profiler and item is not finished:
+                depth = stage.queue.qsize() + 1
+                self.profiler.gauge(f'{stage.name} queue', depth)
+            return item
+        return finished
+
+    def feed(self) -> None:
+        try:
+            for item in self.source:
+                if not self.put(0, item):
+                    return
+        except BaseException as e:
+            self.fail(e)
+        finally:
+            self.close(0)
+
+    def work(self, index: int) -> None:
+        stage = self.stages[index]
+        last = index + 1 == len(self.stages)
+        try:
+            while (item := self.get(stage)) is not finished:
+                result = stage.function(item)
+                if result is not None and not last:
+                    if not self.put(index + 1, result):
+                        return
+        except BaseException as e:
+            self.fail(e)
+        finally:
+            with self.lock:
+                stage.running -= 1
+                done = stage.running == 0
+            if done and not last:
+                self.close(index + 1)
+
+    def close(self, index: int) -> None:
+        # Once everything feeding a stage is done, each worker is told
+        for _ in range(self.stages[index].workers):
+            self.put(index, finished)
+
+    def fail(self, error: BaseException) -> None:
+        with self.lock:
+            if self.error is None:
+                self.error = error
+        self.stopping.set()
+
+
+def spawn_pool(
+    processes: int,
+    initializer: Callable[..., None] | None = None,
+    initargs: tuple = (),
+) -> ProcessPoolExecutor:
+    """Start a pool of processes that can run alongside download threads"""
+    # Forking a process that's running download threads isn't safe, so each
+    # worker starts with a fresh interpreter.
+    return ProcessPoolExecutor(
+        processes,
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=initializer,
+        initargs=initargs,
+    )
@@ -0,0 +1,139 @@
+import contextlib
+import dataclasses
+import json
+import threading
+import time
+
+from pathlib import Path
+from typing import Any, Iterable, Iterator, TypeVar
+
+T = TypeVar('T')
+
+
+@dataclasses.dataclass
+class Stage:
+    calls: int = 0
+    seconds: float = 0.0
+    bytes: int = 0
+
+
+@dataclasses.dataclass
+class Gauge:
+    samples: int = 0
+    total: int = 0
+    peak: int = 0
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.samples if self.samples else 0.0
+
+
+class Profiler:
+    """Record how long each stage of a conversion takes
+
+    Stages are named by the code that times them. Each stage accumulates
+    the number of times it was entered, the time spent in it, and the number
+    of bytes (or characters) it processed. Stages that run on several threads
+    at once (like downloads) can accumulate more time than has elapsed.
+
+    Gauges are sampled rather than timed (e.g. the number of items waiting
+    in a queue); for each one we keep its peak and mean values.
+
+    Code that's being profiled is passed a Profiler, and code that isn't is
+    passed None, so profiling costs nothing unless it's been enabled.
+
+    """
+
+    def __init__(self) -> None:
+        self.stages: dict[str, Stage] = {}
+        self.gauges: dict[str, Gauge] = {}
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+
+    def record(self, name: str, seconds: float, bytes: int = 0) -> None:
+        with self.lock:
+            stage = self.stages.setdefault(name, Stage())
+            stage.calls += 1
+            stage.seconds += seconds
+            stage.bytes += bytes
+
+    def gauge(self, name: str, value: int) -> None:
+        with self.lock:
+            gauge = self.gauges.setdefault(name, Gauge())
+            gauge.samples += 1
+            gauge.total += value
+            gauge.peak = max(gauge.peak, value)
+
+    def merge(self, stages: dict[str, Stage]) -> None:
+        with self.lock:
+            for name, other in stages.items():
+                stage = self.stages.setdefault(name, Stage())
+                stage.calls += other.calls
+                stage.seconds += other.seconds
+                stage.bytes += other.bytes
+
+    def take(self) -> dict[str, Stage]:
+        """Return the stages recorded so far, and start afresh"""
+        with self.lock:
+            stages, self.stages = self.stages, {}
+        return stages
+
+    @contextlib.contextmanager
+    def timing(self, name: str, bytes: int = 0) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started, bytes)
+
+    def iterate(self, name: str, iterable: Iterable[T]) -> Iterator[T]:
+        iterator = iter(iterable)
+        while True:
+            started = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.record(name, time.perf_counter() - started)
+            yield item
+
+    def as_dict(self) -> dict[str, Any]:
+        return {
+            'seconds': time.perf_counter() - self.started,
+            'stages': {
+                name: dataclasses.asdict(stage)
+                for name, stage in self.stages.items()
+            },
+            'gauges': {
+                name: {'peak': gauge.peak, 'mean': gauge.mean}
+                for name, gauge in self.gauges.items()
+            },
+        }
+
+    def dump(self, path: Path) -> None:
+        path.write_text(json.dumps(self.as_dict(), indent=2))
+
+    def report(self) -> str:
+        width = max([len(name) for name in self.stages] + [len('stage')])
+        lines = [
+            f'{"stage":<{width}} {"calls":>8} {"seconds":>10} '
+            f'{"ms/call":>9} {"MB":>9}'
+        ]
+        for name, stage in self.stages.items():
+            per_call = stage.seconds / stage.calls * 1000
+            megabytes = stage.bytes / 1024 / 1024
+            lines.append(
+                f'{name:<{width}} {stage.calls:>8} {stage.seconds:>10.3f} '
+                f'{per_call:>9.2f} {megabytes:>9.1f}'
+            )
+        elapsed = time.perf_counter() - self.started
+        lines.append(f'{"total elapsed":<{width}} {"":>8} {elapsed:>10.3f}')
+        if self.gauges:
+            width = max([len(name) for name in self.gauges] + [len('gauge')])
+            lines.append('')
+            lines.append(f'{"gauge":<{width}} {"peak":>8} {"mean":>10}')
+            for name, gauge in self.gauges.items():
+                lines.append(
+                    f'{name:<{width}} {gauge.peak:>8} {gauge.mean:>10.1f}'
+                )
+        return '\n'.join(lines)
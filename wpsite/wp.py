@@ -1,12 +1,20 @@
+import bz2
+import dataclasses
+import functools
+import gzip
 import io
 import logging
+import lzma
+import os
 import re
+import tempfile
 import xml.etree.ElementTree as ElementTree
 
 from functools import reduce
-from typing import Any, Callable, Generator
+from typing import IO, Any, Callable, Generator, Mapping
 
-from .page import Page
+from .attachments import AttachmentIndex, Builder
+from .page import ChunkFilter, DeferredPage, Page
 
 
 namespaces = {
@@ -15,35 +23,130 @@ namespaces = {
 }
 
 
-def text_of(element: ElementTree.Element, tag: str) -> str:
-    child = element.find(tag, namespaces)
-    if child is not None:
-        return '' if child.text is None else child.text
-    raise ValueError(f"Couldn't find {tag} beneath {element.tag}")
+attachment_reference = re.compile(
+    r'wp-image-([0-9]+)|\[gallery ids="([0-9,]+)'
+)
 
 
-def tag_parser(element: ElementTree.Element) -> dict[str, list[str]]:
-    path = 'category[@domain="post_tag"]'
+def referenced_attachment_ids(text: str) -> set[str]:
+    """Find IDs of images and galleries, without parsing the HTML"""
+    ids = set()
+    for image_id, gallery_ids in attachment_reference.findall(text):
+        if image_id:
+            ids.add(image_id)
+        else:
+            ids.update(gallery_ids.split(','))
+    return ids
+
+
+image_classes = re.compile(
+    r'<img\s[^>]*?\bclass=(?:"([^"]*)"|\'([^\']*)\')', flags=re.IGNORECASE
+)
+gallery_shortcode = re.compile(r'\[gallery ids="([0-9,]+)[^]]+\]')
+
+
+def image_attachment_ids(text: str) -> list[str]:
+    """Find the IDs that AttachmentParser would, without parsing the HTML
+
+    Only the `wp-image-*` classes of <img> tags count, as they do for
+    AttachmentParser; IDs elsewhere (e.g. on a <figure>) are ignored.
 
-    def tags(element: ElementTree.Element) -> Generator[str, None, None]:
-        for child in element.iterfind(path, namespaces):
-            yield child.attrib['nicename']
+    """
+    ids = []
+    for match in image_classes.finditer(text):
+        for html_class in (match.group(1) or match.group(2)).split():
+            if html_class.startswith('wp-image-'):
+                ids.append(html_class.rsplit('-', 1)[-1])
+    return ids
+
+
+def gallery_attachment_ids(text: str) -> list[str]:
+    """Find the IDs of the images in the galleries GalleryFilter expands"""
+    ids: list[str] = []
+    for match in gallery_shortcode.finditer(text):
+        ids.extend(match.group(1).split(','))
+    return ids
 
-    return {'tags': list(tags(element))}
 
+@dataclasses.dataclass
+class Item:
+    """The contents of an <item>, decoded in a single walk over its children
 
-def parse_metadata(element: ElementTree.Element, key: str) -> str:
-    path = f'wp:postmeta/wp:meta_key[.="{key}"]/.../wp:meta_value'
-    meta_value = element.find(path, namespaces)
-    if meta_value is not None and meta_value.text:
-        return meta_value.text
-    raise RuntimeError(f"Couldn't find <wp:meta_value> for key {key}")
+    Each child's text is stored under its tag, using the same prefixes as
+    `namespaces` (e.g. `wp:post_name`). Where a tag appears more than once we
+    keep the first, like `ElementTree.find()` does. The post's tags and
+    metadata are collected too, so that parsers can look them up without
+    searching the XML.
 
+    """
+
+    fields: dict[str, str] = dataclasses.field(default_factory=dict)
+    tags: list[str] = dataclasses.field(default_factory=list)
+    meta: dict[str, str] = dataclasses.field(default_factory=dict)
 
-def thumbnail_parser(attachments: dict[str, str]) -> Callable:
-    def parser(element: ElementTree.Element) -> dict[str, str]:
+    def text(self, name: str) -> str:
+        try:
+            return self.fields[name]
+        except KeyError:
+            raise ValueError(f"Couldn't find {name} beneath item") from None
+
+    def metadata(self, key: str) -> str:
+        value = self.meta.get(key)
+        if value:
+            return value
+        raise RuntimeError(f"Couldn't find <wp:meta_value> for key {key}")
+
+
+prefixes = {f'{{{uri}}}': f'{prefix}:' for prefix, uri in namespaces.items()}
+tag_names: dict[str, str] = {}
+
+
+def tag_name(tag: str) -> str:
+    """Convert an ElementTree tag like `{uri}name` into `prefix:name`"""
+    try:
+        return tag_names[tag]
+    except KeyError:
+        name = tag
+        if tag.startswith('{'):
+            uri, local_name = tag[1:].split('}', 1)
+            if prefix := prefixes.get(f'{{{uri}}}'):
+                name = prefix + local_name
+        tag_names[tag] = name
+        return name
+
+
+def decode_item(element: ElementTree.Element) -> Item:
+    item = Item()
+    for child in element:
+        name = tag_name(child.tag)
+        if name == 'wp:postmeta':
+            meta = {tag_name(c.tag): c.text or '' for c in child}
+            key = meta.get('wp:meta_key')
+            if key is not None:
+                item.meta.setdefault(key, meta.get('wp:meta_value', ''))
+        elif name == 'category' and child.get('domain') == 'post_tag':
+            item.tags.append(child.attrib['nicename'])
+        elif name not in item.fields:
+            item.fields[name] = child.text or ''
+    return item
+
+
+def item_type(element: ElementTree.Element) -> str:
+    """Find an item's post type, without decoding the rest of it"""
+    for child in element:
+        if tag_name(child.tag) == 'wp:post_type':
+            return child.text or ''
+    raise ValueError(f"Couldn't find wp:post_type beneath {element.tag}")
+
+
+def tag_parser(item: Item) -> dict[str, list[str]]:
+    return {'tags': item.tags}
+
+
+def thumbnail_parser(attachments: Mapping[str, str]) -> Callable:
+    def parser(item: Item) -> dict[str, str]:
         try:
-            thumbnail_id = parse_metadata(element, '_thumbnail_id')
+            thumbnail_id = item.metadata('_thumbnail_id')
         except RuntimeError as e:
             logging.warning(str(e))
             return {}
@@ -54,50 +157,207 @@ def thumbnail_parser(attachments: dict[str, str]) -> Callable:
 
 
 def parse_post(
-    element: ElementTree.Element, parsers: list[Callable] = []
+    item: Item, parsers: list[Callable] = [], content: bool = True
 ) -> dict:
     defaults = {
-        'title': text_of(element, 'title'),
-        'slug': text_of(element, 'wp:post_name'),
-        'pubDate': text_of(element, 'wp:post_date_gmt'),
-        'content': text_of(element, 'content:encoded'),
+        'title': item.text('title'),
+        'slug': item.text('wp:post_name'),
+        'pubDate': item.text('wp:post_date_gmt'),
         'tags': '',
     }
-    return reduce(
-        lambda d, parser: {**d, **parser(element)}, parsers, defaults
+    if content:
+        defaults['content'] = item.text('content:encoded')
+    return reduce(lambda d, parser: {**d, **parser(item)}, parsers, defaults)
+
+
+Decompressor = Callable[[IO[bytes]], io.BufferedIOBase]
+compression_formats: list[tuple[bytes, Decompressor]] = [
+    (b'\x1f\x8b', lambda file: gzip.GzipFile(fileobj=file)),
+    (b'BZh', bz2.BZ2File),
+    (b'\xfd7zXZ\x00', lzma.LZMAFile),
+]
+
+
+def decompressed(source: IO[Any]) -> IO[Any] | io.BufferedIOBase:
+    """Decompress a gzip, bzip2 or xz compressed export as it's read
+
+    The format is recognised by the first few bytes of the export, which are
+    peeked at (or read, and then sought back over), so a compressed export can
+    be read from a pipe. Uncompressed sources are returned unchanged.
+
+    """
+    if hasattr(source, 'peek'):
+        magic = source.peek(6)[:6]
+    elif source.seekable():
+        position = source.tell()
+        magic = source.read(6)
+        source.seek(position)
+    else:
+        return source
+    if isinstance(magic, bytes):
+        for prefix, open_compressed in compression_formats:
+            if magic.startswith(prefix):
+                return open_compressed(source)
+    return source
+
+
+def items(source: IO[Any]) -> Generator[ElementTree.Element, None, None]:
+    """Stream the <item> elements in an export
+
+    Each <item> is only valid until the generator is resumed. Once the caller
+    has finished with it we empty it and detach everything parsed so far from
+    <channel>, so that memory use doesn't grow with the size of the export.
+
+    Compressed exports are decompressed as they're parsed.
+
+    """
+    channel = None
+    events = ElementTree.iterparse(
+        decompressed(source), events=('start', 'end')
     )
+    for event, element in events:
+        if event == 'start':
+            if element.tag == 'channel':
+                channel = element
+        elif element.tag == 'item':
+            yield element
+            element.clear()
+            if channel is not None:
+                del channel[:]
 
 
 def items_of_type(
-    source: io.TextIOBase, post_type: str
+    source: IO[Any], post_type: str
 ) -> Generator[ElementTree.Element, None, None]:
-    for _, element in ElementTree.iterparse(source):
-        if element.tag == 'item':
-            if text_of(element, 'wp:post_type') == post_type:
-                yield element
+    for element in items(source):
+        if item_type(element) == post_type:
+            yield element
+
+
+class Spill:
+    """Keep strings in a temporary file, until they're needed
+
+    Each string is read back with `os.pread()`, so strings can be loaded
+    from any thread, in any order. The file is deleted once the Spill (and
+    every loader it's returned) has been garbage collected.
+
+    """
+
+    def __init__(self) -> None:
+        self.file = tempfile.TemporaryFile()
+        self.size = 0
+
+    def store(self, text: str) -> Callable[[], str]:
+        data = text.encode('utf-8')
+        os.pwrite(self.file.fileno(), data, self.size)
+        loader = functools.partial(self.load, self.size, len(data))
+        self.size += len(data)
+        return loader
+
+    def load(self, offset: int, length: int) -> str:
+        return os.pread(self.file.fileno(), length, offset).decode('utf-8')
+
+
+def published_posts(source: IO[Any]) -> Generator[Item, None, None]:
+    if source.seekable():
+        source.seek(0)
+    for element in items_of_type(source, 'post'):
+        item = decode_item(element)
+        if item.text('wp:status') == 'publish':
+            yield item
 
 
 def posts(
-    source: io.TextIOBase,
+    source: IO[Any],
     filters: list[Callable[[str], str]] = [],
-    parsers: list[Callable[[ElementTree.Element], dict[str, Any]]] = [],
+    parsers: list[Callable[[Item], dict[str, Any]]] = [],
+    lazy: bool = False,
 ) -> Generator[Page, None, None]:
-    source.seek(0)
-    for element in items_of_type(source, 'post'):
-        if text_of(element, 'wp:status') == 'publish':
-            yield Page(filters=filters, **parse_post(element, parsers))
+    """Parse the published posts in an export
 
+    Lazy posts don't hold their content in memory; it's spilled to a
+    temporary file, and loaded when it's first used (e.g. to render the post).
 
-def attachments_by_id(source: io.TextIOBase) -> dict[str, str]:
+    """
+    spill = Spill() if lazy else None
+    for item in published_posts(source):
+        fields = parse_post(item, parsers)
+        if spill is None:
+            yield Page(filters=filters, **fields)
+        else:
+            load_content = spill.store(fields.pop('content'))
+            yield DeferredPage(load_content, filters=filters, **fields)
+
+
+def post_metadata(
+    source: IO[Any], parsers: list[Callable[[Item], dict[str, Any]]] = []
+) -> Generator[dict[str, Any], None, None]:
+    """Parse everything but the content of the published posts
+
+    This is a quicker way than `posts()` to list the posts' slugs or tags, as
+    no Pages are created, and their content isn't kept.
+
+    """
+    for item in published_posts(source):
+        yield parse_post(item, parsers, content=False)
+
+
+def attachments_by_id(source: IO[Any]) -> AttachmentIndex:
     source.seek(0)
-    urls = {}
+    urls = Builder()
     for element in items_of_type(source, 'attachment'):
-        the_id = text_of(element, 'wp:post_id')
-        urls[the_id] = text_of(element, 'wp:attachment_url')
-    return urls
+        item = decode_item(element)
+        urls.add(item.text('wp:post_id'), item.text('wp:attachment_url'))
+    return urls.build()
+
+
+def split_export(
+    source: IO[Any],
+    wanted: Callable[[str], bool] | None = None,
+    collect_attachments: bool = True,
+) -> tuple[AttachmentIndex, IO[bytes]]:
+    """Read the attachments and published posts in a single pass
+
+    Posts can refer to attachments that appear later in the export, and we
+    can't parse a post until we know the URLs of its attachments. So while
+    we're collecting the attachment URLs we copy the published posts into a
+    temporary file (the "spool"), which can be passed to `posts()` once the
+    whole export has been read.
+
+    The source is only read once, from start to finish, so it doesn't need to
+    be seekable. The price is that each spooled post is serialized back into
+    XML, and parsed a second time by `posts()`; the benchmark suite measures
+    the two passes separately.
+
+    If `wanted` is given, only the posts whose slugs it accepts are spooled.
+    The attachments can be skipped (and an empty index returned) when the
+    caller already has an index of them. The empty index still has the
+    digest of the export's attachments, so the caller can check that its
+    index matches the export.
+
+    """
+    urls = Builder()
+    spool = tempfile.TemporaryFile()
+    spool.write(b'<rss><channel>')
+    for element in items(source):
+        item = decode_item(element)
+        post_type = item.text('wp:post_type')
+        if post_type == 'attachment':
+            attachment_id = item.text('wp:post_id')
+            url = item.text('wp:attachment_url')
+            if collect_attachments:
+                urls.add(attachment_id, url)
+            else:
+                urls.note(attachment_id, url)
+        elif post_type == 'post' and item.text('wp:status') == 'publish':
+            if wanted is None or wanted(item.text('wp:post_name')):
+                spool.write(ElementTree.tostring(element))
+    spool.write(b'</channel></rss>')
+    spool.seek(0)
+    return urls.build(), spool
 
 
-class DeSpanFilter:
+class DeSpanFilter(ChunkFilter):
     """Tidy up WordPress paragraphs for markdownify
 
     markdownify treats `<span>Para</span>` on a line that's separated
@@ -109,12 +369,13 @@ class DeSpanFilter:
 
     span_start = re.compile(r'^<span[^>]*?>', flags=re.MULTILINE)
     span_end = re.compile(r'</span>$', flags=re.MULTILINE)
+    triggers = re.compile(r'^<span|</span>$', flags=re.MULTILINE)
 
     def __call__(self, text: str) -> str:
         return self.span_start.sub('', self.span_end.sub('', text))
 
 
-class RemoveImageLinksFilter:
+class RemoveImageLinksFilter(ChunkFilter):
     """Remove links that navigate to wrapped image
 
     Some of the pages in a site I'm moving off WordPress contain <a> tags that
@@ -127,12 +388,13 @@ class RemoveImageLinksFilter:
     linked_image = re.compile(
         r'<a[^>]+\bhref="([^"]+)[^>]*?>(<img[^>]+\bsrc="\1"[^>]*?>)</a>'
     )
+    triggers = re.compile(r'<a[^>]')
 
     def __call__(self, text: str) -> str:
         return self.linked_image.sub(r'\2', text)
 
 
-class IllustratedParagraphFilter:
+class IllustratedParagraphFilter(ChunkFilter):
     """Insert line break after image at start of paragraph
 
     WordPress's editor makes it easy for people to create paragraphs that start
@@ -144,15 +406,17 @@ class IllustratedParagraphFilter:
     """
 
     leading_image = re.compile(r'^(<img[^>]+>)([^\s])', flags=re.MULTILINE)
+    triggers = re.compile(r'^<img', flags=re.MULTILINE)
 
     def __call__(self, text: str) -> str:
         return self.leading_image.sub(r'\1\n\n\2', text)
 
 
-class GalleryFilter:
-    gallery_pattern = re.compile(r'\[gallery ids="([0-9,]+)[^]]+\]')
+class GalleryFilter(ChunkFilter):
+    gallery_pattern = gallery_shortcode
+    triggers = re.compile(r'\[gallery ids="')
 
-    def __init__(self, attachment_urls: dict[str, str]) -> None:
+    def __init__(self, attachment_urls: Mapping[str, str]) -> None:
         self.urls = attachment_urls
 
     def __call__(self, text: str) -> str: